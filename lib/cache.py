@@ -0,0 +1,480 @@
+# Copyright (c) 2017  Niklas Rosenstein
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+from __future__ import print_function
+import hashlib
+import json
+import os
+import queue
+import re
+import shutil
+import socketserver
+import tempfile
+import threading
+
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from urllib.parse import quote, unquote
+
+import delta from './delta'
+import {FileLock, lock_path} from './lock'
+import {data_dir} from './paths'
+
+#: Files in the cache directory that are not Disk Image files.
+METADATA_FILES = ('hashes.json', 'verified.json')
+
+
+def cache_dir():
+  """
+  Returns the directory in which Disk Image files are cached.
+  """
+
+  return data_dir('dmg')
+
+
+def sha256_file(filename, bufsize=1024*1024):
+  """
+  Computes the SHA-256 hex digest of the file #filename.
+  """
+
+  hasher = hashlib.sha256()
+  with open(filename, 'rb') as fp:
+    for data in iter(lambda: fp.read(bufsize), b''):
+      hasher.update(data)
+  return hasher.hexdigest()
+
+
+def load_hashes(directory=None):
+  """
+  Loads the known SHA-256 digests of Disk Image files. Returns a dictionary
+  that maps file names to hex digests.
+  """
+
+  filename = os.path.join(directory or cache_dir(), 'hashes.json')
+  try:
+    with open(filename) as fp:
+      return json.load(fp)
+  except (IOError, OSError, ValueError):
+    return {}
+
+
+def _lock(directory):
+  # Serializes read-modify-write cycles of the metadata files between
+  # threads and processes.
+  return FileLock(lock_path('cache', os.path.abspath(directory)), what='cache update')
+
+
+def _write_json(filename, data):
+  fd, tmp = tempfile.mkstemp(prefix='.' + os.path.basename(filename) + '.tmp-',
+    dir=os.path.dirname(filename))
+  try:
+    with os.fdopen(fd, 'w') as fp:
+      json.dump(data, fp, indent=2, sort_keys=True)
+    os.chmod(tmp, 0o644)
+    os.rename(tmp, filename)
+  except BaseException:
+    os.remove(tmp)
+    raise
+
+
+def known_hash(name, directory=None):
+  """
+  Returns the known SHA-256 digest of the Disk Image file #name or #None.
+  """
+
+  return load_hashes(directory).get(os.path.basename(name))
+
+
+def record_hash(name, digest, directory=None):
+  """
+  Records #digest as the known SHA-256 digest of the Disk Image file #name.
+  """
+
+  directory = directory or cache_dir()
+  with _lock(directory):
+    hashes = load_hashes(directory)
+    hashes[os.path.basename(name)] = digest
+    _write_json(os.path.join(directory, 'hashes.json'), hashes)
+
+
+def _load_verified(directory):
+  try:
+    with open(os.path.join(directory, 'verified.json')) as fp:
+      return json.load(fp)
+  except (IOError, OSError, ValueError):
+    return {}
+
+
+def _stat_key(filename):
+  st = os.stat(filename)
+  return [st.st_size, st.st_mtime_ns, st.st_ino]
+
+
+def remember_verified(filename, digest, directory=None):
+  """
+  Remembers that the cached file #filename has the SHA-256 #digest, as
+  long as its size, modification time and inode do not change. #lookup()
+  does not hash such a file again.
+  """
+
+  directory = directory or cache_dir()
+  with _lock(directory):
+    verified = _load_verified(directory)
+    verified[os.path.basename(filename)] = {'stat': _stat_key(filename), 'sha256': digest}
+    _write_json(os.path.join(directory, 'verified.json'), verified)
+
+
+def add(filename, digest=None, directory=None, name=None):
+  """
+  Adds the Disk Image file #filename to the cache, under its base name or
+  #name. The file is hard-linked if possible and copied otherwise. If
+  #digest is not specified, it will be computed. Returns the path to the
+  cached file.
+  """
+
+  directory = directory or cache_dir()
+  dest = os.path.join(directory, os.path.basename(name or filename))
+  if os.path.abspath(filename) != os.path.abspath(dest):
+    if os.path.exists(dest):
+      os.remove(dest)
+    try:
+      os.link(filename, dest)
+    except OSError:
+      shutil.copyfile(filename, dest)
+  digest = digest or sha256_file(dest)
+  record_hash(dest, digest, directory)
+  remember_verified(dest, digest, directory)
+  return dest
+
+
+def lookup(name, directory=None):
+  """
+  Returns the path to the cached Disk Image file #name or #None if it is
+  not cached or if it does not match its known digest. The file is only
+  hashed if it changed since it was last verified.
+  """
+
+  directory = directory or cache_dir()
+  filename = os.path.join(directory, os.path.basename(name))
+  digest = known_hash(name, directory)
+  if not digest or not os.path.isfile(filename):
+    return None
+  memo = _load_verified(directory).get(os.path.basename(name))
+  if memo and memo['sha256'] == digest and memo['stat'] == _stat_key(filename):
+    return filename
+  if sha256_file(filename) != digest:
+    return None
+  remember_verified(filename, digest, directory)
+  return filename
+
+
+def copy_to(filename, dest):
+  """
+  Hard-links or copies the file #filename to #dest.
+  """
+
+  if os.path.exists(dest):
+    if os.path.samefile(filename, dest):
+      return
+    os.remove(dest)
+  try:
+    os.link(filename, dest)
+  except OSError:
+    shutil.copyfile(filename, dest)
+
+
+class RangeRequestHandler(BaseHTTPRequestHandler):
+  """
+  Serves the files in the cache directory of the #CacheServer. Single
+  byte ranges are supported so that interrupted transfers can be resumed.
+  The `X-Content-SHA256` header is set for files with a known digest.
+
+  The delta index of a file (see the #delta module) is served as
+  `<name>.osxtsync`. Indexes are built in the background by the server;
+  while the index of a file is not ready, requests for it are answered
+  with `503 Service Unavailable` and a `Retry-After` header.
+  """
+
+  server_version = 'osxt-cache'
+  bufsize = 1024 * 1024
+  range_regex = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+  def do_HEAD(self):
+    self.send_file(head=True)
+
+  def do_GET(self):
+    self.send_file(head=False)
+
+  def send_file(self, head):
+    directory = self.server.directory
+    name = unquote(self.path.split('?')[0].lstrip('/'))
+    if not name:
+      return self.send_listing(head)
+    if '/' in name or name.startswith('.') or name in METADATA_FILES:
+      return self.send_error(404)
+    filename = os.path.join(directory, name)
+    if name.endswith(delta.INDEX_SUFFIX):
+      source = filename[:-len(delta.INDEX_SUFFIX)]
+      if not known_hash(os.path.basename(source), directory) or not os.path.isfile(source):
+        return self.send_error(404)
+      if delta.load_index(source, build=False) is None:
+        self.server.build_index(source)
+        self.send_response(503)
+        self.send_header('Retry-After', str(self.server.retry_after))
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+        return
+    if not os.path.isfile(filename):
+      return self.send_error(404)
+
+    size = os.path.getsize(filename)
+    start, end = 0, size - 1
+    status = 200
+    header = self.headers.get('Range')
+    if header:
+      match = self.range_regex.match(header.strip())
+      if not match or not (match.group(1) or match.group(2)):
+        return self.send_error(416)
+      if not match.group(1):
+        start = max(0, size - int(match.group(2)))
+      else:
+        start = int(match.group(1))
+        if match.group(2):
+          end = min(end, int(match.group(2)))
+      if start >= size or start > end:
+        self.send_response(416)
+        self.send_header('Content-Range', 'bytes */{}'.format(size))
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+        return
+      status = 206
+
+    self.send_response(status)
+    self.send_header('Content-Type', 'application/octet-stream')
+    self.send_header('Content-Length', str(end - start + 1))
+    self.send_header('Accept-Ranges', 'bytes')
+    if status == 206:
+      self.send_header('Content-Range', 'bytes {}-{}/{}'.format(start, end, size))
+    digest = known_hash(name, directory)
+    if digest:
+      self.send_header('X-Content-SHA256', digest)
+      self.send_header('ETag', '"{}"'.format(digest))
+    self.end_headers()
+    if head:
+      return
+
+    with open(filename, 'rb') as fp:
+      fp.seek(start)
+      remaining = end - start + 1
+      while remaining > 0:
+        data = fp.read(min(self.bufsize, remaining))
+        if not data:
+          break
+        self.wfile.write(data)
+        remaining -= len(data)
+
+  def send_listing(self, head):
+    directory = self.server.directory
+    hashes = load_hashes(directory)
+    files = {}
+    for name in sorted(os.listdir(directory)):
+      filename = os.path.join(directory, name)
+      if name.startswith('.') or name in METADATA_FILES or not os.path.isfile(filename):
+        continue
+      if name.endswith(delta.INDEX_SUFFIX):
+        continue
+      files[name] = {'size': os.path.getsize(filename), 'sha256': hashes.get(name)}
+    data = json.dumps(files, indent=2).encode('utf8')
+    self.send_response(200)
+    self.send_header('Content-Type', 'application/json')
+    self.send_header('Content-Length', str(len(data)))
+    self.end_headers()
+    if not head:
+      self.wfile.write(data)
+
+  def log_message(self, format, *args):
+    if self.server.verbose:
+      BaseHTTPRequestHandler.log_message(self, format, *args)
+
+
+class CacheServer(socketserver.ThreadingMixIn, HTTPServer):
+  """
+  A threaded HTTP server for the Disk Image files in #directory. Pass port
+  0 to bind to a free port, which is then available from #server_port.
+
+  The delta indexes of the files are built one at a time in a background
+  thread, starting with all cached files if #index is #True, so that
+  requests never wait for an index to be built.
+  """
+
+  daemon_threads = True
+
+  #: The number of seconds after which clients should ask again for an
+  #: index that is being built.
+  retry_after = 60
+
+  def __init__(self, host='', port=8585, directory=None, verbose=True, index=True):
+    self.directory = directory or cache_dir()
+    self.verbose = verbose
+    HTTPServer.__init__(self, (host, port), RangeRequestHandler)
+    self._index_queue = queue.Queue()
+    self._index_pending = set()
+    self._index_lock = threading.Lock()
+    threading.Thread(target=self._index_worker, daemon=True).start()
+    if index:
+      for name in sorted(load_hashes(self.directory)):
+        filename = os.path.join(self.directory, name)
+        if os.path.isfile(filename):
+          self.build_index(filename)
+
+  def build_index(self, filename):
+    """
+    Queues #filename for building its delta index, unless it is already
+    queued.
+    """
+
+    with self._index_lock:
+      if filename in self._index_pending:
+        return
+      self._index_pending.add(filename)
+    self._index_queue.put(filename)
+
+  def _index_worker(self):
+    while True:
+      filename = self._index_queue.get()
+      try:
+        delta.load_index(filename)
+      except (IOError, OSError, delta.DeltaError) as exc:
+        print('warning: can not index {!r}: {}'.format(filename, exc))
+      finally:
+        with self._index_lock:
+          self._index_pending.discard(filename)
+
+
+def fetch_from_peers(session, peers, name, digest, dest, bufsize=1024*1024):
+  """
+  Tries to download the Disk Image file #name from the osxt cache servers
+  listed in #peers, in order. The content is only accepted if it matches
+  the SHA-256 #digest. A partially downloaded `<dest>.part` file is resumed
+  with a Range request. Returns the URL the file was downloaded from, or
+  #None if no peer could provide it.
+  """
+
+  part = dest + '.part'
+  for peer in peers:
+    url = peer.rstrip('/') + '/' + quote(os.path.basename(name))
+    hasher = hashlib.sha256()
+    headers = {}
+    offset = os.path.getsize(part) if os.path.isfile(part) else 0
+    if offset:
+      headers['Range'] = 'bytes={}-'.format(offset)
+
+    try:
+      response = session.get(url, headers=headers, stream=True, timeout=10)
+      if response.status_code == 416 and offset:
+        # The range starts at the end of the file, the partial file may
+        # already be complete. Otherwise it is useless, start over.
+        response.close()
+        if sha256_file(part) == digest:
+          os.rename(part, dest)
+          return url
+        os.remove(part)
+        offset = 0
+        response = session.get(url, stream=True, timeout=10)
+      if response.status_code == 206 and offset:
+        with open(part, 'rb') as fp:
+          for data in iter(lambda: fp.read(bufsize), b''):
+            hasher.update(data)
+        mode = 'ab'
+      elif response.status_code == 200:
+        mode = 'wb'
+      else:
+        print('peer {}: HTTP {}'.format(peer, response.status_code))
+        continue
+      with open(part, mode) as fp:
+        for data in response.iter_content(bufsize):
+          hasher.update(data)
+          fp.write(data)
+    except (IOError, OSError) as exc:
+      print('peer {}: {}'.format(peer, exc))
+      continue
+
+    if hasher.hexdigest() != digest:
+      print('peer {}: content does not match the known SHA-256'.format(peer))
+      os.remove(part)
+      continue
+    os.rename(part, dest)
+    return url
+
+  return None
+
+
+def fetch_delta_from_peers(session, peers, name, digest, dest, directory=None,
+    progress=None):
+  """
+  Like #fetch_from_peers(), but the file is reconstructed from the cached
+  Disk Image files with the most similar names (eg. the previous release)
+  and only the parts that they do not contain are downloaded, using the
+  delta index of the file on the peer. Returns a tuple of the URL and the
+  #delta.DeltaResult, or #None if no peer could provide the file or no
+  cached file can be used.
+  """
+
+  directory = directory or cache_dir()
+  name = os.path.basename(name)
+  candidates = [os.path.join(directory, x) for x in load_hashes(directory)
+                if x != name and os.path.isfile(os.path.join(directory, x))]
+  if not candidates:
+    return None
+  seeds = []
+  for filename in delta.select_seeds(name, candidates):
+    try:
+      seeds.append((filename, delta.load_index(filename)))
+    except (IOError, OSError, delta.DeltaError) as exc:
+      print('warning: can not index {!r}: {}'.format(filename, exc))
+  if not seeds:
+    return None
+
+  tmp = dest + '.delta'
+  for peer in peers:
+    url = peer.rstrip('/') + '/' + quote(name)
+    try:
+      # The index of a large file is a few MiB, allow for slow links.
+      response = session.get(url + delta.INDEX_SUFFIX, timeout=(10, 120))
+      if response.status_code == 503:
+        print('peer {}: delta index is not ready yet'.format(peer))
+        continue
+      if response.status_code != 200:
+        print('peer {}: no delta index (HTTP {})'.format(peer, response.status_code))
+        continue
+      index = delta.DeltaIndex.loads(response.content)
+      if index.sha256 != digest:
+        print('peer {}: delta index does not match the known SHA-256'.format(peer))
+        continue
+      result = delta.reconstruct(index, seeds, url, tmp, session, progress=progress)
+    except (IOError, OSError, delta.DeltaError) as exc:
+      print('peer {}: {}'.format(peer, exc))
+      continue
+    os.rename(tmp, dest)
+    result.filename = dest
+    return url, result
+
+  if os.path.exists(tmp):
+    os.remove(tmp)
+  return None
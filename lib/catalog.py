@@ -0,0 +1,292 @@
+# Copyright (c) 2017  Niklas Rosenstein
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+import hashlib
+import json
+import os
+import posixpath
+import re
+import tempfile
+import time
+
+from urllib.parse import urlparse
+
+import download from './download'
+import {FileLock, lock_path} from './lock'
+import {data_dir} from './paths'
+
+#: Download URLs are relative to this host in the download list.
+DOWNLOAD_HOST = 'https://download.developer.apple.com'
+
+
+class CatalogError(Exception):
+  pass
+
+
+class RefreshResult(object):
+  """
+  The result of #refresh(). #modified is #False if the server reported
+  that the list did not change (HTTP 304). #added, #updated and #removed
+  are lists of file names.
+  """
+
+  def __init__(self, modified, added=(), updated=(), removed=()):
+    self.modified = modified
+    self.added = list(added)
+    self.updated = list(updated)
+    self.removed = list(removed)
+
+
+def catalog_file():
+  return os.path.join(data_dir(), 'catalog.json')
+
+
+def load(filename=None):
+  """
+  Loads the local catalog. Returns a dictionary with the `url`, `etag`,
+  `last_modified` and `updated` fields of the last refresh, the `entries`,
+  which maps file names to dictionaries with the `name`, `url`, `title`,
+  `date`, `size` and `fingerprint` of every download, and the `digests`
+  recorded with #record_digests().
+  """
+
+  try:
+    with open(filename or catalog_file()) as fp:
+      return json.load(fp)
+  except (IOError, OSError, ValueError):
+    return {'entries': {}}
+
+
+def lock(filename=None):
+  """
+  Returns a #FileLock that serializes changes to the local catalog between
+  threads and processes. Hold it while loading, changing and saving the
+  catalog.
+  """
+
+  filename = os.path.abspath(filename or catalog_file())
+  return FileLock(lock_path('catalog', filename), what='catalog update')
+
+
+def save(catalog, filename=None):
+  filename = filename or catalog_file()
+  fd, tmp = tempfile.mkstemp(prefix='.' + os.path.basename(filename) + '.tmp-',
+    dir=os.path.dirname(os.path.abspath(filename)))
+  try:
+    with os.fdopen(fd, 'w') as fp:
+      json.dump(catalog, fp, indent=2, sort_keys=True)
+    os.chmod(tmp, 0o644)
+    os.rename(tmp, filename)
+  except BaseException:
+    os.remove(tmp)
+    raise
+
+
+def known_hash(name, filename=None):
+  """
+  Returns the SHA-256 digest of the Disk Image file #name recorded in the
+  local catalog, or #None.
+  """
+
+  return load(filename).get('digests', {}).get(posixpath.basename(name))
+
+
+def record_digests(digests, filename=None):
+  """
+  Records the trusted SHA-256 #digests (a dictionary that maps file names
+  to hex digests) in the local catalog. #download.download() verifies
+  files against them, and uses peers for files that are not cached yet.
+  The digests are kept when the catalog is refreshed. Returns the sorted
+  names whose digest was added or changed.
+  """
+
+  with lock(filename):
+    catalog = load(filename)
+    known = catalog.setdefault('digests', {})
+    changed = sorted(name for name, digest in digests.items() if known.get(name) != digest)
+    known.update(digests)
+    save(catalog, filename)
+  return changed
+
+
+def parse_digests(text):
+  """
+  Parses lines of a SHA-256 hex digest and a file name, as printed by
+  `osxt cache list` and `sha256sum`. Empty lines and lines that start with
+  `#` are ignored. Returns a dictionary that maps base names to digests or
+  raises a #CatalogError.
+  """
+
+  digests = {}
+  for lineno, line in enumerate(text.splitlines(), 1):
+    line = line.strip()
+    if not line or line.startswith('#'):
+      continue
+    match = re.match(r'^([0-9a-fA-F]{64})\s+\*?(.+)$', line)
+    if not match:
+      raise CatalogError('line {}: expected a SHA-256 digest and a file name'.format(lineno))
+    digests[posixpath.basename(match.group(2))] = match.group(1).lower()
+  return digests
+
+
+def fingerprint(record):
+  """
+  Returns a digest of the raw download #record from the download list.
+  Records with an unchanged fingerprint are not parsed again.
+  """
+
+  data = json.dumps(record, sort_keys=True, separators=(',', ':'))
+  return hashlib.sha1(data.encode('utf8')).hexdigest()
+
+
+def parse_record(record):
+  """
+  Parses a download #record from the download list and returns a list of
+  catalog entries, one for every `*.dmg` file of the download.
+  """
+
+  entries = []
+  for info in record.get('files') or ():
+    path = info.get('remotePath') or ''
+    name = info.get('filename') or posixpath.basename(path)
+    if not name.lower().endswith('.dmg'):
+      continue
+    url = path if path.startswith('http') else DOWNLOAD_HOST + '/' + path.lstrip('/')
+    entries.append({
+      'name': name,
+      'url': url,
+      'title': record.get('name'),
+      'date': record.get('dateModified') or record.get('dateCreated'),
+      'size': info.get('fileSize'),
+    })
+  return entries
+
+
+def merge(catalog, records):
+  """
+  Merges the download #records into the #catalog. Only records whose
+  #fingerprint changed are parsed. Returns a #RefreshResult.
+  """
+
+  old = catalog.get('entries', {})
+  by_fingerprint = {}
+  for entry in old.values():
+    by_fingerprint.setdefault(entry.get('fingerprint'), []).append(entry)
+
+  entries = {}
+  for record in records:
+    key = fingerprint(record)
+    parsed = by_fingerprint.get(key)
+    if parsed is None:
+      parsed = parse_record(record)
+      for entry in parsed:
+        entry['fingerprint'] = key
+    for entry in parsed:
+      entries[entry['name']] = entry
+
+  result = RefreshResult(True)
+  for name, entry in entries.items():
+    if name not in old:
+      result.added.append(name)
+    elif old[name] != entry:
+      result.updated.append(name)
+  result.removed = [name for name in old if name not in entries]
+  for names in (result.added, result.updated, result.removed):
+    names.sort()
+  catalog['entries'] = entries
+  return result
+
+
+def refresh(session=None, url=None, credentials=None, force=False, filename=None):
+  """
+  Fetches the download list from #url (defaults to the Apple Developer
+  Downloads) and merges it into the local catalog. The request is
+  conditional on the ETag and Last-Modified date of the previous refresh
+  unless #force is #True.
+
+  If the server requires a login and #credentials is specified, it is
+  called to get the Apple ID and password and the request is repeated.
+
+  Returns a #RefreshResult or raises a #CatalogError.
+  """
+
+  import requests
+  session = session or requests.Session()
+  url = url or download.LIST_DOWNLOADS_URL
+  catalog = load(filename)
+  same_source = catalog.get('url') == url
+  etag = catalog.get('etag') if same_source and not force else None
+  last_modified = catalog.get('last_modified') if same_source and not force else None
+
+  response = download.fetch_downloads(session, url, etag, last_modified)
+  if response.status_code in (401, 403) or _is_html(response):
+    if not credentials:
+      raise CatalogError('{} requires an Apple ID login'.format(url))
+    apple_id, password = credentials()
+    if not download.apple_id_login(session, apple_id, password):
+      raise CatalogError('Apple ID login failed')
+    response = download.fetch_downloads(session, url, etag, last_modified)
+
+  if response.status_code == 304:
+    with lock(filename):
+      catalog = load(filename)
+      catalog['updated'] = time.time()
+      save(catalog, filename)
+    return RefreshResult(False)
+  if response.status_code != 200:
+    raise CatalogError('{}: HTTP {}'.format(url, response.status_code))
+  try:
+    records = response.json()['downloads']
+  except (ValueError, KeyError, TypeError):
+    raise CatalogError('{}: unexpected response'.format(url))
+
+  # The catalog is loaded again, it may have changed during the request.
+  with lock(filename):
+    catalog = load(filename)
+    if catalog.get('url') != url:
+      catalog['entries'] = {}
+    result = merge(catalog, records)
+    catalog['url'] = url
+    catalog['etag'] = response.headers.get('ETag')
+    catalog['last_modified'] = response.headers.get('Last-Modified')
+    catalog['updated'] = time.time()
+    save(catalog, filename)
+  return result
+
+
+def _is_html(response):
+  return response.headers.get('Content-Type', '').startswith('text/html')
+
+
+def versions(filename=None):
+  """
+  Returns a list of `(name, url)` tuples for the XCode Version Table in
+  the README followed by the entries of the local catalog that are not in
+  the table. No network request is made.
+  """
+
+  # The table and the download list use different hosts for the same files.
+  result = download.parse_xcode_version_table()
+  paths = set(urlparse(url).path for _, url in result)
+  entries = load(filename).get('entries', {})
+  for name in sorted(entries):
+    if urlparse(entries[name]['url']).path not in paths:
+      result.append((name, entries[name]['url']))
+  return result
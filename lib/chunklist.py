@@ -0,0 +1,133 @@
+# Copyright (c) 2017  Niklas Rosenstein
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+import hashlib
+import mmap
+import os
+import struct
+
+from concurrent.futures import ThreadPoolExecutor
+
+MAGIC = 0x4C4B4E43  # 'CNKL'
+HEADER = struct.Struct('<IIBBBBQQQ')
+CHUNK = struct.Struct('<I32s')
+METHOD_SHA256 = 1
+
+
+class ChunklistError(Exception):
+  pass
+
+
+class Chunk(object):
+
+  def __init__(self, index, offset, size, digest):
+    self.index = index
+    self.offset = offset
+    self.size = size
+    self.digest = digest
+
+  def __repr__(self):
+    return '<Chunk #{} offset={} size={}>'.format(self.index, self.offset, self.size)
+
+
+class Chunklist(object):
+  """
+  The contents of a `*.chunklist` file, as shipped next to `BaseSystem.dmg`
+  in the macOS installer. #chunks is a list of #Chunk objects with the
+  SHA-256 digest of every chunk of the Disk Image File. The signature is
+  not checked.
+  """
+
+  def __init__(self, chunks, signature=None):
+    self.chunks = chunks
+    self.signature = signature
+
+  @property
+  def total_size(self):
+    return sum(chunk.size for chunk in self.chunks)
+
+
+def parse(filename):
+  """
+  Parses the chunklist file #filename and returns a #Chunklist.
+  """
+
+  with open(filename, 'rb') as fp:
+    data = fp.read()
+
+  if len(data) < HEADER.size:
+    raise ChunklistError('{!r}: file too short'.format(filename))
+  magic, header_size, version, chunk_method, sig_method, _, count, \
+    chunk_offset, sig_offset = HEADER.unpack_from(data)
+  if magic != MAGIC:
+    raise ChunklistError('{!r}: bad magic 0x{:08x}'.format(filename, magic))
+  if chunk_method != METHOD_SHA256:
+    raise ChunklistError('{!r}: unsupported chunk method {}'.format(filename, chunk_method))
+  if chunk_offset + count * CHUNK.size > len(data):
+    raise ChunklistError('{!r}: truncated chunk table'.format(filename))
+
+  chunks = []
+  offset = 0
+  for index in range(count):
+    size, digest = CHUNK.unpack_from(data, chunk_offset + index * CHUNK.size)
+    chunks.append(Chunk(index, offset, size, digest))
+    offset += size
+
+  signature = data[sig_offset:] if sig_method and sig_offset else None
+  return Chunklist(chunks, signature)
+
+
+def verify(chunklist, filename, workers=None, progress=None):
+  """
+  Verifies the file #filename against the #Chunklist. The file is mapped
+  into memory and the chunks are hashed in parallel by #workers threads
+  (defaults to the number of CPUs). #progress is called with every
+  verified #Chunk. Returns a list of the chunks whose digest does not
+  match. Raises a #ChunklistError if the file size does not match.
+  """
+
+  size = os.path.getsize(filename)
+  if size != chunklist.total_size:
+    raise ChunklistError('{!r}: size is {} bytes, expected {}'.format(
+      filename, size, chunklist.total_size))
+  if size == 0:
+    return []
+
+  def check(chunk):
+    # hashlib releases the GIL for large buffers, and the memoryview
+    # avoids copying the chunk out of the mapping.
+    digest = hashlib.sha256(view[chunk.offset:chunk.offset + chunk.size]).digest()
+    return chunk, digest == chunk.digest
+
+  failed = []
+  with open(filename, 'rb') as fp:
+    mapping = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+    view = memoryview(mapping)
+    try:
+      with ThreadPoolExecutor(workers or os.cpu_count() or 1) as executor:
+        for chunk, ok in executor.map(check, chunklist.chunks):
+          if not ok:
+            failed.append(chunk)
+          if progress:
+            progress(chunk)
+    finally:
+      view.release()
+      mapping.close()
+  return failed
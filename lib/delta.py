@@ -0,0 +1,365 @@
+# Copyright (c) 2017  Niklas Rosenstein
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+import difflib
+import gzip
+import hashlib
+import json
+import mmap
+import os
+import re
+import tempfile
+import zlib
+
+import {HttpFile} from './httpio'
+import {FileLock, lock_path} from './lock'
+import {UdifError, UdifImage} from './udif'
+
+#: The index of `<name>` is stored and served as `<name>.osxtsync`.
+INDEX_SUFFIX = '.osxtsync'
+INDEX_VERSION = 2
+BLOCK_SIZE = 1024 * 1024
+MIN_SEGMENT_SIZE = 16 * 1024
+
+#: Segment boundaries are placed in front of every match of this pattern,
+#: so they move with the content. It matches once every 64 KiB on average
+#: in random (eg. compressed) data, and `re` finds it at memchr() speed
+#: thanks to the literal first byte.
+ANCHOR = re.compile(rb'\x9b[\x83\x8b\x93\x9b\xa3\xab\xb3\xbb\xc3\xcb\xd3\xdb\xe3\xeb\xf3\xfb]{2}')
+
+
+class DeltaError(Exception):
+  pass
+
+
+class Segment(object):
+  """
+  A range of a file in a #DeltaIndex. #weak is the Adler-32 and #strong
+  the (truncated) SHA-256 of the data.
+  """
+
+  def __init__(self, offset, size, weak, strong):
+    self.offset = offset
+    self.size = size
+    self.weak = weak
+    self.strong = strong
+
+  def __repr__(self):
+    return '<Segment offset={} size={}>'.format(self.offset, self.size)
+
+  @property
+  def key(self):
+    return (self.size, self.weak, self.strong)
+
+
+class DeltaIndex(object):
+  """
+  A block checksum index of a file, similar to a zsync control file. The
+  #segments cover the whole file without gaps. Their boundaries are
+  content-defined (see #segment_ranges()), so data that two files share
+  is split into the same segments wherever it is located in the files,
+  and can be matched by its checksums alone.
+  """
+
+  def __init__(self, size, sha256, segments, block_size=BLOCK_SIZE, mtime=None):
+    self.size = size
+    self.sha256 = sha256
+    self.segments = segments
+    self.block_size = block_size
+    self.mtime = mtime
+
+  def dumps(self):
+    data = {
+      'version': INDEX_VERSION,
+      'size': self.size,
+      'sha256': self.sha256,
+      'block_size': self.block_size,
+      'mtime': self.mtime,
+      'segments': [[s.offset, s.size, s.weak, s.strong] for s in self.segments],
+    }
+    return gzip.compress(json.dumps(data, separators=(',', ':')).encode('utf8'))
+
+  @classmethod
+  def loads(cls, data):
+    try:
+      data = json.loads(gzip.decompress(data).decode('utf8'))
+    except (IOError, OSError, ValueError, EOFError) as exc:
+      raise DeltaError('invalid index: {}'.format(exc))
+    if data.get('version') != INDEX_VERSION:
+      raise DeltaError('unsupported index version {!r}'.format(data.get('version')))
+    segments = [Segment(*x) for x in data['segments']]
+    return cls(data['size'], data['sha256'], segments, data['block_size'], data.get('mtime'))
+
+
+def _split(offset, size, block_size):
+  end = offset + size
+  while offset < end:
+    yield offset, min(block_size, end - offset)
+    offset += block_size
+
+
+def _cut(data, start, end, block_size, min_size=MIN_SEGMENT_SIZE):
+  """
+  Splits the range from #start to #end of #data in front of the matches
+  of #ANCHOR that are at least #min_size bytes apart, and splits the
+  pieces into blocks of at most #block_size.
+  """
+
+  pos = start
+  while pos < end:
+    match = ANCHOR.search(data, pos + min_size, end) if pos + min_size < end else None
+    cut = match.start() if match else end
+    for x in _split(pos, cut - pos, block_size):
+      yield x
+    pos = cut
+
+
+def segment_ranges(filename, block_size=BLOCK_SIZE):
+  """
+  Returns the `(offset, size)` ranges of the segments of #filename, see
+  #DeltaIndex. The file is cut with content-defined chunking: a boundary
+  is placed in front of every match of #ANCHOR, at least
+  #MIN_SEGMENT_SIZE bytes after the previous boundary. Inserting or
+  removing data only changes the segments around the change, the
+  segments after it are shifted but otherwise the same. For UDIF Disk
+  Image Files, the compressed chunks of the partitions are additional
+  boundaries, as consecutive releases share whole chunks.
+  """
+
+  size = os.path.getsize(filename)
+  chunks = []
+  try:
+    with open(filename, 'rb') as fp:
+      image = UdifImage(fp)
+    for partition in image.partitions:
+      for chunk in partition.chunks:
+        if chunk.data_length:
+          chunks.append((chunk.data_offset, chunk.data_length))
+  except (UdifError, ValueError, KeyError):
+    pass  # Not a UDIF Disk Image File, or not one that we understand.
+
+  if not size:
+    return []
+  result = []
+  pos = 0
+  with open(filename, 'rb') as fp:
+    data = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+      for offset, length in sorted(set(chunks)):
+        if offset < pos or offset + length > size:
+          continue
+        result.extend(_cut(data, pos, offset, block_size))
+        result.extend(_cut(data, offset, offset + length, block_size))
+        pos = offset + length
+      result.extend(_cut(data, pos, size, block_size))
+    finally:
+      data.close()
+  return result
+
+
+def build_index(filename, block_size=BLOCK_SIZE):
+  """
+  Builds the #DeltaIndex of #filename in a single pass over the file.
+  """
+
+  hasher = hashlib.sha256()
+  segments = []
+  st = os.stat(filename)
+  with open(filename, 'rb') as fp:
+    for offset, size in segment_ranges(filename, block_size):
+      data = fp.read(size)
+      if len(data) != size:
+        raise DeltaError('{!r} changed while it was indexed'.format(filename))
+      hasher.update(data)
+      segments.append(Segment(offset, size, zlib.adler32(data), _strong(data)))
+  return DeltaIndex(st.st_size, hasher.hexdigest(), segments, block_size, st.st_mtime)
+
+
+def _strong(data):
+  return hashlib.sha256(data).hexdigest()[:32]
+
+
+def index_file(filename):
+  return filename + INDEX_SUFFIX
+
+
+def _read_index(filename):
+  st = os.stat(filename)
+  try:
+    with open(index_file(filename), 'rb') as fp:
+      index = DeltaIndex.loads(fp.read())
+  except (IOError, OSError, DeltaError):
+    return None
+  if index.size == st.st_size and index.mtime == st.st_mtime:
+    return index
+  return None
+
+
+def load_index(filename, build=True):
+  """
+  Returns the #DeltaIndex of #filename from its index file. If the index
+  file is missing or out of date and #build is #True, the index is built
+  and saved, otherwise #None is returned. Only one thread or process
+  builds the index of a file at a time, others wait for it.
+  """
+
+  index = _read_index(filename)
+  if index is not None or not build:
+    return index
+
+  path = index_file(filename)
+  lock = FileLock(lock_path('index', os.path.abspath(filename)), what='indexing of ' + filename)
+  with lock:
+    # The index may have been built while we were waiting for the lock.
+    index = _read_index(filename)
+    if index is not None:
+      return index
+    index = build_index(filename)
+    fd, tmp = tempfile.mkstemp(prefix='.' + os.path.basename(path) + '.tmp-',
+      dir=os.path.dirname(path))
+    try:
+      with os.fdopen(fd, 'wb') as fp:
+        fp.write(index.dumps())
+      os.chmod(tmp, 0o644)
+      os.rename(tmp, path)
+    except BaseException:
+      os.remove(tmp)
+      raise
+  return index
+
+
+def select_seeds(name, candidates, max_seeds=2):
+  """
+  Returns the #max_seeds paths from #candidates whose file names are the
+  most similar to #name, eg. the previous point releases of the same
+  product.
+  """
+
+  def ratio(path):
+    return difflib.SequenceMatcher(None, name, os.path.basename(path)).ratio()
+  return sorted(candidates, key=ratio, reverse=True)[:max_seeds]
+
+
+class DeltaResult(object):
+  """
+  The result of #reconstruct(). #reused is the number of bytes copied from
+  seed files, #fetched the number of bytes that were downloaded.
+  """
+
+  def __init__(self, filename, sha256, reused, fetched, requests):
+    self.filename = filename
+    self.sha256 = sha256
+    self.reused = reused
+    self.fetched = fetched
+    self.requests = requests
+
+
+def plan(index, seeds):
+  """
+  Matches the segments of the #DeltaIndex #index against the indexes of the
+  #seeds, a list of `(filename, DeltaIndex)` tuples. Returns a list that
+  contains a `(filename, offset)` tuple for every segment that is found in
+  a seed and #None for every segment that must be downloaded.
+  """
+
+  available = {}
+  for filename, seed_index in seeds:
+    for segment in seed_index.segments:
+      available.setdefault(segment.key, (filename, segment.offset))
+  return [available.get(segment.key) for segment in index.segments]
+
+
+def _missing_ranges(index, sources, max_request_size):
+  ranges = []
+  for segment, source in zip(index.segments, sources):
+    if source is not None:
+      continue
+    if ranges and ranges[-1][0] + ranges[-1][1] == segment.offset and \
+        ranges[-1][1] + segment.size <= max_request_size:
+      ranges[-1][1] += segment.size
+    else:
+      ranges.append([segment.offset, segment.size])
+  return [tuple(x) for x in ranges]
+
+
+def reconstruct(index, seeds, url, dest, session=None, jobs=4, progress=None,
+    max_request_size=8*1024*1024):
+  """
+  Reconstructs the file described by #index at #dest. Segments found in the
+  #seeds (see #plan()) are copied from there and only the missing ranges
+  are downloaded from #url with HTTP Range requests, #jobs at a time. The
+  result is verified against the SHA-256 of the index. #progress is called
+  with the number of bytes written and the size of the file.
+
+  Returns a #DeltaResult or raises a #DeltaError.
+  """
+
+  sources = plan(index, seeds)
+  ranges = _missing_ranges(index, sources, max_request_size)
+  fp = HttpFile(url, session) if ranges else None
+  if fp is not None and fp.size != index.size:
+    raise DeltaError('{}: size {} does not match the index ({})'.format(url, fp.size, index.size))
+
+  written = 0
+  reused = 0
+  handles = {}
+  try:
+    with open(dest, 'wb') as out:
+      out.truncate(index.size)
+      for segment, source in zip(index.segments, sources):
+        if source is None:
+          continue
+        filename, offset = source
+        if filename not in handles:
+          handles[filename] = open(filename, 'rb')
+        seed = handles[filename]
+        seed.seek(offset)
+        data = seed.read(segment.size)
+        if zlib.adler32(data) != segment.weak or _strong(data) != segment.strong:
+          raise DeltaError('{!r} changed since it was indexed'.format(filename))
+        out.seek(segment.offset)
+        out.write(data)
+        written += len(data)
+        reused += len(data)
+        if progress:
+          progress(written, index.size)
+
+      # Download the missing ranges in batches, so that at most #jobs
+      # requests of #max_request_size are held in memory.
+      for start in range(0, len(ranges), jobs):
+        batch = ranges[start:start + jobs]
+        for (offset, size), data in zip(batch, fp.read_ranges(batch, jobs)):
+          out.seek(offset)
+          out.write(data)
+          written += len(data)
+          if progress:
+            progress(written, index.size)
+  finally:
+    for handle in handles.values():
+      handle.close()
+
+  hasher = hashlib.sha256()
+  with open(dest, 'rb') as out:
+    for data in iter(lambda: out.read(1024 * 1024), b''):
+      hasher.update(data)
+  if hasher.hexdigest() != index.sha256:
+    raise DeltaError('SHA-256 of the reconstructed file does not match the index')
+  return DeltaResult(dest, index.sha256, reused, fp.bytes_fetched if fp else 0,
+    fp.requests if fp else 0)
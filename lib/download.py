@@ -18,9 +18,39 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 # THE SOFTWARE.
 
+import hashlib
 import os
+import posixpath
 import re
 
+import cache from './cache'
+import {BytesDownloaded, EventBus} from './events'
+import {FileLock, LockTimeout, lock_path} from './lock'
+
+#: The Apple Developer Downloads endpoint that lists the available files.
+LIST_DOWNLOADS_URL = ('https://developer.apple.com/services-account/QH65B2/'
+                      'downloadws/listDownloads.action')
+
+
+class DownloadError(Exception):
+  pass
+
+
+class DownloadResult(object):
+  """
+  The result of #download(). #source is one of `'cache'`, `'delta'`,
+  `'peer'` and `'apple'`, #url is the URL the file was downloaded from
+  (#None if it was taken from the cache). For `'delta'`, #delta is the
+  #delta.DeltaResult with the number of bytes reused and downloaded.
+  """
+
+  def __init__(self, filename, source, url, sha256, delta=None):
+    self.filename = filename
+    self.source = source
+    self.url = url
+    self.sha256 = sha256
+    self.delta = delta
+
 
 def apple_id_login(session, apple_id, password, getdownloads=False):
   """
@@ -50,14 +80,28 @@ def apple_id_login(session, apple_id, password, getdownloads=False):
     return False
 
   # Grab the the ADCDownloadAuth cookie.
-  response = session.get('https://developer.apple.com/services-account/QH65B2/'
-                         'downloadws/listDownloads.action', stream=True)
+  response = fetch_downloads(session)
 
   if getdownloads:
     return response.json()
   return True
 
 
+def fetch_downloads(session, url=LIST_DOWNLOADS_URL, etag=None, last_modified=None):
+  """
+  Requests the list of downloads from #url. If #etag or #last_modified
+  are specified, the request is conditional and the response has status
+  304 if the list did not change. Returns the response object.
+  """
+
+  headers = {}
+  if etag:
+    headers['If-None-Match'] = etag
+  if last_modified:
+    headers['If-Modified-Since'] = last_modified
+  return session.get(url, headers=headers, stream=True)
+
+
 def parse_xcode_version_table():
   """
   Parses the XCode Version Table in the README.md and returns a list of the
@@ -74,3 +118,149 @@ def parse_xcode_version_table():
   contents = contents[begin:end]
   results = re.findall('\[(xcode(?:[\.\d]+)-.*?.dmg)\]\((.*?)\)', contents)
   return results
+
+
+def find_version(query, versions=None):
+  """
+  Finds the single entry in #versions (defaults to the XCode Version
+  Table) whose name contains #query. Returns a tuple of the file name and
+  download URL. Raises a #DownloadError if there is no or more than one
+  matching version. The matching versions are available from the
+  `candidates` attribute of the exception.
+  """
+
+  if versions is None:
+    versions = parse_xcode_version_table()
+  results = [v for v in versions if query in v[0]]
+  if len(results) == 1:
+    return results[0]
+  if not results:
+    exc = DownloadError('no versions matching "{}"'.format(query))
+  else:
+    exc = DownloadError('multiple versions matching "{}"'.format(query))
+  exc.candidates = results
+  raise exc
+
+
+def download(url, filename=None, credentials=None, session=None, peers=(),
+    sha256=None, use_cache=True, progress=None, chunk_size=64*1024,
+    lock_timeout=None, on_wait=None, use_delta=True, events=None):
+  """
+  Downloads the file at #url to #filename (defaults to the base name of
+  the URL). The file is taken from the local cache if possible, then from
+  the #peers (if its SHA-256 is known) and only then from Apple. The
+  SHA-256 is #sha256, or the digest recorded in the local cache or the
+  catalog (see #catalog.record_digests()).
+
+  With #use_delta, the file is first reconstructed from similar files in
+  the cache, downloading only the missing parts from a peer (see
+  #cache.fetch_delta_from_peers()). #progress is also called while doing
+  so.
+
+  #credentials is a function that returns a tuple of the Apple ID and
+  password. It is only called if the file needs to be downloaded from
+  Apple. #progress is called with the number of bytes downloaded and the
+  total size (or #None) while downloading from Apple.
+
+  This function uses no global state besides the cache directory and can
+  be called from multiple threads with different #session objects. Only
+  one thread or process downloads the same file at a time, the others
+  wait for it and take the file from the cache afterwards. #lock_timeout
+  is the number of seconds to wait (#None waits forever), #on_wait is
+  called with the #lock.FileLock.holder() information when waiting.
+
+  If an #events.EventBus is specified, the stages of the download and
+  #events.BytesDownloaded events are emitted on it, with the base name of
+  the URL as the task.
+
+  Returns a #DownloadResult or raises a #DownloadError.
+  """
+
+  name = posixpath.basename(url)
+  lock = FileLock(lock_path('download', name), lock_timeout, 'download of ' + name, on_wait)
+  try:
+    lock.acquire()
+  except LockTimeout as exc:
+    raise DownloadError(str(exc))
+  try:
+    return _download(url, filename, credentials, session, peers, sha256,
+      use_cache, progress, chunk_size, use_delta, events or EventBus())
+  finally:
+    lock.release()
+
+
+def _download(url, filename, credentials, session, peers, sha256, use_cache,
+    progress, chunk_size, use_delta, events):
+  import requests
+  filename = filename or posixpath.basename(url)
+  name = posixpath.basename(url)
+
+  def report(bytes_read, size):
+    if progress:
+      progress(bytes_read, size)
+    events.emit(BytesDownloaded(name, bytes_read, size))
+
+  # Reuse the file from the local cache if we have it.
+  cached = cache.lookup(name)
+  if cached:
+    cache.copy_to(cached, filename)
+    return DownloadResult(filename, 'cache', None, cache.known_hash(name))
+
+  # The catalog may know the digest of a file that was never downloaded on
+  # this machine, see #catalog.record_digests().
+  import catalog from './catalog'
+  session = session or requests.Session()
+  digest = sha256 or cache.known_hash(name) or catalog.known_hash(name)
+  if peers and digest and use_delta:
+    with events.stage(name, 'delta'):
+      found = cache.fetch_delta_from_peers(session, peers, name, digest, filename,
+        progress=report)
+    if found:
+      if use_cache:
+        cache.add(filename, digest, name=name)
+      return DownloadResult(filename, 'delta', found[0], digest, found[1])
+  if peers and digest:
+    with events.stage(name, 'peer'):
+      peer_url = cache.fetch_from_peers(session, peers, name, digest, filename)
+    if peer_url:
+      if use_cache:
+        cache.add(filename, digest, name=name)
+      return DownloadResult(filename, 'peer', peer_url, digest)
+
+  if not credentials:
+    raise DownloadError('Apple ID credentials required to download "{}"'.format(name))
+  apple_id, password = credentials()
+  if not apple_id_login(session, apple_id, password):
+    raise DownloadError('Apple ID login failed')
+
+  response = session.get(url, stream=True)
+  response.raise_for_status()
+  if response.headers.get('Content-Type', '').startswith('text/html'):
+    import bs4
+    soup = bs4.BeautifulSoup(response.content, 'html5lib')
+    raise DownloadError(str(soup.find(id='content')))
+  if 'Content-Length' in response.headers:
+    size = int(response.headers['Content-Length'])
+  else:
+    size = None
+
+  bytes_read = 0
+  hasher = hashlib.sha256()
+  # Download to a temporary name, so that an interrupted download does
+  # not leave a file that looks complete.
+  tmp = filename + '.part'
+  with events.stage(name, 'download'), open(tmp, 'wb') as fp:
+    report(bytes_read, size)
+    for data in response.iter_content(chunk_size):
+      bytes_read += len(data)
+      hasher.update(data)
+      fp.write(data)
+      report(bytes_read, size)
+
+  if digest and hasher.hexdigest() != digest:
+    os.remove(tmp)
+    raise DownloadError('SHA-256 of "{}" does not match {}'.format(filename, digest))
+  os.rename(tmp, filename)
+  if use_cache:
+    cache.add(filename, hasher.hexdigest(), name=name)
+  return DownloadResult(filename, 'apple', url, hasher.hexdigest())
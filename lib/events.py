@@ -0,0 +1,422 @@
+# Copyright (c) 2017  Niklas Rosenstein
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+import collections
+import contextlib
+import json
+import os
+import sys
+import threading
+import time
+
+
+class Event(object):
+  """
+  Base class for the events emitted on an #EventBus. #task names the
+  operation that the event belongs to (eg. the name of a Disk Image File
+  or a package), #time is when the event was created.
+  """
+
+  type = None
+
+  def __init__(self, task):
+    self.task = task
+    self.time = time.time()
+
+  def __repr__(self):
+    return '<{} {!r}>'.format(type(self).__name__, self.task)
+
+  def to_dict(self):
+    result = {'type': self.type}
+    result.update(vars(self))
+    return result
+
+
+class StageStarted(Event):
+
+  type = 'stage_started'
+
+  def __init__(self, task, stage):
+    Event.__init__(self, task)
+    self.stage = stage
+
+
+class StageFinished(Event):
+  """
+  Emitted when a stage ends. #duration is in seconds, #error is the name
+  of the exception type (or another description of the failure) if the
+  stage failed, otherwise #None.
+  """
+
+  type = 'stage_finished'
+
+  def __init__(self, task, stage, duration, error=None):
+    Event.__init__(self, task)
+    self.stage = stage
+    self.duration = duration
+    self.error = error
+
+
+class Progress(Event):
+  """
+  Base class for progress events. #done is the amount of #unit processed
+  so far for the #task, #total the expected amount or #None if unknown.
+  """
+
+  unit = None
+
+  def __init__(self, task, done, total=None):
+    Event.__init__(self, task)
+    self.done = done
+    self.total = total
+
+
+class BytesDownloaded(Progress):
+  type = 'bytes_downloaded'
+  unit = 'bytes'
+
+
+class BytesDecompressed(Progress):
+  type = 'bytes_decompressed'
+  unit = 'bytes'
+
+
+class FilesExtracted(Progress):
+  type = 'files_extracted'
+  unit = 'files'
+
+
+class StageState(object):
+  """
+  Yielded by #EventBus.stage(). #error is reported in the #StageFinished
+  event of the stage.
+  """
+
+  def __init__(self):
+    self.error = None
+
+
+class EventBus(object):
+  """
+  Passes events to a list of sinks. A sink is a callable that accepts an
+  #Event and may have a `close()` method, which is called by #close().
+  Events can be emitted from multiple threads, the sinks are called one
+  at a time. Progress events may be emitted for every chunk of data, so
+  sinks must be cheap and throttle their output themselves.
+  """
+
+  def __init__(self, sinks=()):
+    self.sinks = list(sinks)
+    self._lock = threading.Lock()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *args):
+    self.close()
+
+  def subscribe(self, sink):
+    with self._lock:
+      self.sinks.append(sink)
+    return sink
+
+  def emit(self, event):
+    if not self.sinks:
+      return
+    with self._lock:
+      for sink in self.sinks:
+        sink(event)
+
+  @contextlib.contextmanager
+  def stage(self, task, stage):
+    """
+    A context manager that emits #StageStarted and #StageFinished events
+    around the code that it wraps. It yields a #StageState; setting its
+    #StageState.error marks the stage as failed without raising an
+    exception.
+    """
+
+    self.emit(StageStarted(task, stage))
+    state = StageState()
+    start = time.time()
+    try:
+      yield state
+    except BaseException as exc:
+      self.emit(StageFinished(task, stage, time.time() - start, type(exc).__name__))
+      raise
+    self.emit(StageFinished(task, stage, time.time() - start, state.error))
+
+  def close(self):
+    with self._lock:
+      for sink in self.sinks:
+        if hasattr(sink, 'close'):
+          sink.close()
+
+
+class _Rate(object):
+  """
+  Tracks the throughput of a progress metric, both on average since the
+  first event and over the last #window seconds.
+  """
+
+  def __init__(self, window=5.0):
+    self.window = window
+    self.samples = collections.deque()
+    self.first = None
+
+  def update(self, now, done):
+    if self.first is None:
+      self.first = (now, done)
+    self.samples.append((now, done))
+    while len(self.samples) > 2 and self.samples[1][0] < now - self.window:
+      self.samples.popleft()
+
+  @staticmethod
+  def _rate(first, last):
+    if last[0] <= first[0]:
+      return None
+    return (last[1] - first[1]) / (last[0] - first[0])
+
+  def current(self):
+    return self._rate(self.samples[0], self.samples[-1]) if self.samples else None
+
+  def average(self):
+    return self._rate(self.first, self.samples[-1]) if self.samples else None
+
+
+def _format_amount(value, unit):
+  import {format_size} from './installer'
+  if value is None:
+    return '?'
+  if unit == 'bytes':
+    return format_size(int(value))
+  return str(int(value))
+
+
+class TtyRenderer(object):
+  """
+  Shows the progress of the most recently updated task in a single line
+  on the terminal #stream, redrawn at most every #interval seconds. The
+  line is completed when a stage of the task finishes.
+  """
+
+  def __init__(self, stream=None, interval=0.1):
+    self.stream = stream or sys.stdout
+    self.interval = interval
+    self._task = None
+    self._stages = {}
+    self._metrics = collections.OrderedDict()
+    self._last_draw = 0
+    self._width = 0
+
+  def __call__(self, event):
+    if isinstance(event, StageStarted):
+      self._stages[event.task] = event.stage
+    elif isinstance(event, StageFinished):
+      if event.task == self._task:
+        self._draw(' in {:.1f}s'.format(event.duration))
+        self.stream.write('\n')
+        self.stream.flush()
+        self._task = None
+        self._width = 0
+      self._stages.pop(event.task, None)
+      for key in [k for k in self._metrics if k[0] == event.task]:
+        del self._metrics[key]
+    elif isinstance(event, Progress):
+      key = (event.task, event.type)
+      if key not in self._metrics:
+        self._metrics[key] = [event, _Rate()]
+      state = self._metrics[key]
+      state[0] = event
+      state[1].update(event.time, event.done)
+      self._task = event.task
+      if event.time - self._last_draw >= self.interval:
+        self._draw()
+
+  def _draw(self, suffix=''):
+    parts = []
+    for (task, _), (event, rate) in self._metrics.items():
+      if task != self._task:
+        continue
+      text = _format_amount(event.done, event.unit)
+      if event.total:
+        text += ' of ' + _format_amount(event.total, event.unit)
+      if event.unit != 'bytes':
+        text += ' ' + event.unit
+      if event.total:
+        text += ' ({}%)'.format(min(100, int(event.done * 100 // event.total)))
+      current = rate.current()
+      if current is not None and event.unit == 'bytes':
+        text += ', {}/s'.format(_format_amount(current, event.unit))
+      parts.append(text)
+    stage = self._stages.get(self._task)
+    line = '{}: {}{}{}'.format(self._task, stage + ' ' if stage else '', ', '.join(parts), suffix)
+    self.stream.write('\r' + line.ljust(self._width))
+    self.stream.flush()
+    self._width = len(line)
+    self._last_draw = time.time()
+
+  def close(self):
+    if self._task is not None:
+      self.stream.write('\n')
+      self.stream.flush()
+      self._task = None
+
+
+class JsonLinesSink(object):
+  """
+  Writes events as JSON objects, one per line, to the file object #fp.
+  Stage events are always written. Progress events are written at most
+  every #interval seconds per task and metric, and when they reach their
+  total; the last one of every metric is written on #close(). If
+  #close_fp is True, #fp is closed with the sink.
+  """
+
+  def __init__(self, fp, interval=1.0, close_fp=False):
+    self.fp = fp
+    self.interval = interval
+    self.close_fp = close_fp
+    self._written = {}
+    self._pending = collections.OrderedDict()
+
+  def __call__(self, event):
+    if isinstance(event, Progress):
+      key = (event.task, event.type)
+      last = self._written.get(key)
+      if last is not None and event.time - last < self.interval and event.done != event.total:
+        self._pending[key] = event
+        return
+      self._written[key] = event.time
+      self._pending.pop(key, None)
+    elif isinstance(event, StageFinished):
+      # Flush the progress of the task, so it precedes the end of the stage.
+      for key in [k for k in self._pending if k[0] == event.task]:
+        self._write(self._pending.pop(key))
+    self._write(event)
+
+  def _write(self, event):
+    self.fp.write(json.dumps(event.to_dict(), sort_keys=True) + '\n')
+    self.fp.flush()
+
+  def close(self):
+    while self._pending:
+      self._write(self._pending.popitem(last=False)[1])
+    if self.close_fp:
+      self.fp.close()
+
+
+def _escape_label(value):
+  return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class PrometheusTextfile(object):
+  """
+  Exports the progress, throughput and stage durations to #filename in
+  the Prometheus text format, for the textfile collector of the node
+  exporter. The file is replaced atomically, at most every #interval
+  seconds while progress events arrive and whenever a stage starts or
+  finishes. Errors writing the file are ignored, metrics must not stop
+  a download or installation.
+  """
+
+  def __init__(self, filename, interval=5.0, prefix='osxt'):
+    self.filename = filename
+    self.interval = interval
+    self.prefix = prefix
+    self._progress = collections.OrderedDict()
+    self._stages = collections.OrderedDict()
+    self._last_write = 0
+    self._last_event = None
+
+  def __call__(self, event):
+    self._last_event = event.time
+    if isinstance(event, Progress):
+      key = (event.type, event.task)
+      if key not in self._progress:
+        self._progress[key] = [event, _Rate()]
+      state = self._progress[key]
+      state[0] = event
+      state[1].update(event.time, event.done)
+      if event.time - self._last_write < self.interval:
+        return
+    elif isinstance(event, StageStarted):
+      self._stages[(event.task, event.stage)] = {'running': 1}
+    elif isinstance(event, StageFinished):
+      self._stages[(event.task, event.stage)] = {'running': 0,
+        'duration': event.duration, 'success': 0 if event.error else 1}
+    self.write()
+
+  def render(self):
+    """
+    Returns the current metrics as a string.
+    """
+
+    lines = []
+    def metric(name, type, help, samples):
+      if not samples:
+        return
+      name = self.prefix + '_' + name
+      lines.append('# HELP {} {}'.format(name, help))
+      lines.append('# TYPE {} {}'.format(name, type))
+      for labels, value in samples:
+        labels = ','.join('{}="{}"'.format(k, _escape_label(v)) for k, v in labels)
+        lines.append('{}{{{}}} {}'.format(name, labels, value))
+
+    types = []
+    for type, _ in self._progress:
+      if type not in types:
+        types.append(type)
+    for type in types:
+      states = [(task, state) for (t, task), state in self._progress.items() if t == type]
+      unit = states[0][1][0].unit
+      metric(type, 'gauge', 'The number of {} processed so far.'.format(unit),
+        [([('task', task)], s[0].done) for task, s in states])
+      metric(type + '_expected', 'gauge', 'The number of {} expected in total.'.format(unit),
+        [([('task', task)], s[0].total) for task, s in states if s[0].total is not None])
+      metric(type + '_per_second', 'gauge', 'The average throughput in {} per second.'.format(unit),
+        [([('task', task)], '{:.1f}'.format(s[1].average()))
+          for task, s in states if s[1].average() is not None])
+
+    stages = self._stages.items()
+    metric('stage_running', 'gauge', 'Whether the stage is running.',
+      [([('task', task), ('stage', stage)], s['running']) for (task, stage), s in stages])
+    metric('stage_duration_seconds', 'gauge', 'The duration of the stage.',
+      [([('task', task), ('stage', stage)], '{:.3f}'.format(s['duration']))
+        for (task, stage), s in stages if 'duration' in s])
+    metric('stage_success', 'gauge', 'Whether the stage completed without error.',
+      [([('task', task), ('stage', stage)], s['success'])
+        for (task, stage), s in stages if 'success' in s])
+    if self._last_event is not None:
+      lines.append('# HELP {}_last_event_timestamp_seconds The time of the last event.'.format(self.prefix))
+      lines.append('# TYPE {}_last_event_timestamp_seconds gauge'.format(self.prefix))
+      lines.append('{}_last_event_timestamp_seconds {:.3f}'.format(self.prefix, self._last_event))
+    return '\n'.join(lines) + '\n' if lines else ''
+
+  def write(self):
+    self._last_write = time.time()
+    tmp = '{}.tmp-{}'.format(self.filename, os.getpid())
+    try:
+      with open(tmp, 'w') as fp:
+        fp.write(self.render())
+      os.rename(tmp, self.filename)
+    except (IOError, OSError):
+      pass
+
+  def close(self):
+    self.write()
@@ -0,0 +1,337 @@
+# Copyright (c) 2017  Niklas Rosenstein
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+import os
+import stat
+import struct
+import unicodedata
+
+#: Offset of the volume header from the start of the volume.
+VOLUME_HEADER_OFFSET = 1024
+#: The parts of the volume header that we need: signature, version,
+#: attributes, lastMountedVersion, journalInfoBlock, four dates, fileCount,
+#: folderCount and blockSize.
+VOLUME_HEADER = struct.Struct('>2sHIII16xIII')
+FORK_DATA = struct.Struct('>QII16I')
+EXTENTS_FILE_OFFSET = 192
+CATALOG_FILE_OFFSET = 272
+
+NODE_DESCRIPTOR = struct.Struct('>IIbBHH')
+HEADER_RECORD = struct.Struct('>HIIIIHHII')
+NODE_LEAF = -1
+
+ROOT_FOLDER_ID = 2
+EXTENTS_FILE_ID = 3
+CATALOG_FILE_ID = 4
+
+RECORD_FOLDER = 1
+RECORD_FILE = 2
+
+
+class HfsError(Exception):
+  pass
+
+
+def _parse_fork(data, offset=0):
+  fields = FORK_DATA.unpack_from(data, offset)
+  extents = [(fields[i], fields[i + 1]) for i in range(3, 19, 2) if fields[i + 1]]
+  return fields[0], fields[2], extents
+
+
+class HfsEntry(object):
+  """
+  A file or folder in the catalog of a #HfsVolume. #size and #extents
+  describe the data fork of files; #extents is a list of `(start_block,
+  block_count)` tuples.
+  """
+
+  def __init__(self, name, id, parent, isdir, mode, size=0, extents=()):
+    self.name = name
+    self.id = id
+    self.parent = parent
+    self.isdir = isdir
+    self.mode = mode
+    self.size = size
+    self.extents = list(extents)
+
+  def __repr__(self):
+    return '<HfsEntry {!r} id={} {}>'.format(self.name, self.id, 'dir' if self.isdir else self.size)
+
+  def islnk(self):
+    return stat.S_ISLNK(self.mode)
+
+
+class HfsVolume(object):
+  """
+  A minimal read-only reader for HFS+ and HFSX volumes, sufficient to list
+  directories and read files from the volume of a Disk Image File without
+  mounting it. #fp is a file-like object for the volume; it should have a
+  `read_at()` method and may have a `prefetch()` method (like
+  #udif.PartitionReader), which is used for read-ahead when reading files.
+
+  The catalog is read completely when the volume is opened. This is cheap
+  for the few files on an installer volume, but this class is not meant
+  for large file systems. The journal is ignored.
+  """
+
+  def __init__(self, fp):
+    self.fp = fp
+    header = self._read_at(VOLUME_HEADER_OFFSET, 512)
+    signature, version, _, _, _, self.file_count, self.folder_count, \
+      self.block_size = VOLUME_HEADER.unpack_from(header)
+    if signature not in (b'H+', b'HX'):
+      raise HfsError('not a HFS+ volume (signature {!r})'.format(signature))
+    self.case_sensitive = signature == b'HX'
+    self._extents_fork = _parse_fork(header, EXTENTS_FILE_OFFSET)
+    self._overflow = None
+    catalog_fork = _parse_fork(header, CATALOG_FILE_OFFSET)
+    self._children = {}
+    self._load_catalog(self._fork_file(CATALOG_FILE_ID, catalog_fork))
+
+  def _read_at(self, offset, size):
+    if hasattr(self.fp, 'read_at'):
+      return self.fp.read_at(offset, size)
+    self.fp.seek(offset)
+    return self.fp.read(size)
+
+  def _fork_file(self, file_id, fork):
+    size, total_blocks, extents = fork
+    if sum(count for _, count in extents) < total_blocks:
+      extents = self._overflow_extents(file_id, extents, total_blocks)
+    return HfsFile(self, size, extents)
+
+  def _overflow_extents(self, file_id, extents, total_blocks):
+    # Files with more than eight extents continue in the extents overflow
+    # file, keyed by the file ID and the first block of the continuation.
+    if file_id == EXTENTS_FILE_ID:
+      raise HfsError('fragmented extents overflow file is not supported')
+    if self._overflow is None:
+      self._overflow = {}
+      tree = HfsFile(self, self._extents_fork[0], self._extents_fork[2])
+      for key, data in _iter_leaf_records(tree):
+        fork_type, record_id, start = struct.unpack_from('>BxII', key)
+        if fork_type == 0:
+          self._overflow[(record_id, start)] = _parse_fork(b'\0' * 16 + data)[2]
+    extents = list(extents)
+    while True:
+      have = sum(count for _, count in extents)
+      if have >= total_blocks:
+        return extents
+      more = self._overflow.get((file_id, have))
+      if not more:
+        raise HfsError('missing extents for file {}'.format(file_id))
+      extents += more
+
+  def _load_catalog(self, tree):
+    for key, data in _iter_leaf_records(tree):
+      parent, = struct.unpack_from('>I', key)
+      length, = struct.unpack_from('>H', key, 4)
+      name = key[6:6 + length * 2].decode('utf-16-be')
+      name = unicodedata.normalize('NFC', name)
+      record_type, = struct.unpack_from('>h', data)
+      if record_type == RECORD_FOLDER:
+        folder_id, = struct.unpack_from('>I', data, 8)
+        mode, = struct.unpack_from('>H', data, 42)
+        entry = HfsEntry(name, folder_id, parent, True, mode or 0o40755)
+      elif record_type == RECORD_FILE:
+        file_id, = struct.unpack_from('>I', data, 8)
+        mode, = struct.unpack_from('>H', data, 42)
+        size, total_blocks, extents = _parse_fork(data, 88)
+        if sum(count for _, count in extents) < total_blocks:
+          extents = self._overflow_extents(file_id, extents, total_blocks)
+        entry = HfsEntry(name, file_id, parent, False, mode or 0o100644, size, extents)
+      else:
+        continue
+      self._children.setdefault(parent, {})[name] = entry
+
+  def lookup(self, path):
+    """
+    Returns the #HfsEntry for #path (relative to the root of the volume).
+    Raises an #IOError if it does not exist.
+    """
+
+    folder_id = ROOT_FOLDER_ID
+    entry = HfsEntry('', ROOT_FOLDER_ID, 1, True, 0o40755)
+    for part in [x for x in path.split('/') if x and x != '.']:
+      if not entry.isdir:
+        raise IOError('not a directory: {!r}'.format(path))
+      children = self._children.get(folder_id, {})
+      part = unicodedata.normalize('NFC', part)
+      entry = children.get(part)
+      if entry is None and not self.case_sensitive:
+        entry = next((v for k, v in children.items() if k.lower() == part.lower()), None)
+      if entry is None:
+        raise IOError('no such file or directory: {!r}'.format(path))
+      folder_id = entry.id
+    return entry
+
+  def exists(self, path):
+    try:
+      self.lookup(path)
+    except IOError:
+      return False
+    return True
+
+  def isdir(self, path):
+    return self.exists(path) and self.lookup(path).isdir
+
+  def listdir(self, path=''):
+    entry = self.lookup(path)
+    if not entry.isdir:
+      raise IOError('not a directory: {!r}'.format(path))
+    return sorted(self._children.get(entry.id, {}))
+
+  def open(self, path, readahead=16*1024*1024):
+    """
+    Returns a #HfsFile for the data fork of the file at #path.
+    """
+
+    entry = self.lookup(path)
+    if entry.isdir:
+      raise IOError('is a directory: {!r}'.format(path))
+    return HfsFile(self, entry.size, entry.extents, readahead)
+
+
+class HfsFile(object):
+  """
+  A seekable, read-only file-like object for a fork of a file on a
+  #HfsVolume. If the volume's file object has a `prefetch()` method, data
+  ahead of sequential reads is prefetched. The read-ahead window starts
+  small and doubles with every sequential read up to #readahead bytes, so
+  that reading a few headers does not transfer much more than needed.
+  """
+
+  min_readahead = 64 * 1024
+
+  def __init__(self, volume, size, extents, readahead=0):
+    self.volume = volume
+    self.size = size
+    self.extents = extents
+    self.readahead = readahead
+    self.pos = 0
+    self._prefetched = 0
+    self._window = self.min_readahead
+    self._last_end = None
+    self._limit = size
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *args):
+    self.close()
+
+  def close(self):
+    pass
+
+  def hint(self, offset, size):
+    """
+    Restricts read-ahead to the range of the file that is read next, eg.
+    a member of an archive, so no data after it is fetched.
+    """
+
+    self._limit = min(self.size, offset + size)
+    self._prefetched = offset
+    self._last_end = None
+
+  def ranges(self, offset, size):
+    """
+    Maps a range of the file to a list of `(offset, size)` ranges of the
+    volume.
+    """
+
+    block_size = self.volume.block_size
+    size = max(0, min(size, self.size - offset))
+    result = []
+    file_offset = 0
+    for start, count in self.extents:
+      length = count * block_size
+      if size <= 0:
+        break
+      if offset < file_offset + length:
+        skip = max(0, offset - file_offset)
+        n = min(length - skip, size)
+        result.append((start * block_size + skip, n))
+        offset += n
+        size -= n
+      file_offset += length
+    return result
+
+  def read_at(self, offset, size):
+    fp = self.volume.fp
+    if self.readahead and hasattr(fp, 'prefetch'):
+      if offset == self._last_end:
+        self._window = min(self._window * 2, self.readahead)
+      else:
+        self._window = self.min_readahead
+        self._prefetched = offset
+      self._last_end = offset + size
+      if offset + size > self._prefetched:
+        start = max(offset, self._prefetched)
+        end = max(offset + size, min(start + self._window, self._limit))
+        fp.prefetch(self.ranges(start, end - start))
+        self._prefetched = end
+    return b''.join(self.volume._read_at(o, n) for o, n in self.ranges(offset, size))
+
+  def read(self, size=-1):
+    if size < 0:
+      size = self.size - self.pos
+    data = self.read_at(self.pos, size)
+    self.pos += len(data)
+    return data
+
+  def seek(self, offset, whence=0):
+    if whence == os.SEEK_CUR:
+      offset += self.pos
+    elif whence == os.SEEK_END:
+      offset += self.size
+    self.pos = max(0, offset)
+    return self.pos
+
+  def tell(self):
+    return self.pos
+
+
+def _iter_leaf_records(tree):
+  """
+  Yields the `(key, data)` of every record in the leaf nodes of the B-tree
+  file #tree (a #HfsFile), in key order. #key does not include the key
+  length field.
+  """
+
+  header = tree.read_at(0, 512)
+  if len(header) < NODE_DESCRIPTOR.size + HEADER_RECORD.size:
+    raise HfsError('truncated B-tree header')
+  _, _, _, first_leaf, _, node_size, _, _, _ = HEADER_RECORD.unpack_from(header, NODE_DESCRIPTOR.size)
+  node_id = first_leaf
+  seen = set()
+  while node_id:
+    if node_id in seen:
+      raise HfsError('loop in B-tree leaf nodes')
+    seen.add(node_id)
+    node = tree.read_at(node_id * node_size, node_size)
+    flink, _, kind, _, num_records, _ = NODE_DESCRIPTOR.unpack_from(node)
+    if kind != NODE_LEAF:
+      raise HfsError('expected leaf node at {}'.format(node_id))
+    for index in range(num_records):
+      offset, = struct.unpack_from('>H', node, node_size - 2 * (index + 1))
+      key_length, = struct.unpack_from('>H', node, offset)
+      key = node[offset + 2:offset + 2 + key_length]
+      yield key, node[offset + 2 + key_length:]
+    node_id = flink
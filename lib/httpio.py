@@ -0,0 +1,184 @@
+# Copyright (c) 2017  Niklas Rosenstein
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+import collections
+import os
+import re
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+
+
+class HttpError(IOError):
+  """
+  Raised by #HttpFile if a request fails, including connection errors and
+  timeouts.
+  """
+
+
+def is_url(path):
+  return re.match(r'^https?://', path or '') is not None
+
+
+class HttpFile(object):
+  """
+  A read-only, seekable file-like object for the resource at #url that
+  reads with HTTP Range requests. Small reads (eg. file system metadata)
+  go through a cache of #block_size blocks, larger reads are requested
+  as they are. #read_range() can be called from multiple threads.
+
+  If no #session is specified, every thread uses its own
+  `requests.Session`. #timeout is the `(connect, read)` timeout of every
+  request in seconds. #bytes_fetched and #requests count the transferred
+  data.
+  """
+
+  def __init__(self, url, session=None, block_size=64*1024, cache_blocks=256,
+      timeout=(10, 60)):
+    self.url = url
+    self.timeout = timeout
+    self.block_size = block_size
+    self.cache_blocks = cache_blocks
+    self.pos = 0
+    self.bytes_fetched = 0
+    self.requests = 0
+    self._session = session
+    self._local = threading.local()
+    self._lock = threading.Lock()
+    self._blocks = collections.OrderedDict()
+    self.size = self._get_size()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *args):
+    self.close()
+
+  def close(self):
+    self._blocks.clear()
+
+  @property
+  def session(self):
+    if self._session is not None:
+      return self._session
+    if not hasattr(self._local, 'session'):
+      import requests
+      self._local.session = requests.Session()
+    return self._local.session
+
+  def _get(self, headers, stream=False):
+    import requests
+    try:
+      return self.session.get(self.url, headers=headers, stream=stream, timeout=self.timeout)
+    except requests.RequestException as exc:
+      raise HttpError('{}: {}'.format(self.url, exc))
+
+  def _get_size(self):
+    response = self._get({'Range': 'bytes=0-0'}, stream=True)
+    try:
+      if response.status_code != 206:
+        raise HttpError('{}: HTTP {}, the server must support Range requests'.format(
+          self.url, response.status_code))
+      match = re.match(r'^bytes\s+\d+-\d+/(\d+)$', response.headers.get('Content-Range', ''))
+      if not match:
+        raise HttpError('{}: missing Content-Range'.format(self.url))
+      return int(match.group(1))
+    finally:
+      response.close()
+
+  def read_range(self, offset, size):
+    """
+    Reads #size bytes at #offset with a single Range request.
+    """
+
+    size = max(0, min(size, self.size - offset))
+    if size == 0:
+      return b''
+    headers = {'Range': 'bytes={}-{}'.format(offset, offset + size - 1)}
+    response = self._get(headers)
+    if response.status_code != 206:
+      raise HttpError('{}: HTTP {} for range {}'.format(self.url, response.status_code,
+        headers['Range']))
+    data = response.content
+    if len(data) != size:
+      raise HttpError('{}: expected {} bytes, got {}'.format(self.url, size, len(data)))
+    with self._lock:
+      self.bytes_fetched += size
+      self.requests += 1
+    return data
+
+  def read_ranges(self, ranges, jobs=4):
+    """
+    Reads the `(offset, size)` #ranges with #jobs parallel requests.
+    Returns a list of the data in the same order.
+    """
+
+    with ThreadPoolExecutor(jobs) as executor:
+      return list(executor.map(lambda r: self.read_range(*r), ranges))
+
+  def _read_block(self, index):
+    with self._lock:
+      data = self._blocks.get(index)
+      if data is not None:
+        self._blocks.move_to_end(index)
+        return data
+    data = self.read_range(index * self.block_size, self.block_size)
+    with self._lock:
+      self._blocks[index] = data
+      while len(self._blocks) > self.cache_blocks:
+        self._blocks.popitem(last=False)
+    return data
+
+  def read_at(self, offset, size):
+    """
+    Reads #size bytes at #offset, using the block cache for small reads.
+    """
+
+    size = max(0, min(size, self.size - offset))
+    if size > self.block_size * 4:
+      return self.read_range(offset, size)
+    result = []
+    end = offset + size
+    while offset < end:
+      index, start = divmod(offset, self.block_size)
+      data = self._read_block(index)[start:start + end - offset]
+      if not data:
+        break
+      result.append(data)
+      offset += len(data)
+    return b''.join(result)
+
+  def read(self, size=-1):
+    if size < 0:
+      size = self.size - self.pos
+    data = self.read_at(self.pos, size)
+    self.pos += len(data)
+    return data
+
+  def seek(self, offset, whence=0):
+    if whence == os.SEEK_CUR:
+      offset += self.pos
+    elif whence == os.SEEK_END:
+      offset += self.size
+    self.pos = max(0, offset)
+    return self.pos
+
+  def tell(self):
+    return self.pos
@@ -18,16 +18,132 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 # THE SOFTWARE.
 
+import errno
+import fnmatch
 import glob
+import hashlib
+import json
 import os
 import re
-import pipes
 import shutil
-import subprocess
-import sys
+import socket
+import struct
 import tempfile
+import time
+import xml.etree.ElementTree as ET
 
+import payload from './payload'
+import pbzx from './pbzx'
+import registry from './registry'
 import system from './system'
+import {BytesDecompressed, EventBus, FilesExtracted} from './events'
+import {HttpError, HttpFile, is_url} from './httpio'
+import {FileLock, LockTimeout, describe_holder, lock_path} from './lock'
+import {HfsVolume} from './hfsplus'
+import {UdifImage} from './udif'
+import {XarArchive, XarError} from './xar'
+
+
+#: The tmpfs that is used for scratch directories if the data fits. It
+#: only exists on Linux.
+SHM_DIR = '/dev/shm'
+
+#: The name of the scratch directory next to the installation directory.
+SCRATCH_NAME = '.osxt-scratch'
+
+
+def _available_memory():
+    # SC_AVPHYS_PAGES is Linux-only, like SHM_DIR.
+    try:
+        return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+    except (AttributeError, ValueError, OSError):
+        return None
+
+
+def _writable_dir(path):
+    return os.path.isdir(path) and os.access(path, os.W_OK | os.X_OK)
+
+
+def scratch_dir(size=None, dest=None, scratch=None, reserve=64*1024*1024):
+    '''
+    Returns the directory in which a :class:`TempDir` for *size* bytes of
+    data should be created:
+
+    1. ``/dev/shm``, if *size* is known and fits into its free space and
+       into half of the free memory. This is only possible on Linux,
+       macOS has neither the tmpfs nor the free memory probe.
+    2. The *scratch* directory, which defaults to the ``OSXT_SCRATCH``
+       environment variable.
+    3. The ``.osxt-scratch`` directory next to *dest*, on the file system
+       that needs room for the installation anyway (the default temporary
+       directory is often small). The directory is removed again when the
+       last :class:`TempDir` in it is removed.
+    4. The default temporary directory.
+    '''
+
+    if size is not None and _writable_dir(SHM_DIR):
+        memory = _available_memory()
+        free = shutil.disk_usage(SHM_DIR).free
+        if memory is not None and size + reserve <= min(free, memory // 2):
+            return SHM_DIR
+
+    scratch = scratch or os.environ.get('OSXT_SCRATCH')
+    if scratch:
+        if not os.path.isdir(scratch):
+            os.makedirs(scratch)
+        return scratch
+
+    if dest:
+        parent = _find_existing(os.path.dirname(os.path.abspath(dest)))
+        path = os.path.join(parent, SCRATCH_NAME)
+        if _writable_dir(path):
+            return path
+        if _writable_dir(parent):
+            try:
+                os.mkdir(path)
+                return path
+            except OSError as exc:
+                # Created by another process in the meantime.
+                if exc.errno == errno.EEXIST:
+                    return path
+
+    return tempfile.gettempdir()
+
+
+def _host_id():
+    return hashlib.sha1(socket.gethostname().encode('utf8')).hexdigest()[:8]
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as exc:
+        return exc.errno == errno.EPERM
+    return True
+
+
+def sweep_scratch(directory):
+    '''
+    Removes the directories of :class:`TempDir` objects in *directory*
+    that were left behind by processes on this host that no longer run,
+    eg. because they were killed. Returns the removed paths.
+    '''
+
+    removed = []
+    host = _host_id()
+    try:
+        names = os.listdir(directory)
+    except OSError:
+        return removed
+    for name in names:
+        match = re.match(r'^osxt-(\d+)-([0-9a-f]{8})-', name)
+        if not match or match.group(2) != host or _pid_alive(int(match.group(1))):
+            continue
+        path = os.path.join(directory, name)
+        if os.path.isdir(path) and not os.path.islink(path):
+            shutil.rmtree(path, ignore_errors=True)
+            removed.append(path)
+    return removed
 
 
 class TempDir(object):
@@ -38,23 +154,55 @@ class TempDir(object):
 
     Alternatively, the folder will be deleted when the TempDir
     object is garbage collected.
+
+    The directory is created in *dir*, which defaults to the result of
+    :func:`scratch_dir`. Its name contains the process ID, so that the
+    directories of crashed processes are removed by :func:`sweep_scratch`
+    the next time a TempDir is created in the same place (or anywhere,
+    for ``/dev/shm``).
     '''
 
-    def __init__(self, delete=True):
+    def __init__(self, delete=True, dir=None):
         super(TempDir, self).__init__()
         self.delete = delete
+        self.dir = dir
+        self.folder = None
 
     def __del__(self):
         self.__exit__(None, None, None)
 
     def __enter__(self):
-        self.folder = tempfile.mkdtemp()
+        parent = self.dir or scratch_dir()
+        sweep_scratch(parent)
+        if parent != SHM_DIR:
+            # Leftovers in memory are the most expensive ones.
+            sweep_scratch(SHM_DIR)
+        prefix = 'osxt-{}-{}-'.format(os.getpid(), _host_id())
+        while True:
+            try:
+                self.folder = tempfile.mkdtemp(prefix=prefix, dir=parent)
+                break
+            except OSError as exc:
+                # The last TempDir in the scratch directory may have just
+                # removed it, see __exit__().
+                if exc.errno != errno.ENOENT or os.path.basename(parent) != SCRATCH_NAME:
+                    raise
+                try:
+                    os.mkdir(parent)
+                except OSError:
+                    pass
         return self.folder
 
     def __exit__(self, *args):
         if self.folder and os.path.isdir(self.folder):
             if self.delete:
                 shutil.rmtree(self.folder)
+                parent = os.path.dirname(self.folder)
+                if os.path.basename(parent) == SCRATCH_NAME:
+                    try:
+                        os.rmdir(parent)
+                    except OSError:
+                        pass  # Not empty, still in use by another TempDir.
             self.folder = None
 
 
@@ -62,24 +210,42 @@ class MountFile(object):
     '''
     This context-manager is a utility for mounting Disk Image Files
     using the ``hdiutil`` system command.
+
+    If *private* is True, the image is attached at a new temporary mount
+    point instead of under ``/Volumes``, and detached again on exit.
+    Every MountFile then has its own attachment, so that it is not
+    unmounted by another thread or process that mounted the same file.
     '''
 
     expr = re.compile('\s+(/Volumes/.*)$', re.M | re.I)
 
-    def __init__(self, filename, args=None):
+    def __init__(self, filename, args=None, verbose=None, private=False):
         super(MountFile, self).__init__()
         self.filename = filename
         self.volume = None
         self.args = [] if args is None else args
+        self.verbose = verbose
+        self.private = private
+        self.mountpoint = None
 
     def __enter__(self):
         # Run the hdiutil command to mount the file and determine
         # the Volume at which it was mounted.
+        args = list(self.args)
+        if self.private:
+            self.mountpoint = tempfile.mkdtemp(prefix='osxt-mount-')
+            args = ['-nobrowse', '-mountpoint', self.mountpoint] + args
         try:
-            output = system.getoutput('hdiutil', 'mount', self.filename, *self.args)
+            output = system.getoutput('hdiutil', 'mount', self.filename,
+                *args, verbose=self.verbose)
         except system.ExitError:
+            self._remove_mountpoint()
             raise RuntimeError("could not found '%s'" % self.filename)
 
+        if self.private:
+            self.volume = self.mountpoint
+            return self.volume
+
         # Find the name of the volume in the output.
         volume = self.expr.search(output)
         if not volume:
@@ -90,19 +256,62 @@ class MountFile(object):
         return self.volume
 
     def __exit__(self, *args):
-        # Unmount the volume if it was mounted before.
+        # Unmount the volume if it was mounted before. A private
+        # attachment is detached, so that the device does not linger.
         if self.volume:
+            command = 'detach' if self.private else 'unmount'
             try:
-                output = system.getoutput('hdiutil', 'unmount', self.volume)
+                output = system.getoutput('hdiutil', command, self.volume,
+                    verbose=self.verbose)
             except system.ExitError:
                 print("WARNING: Could not unmount '%s' for '%s'"
                     % (self.volume, self.filename))
+            self.volume = None
+        self._remove_mountpoint()
+
+    def _remove_mountpoint(self):
+        # rmdir() fails on a directory that is still mounted, nothing
+        # on the volume can be removed by accident.
+        if self.mountpoint:
+            try:
+                os.rmdir(self.mountpoint)
+            except OSError:
+                pass
+            self.mountpoint = None
+
+
+class RemoteImage(object):
+    '''
+    This context-manager opens the HFS+ volume of the Disk Image File at
+    *url* without downloading it. The UDIF block table is read with HTTP
+    Range requests, and only the compressed blocks that back the files
+    that are actually read are fetched, with *jobs* parallel requests.
+    Entering the context returns the :class:`hfsplus.HfsVolume`.
+    '''
+
+    def __init__(self, url, session=None, jobs=4):
+        super(RemoteImage, self).__init__()
+        self.url = url
+        self.session = session
+        self.jobs = jobs
+        self.http = None
+
+    def __enter__(self):
+        self.http = HttpFile(self.url, self.session)
+        image = UdifImage(self.http)
+        partition = image.find_partition('Apple_HFS')
+        return HfsVolume(image.open(partition, self.jobs))
+
+    def __exit__(self, *args):
+        if self.http:
+            self.http.close()
+            self.http = None
 
 
 class MultiContext(object):
     '''
     This context manager allows you to enter new context managers
-    which will all exit when this one exits.
+    which will all exit when this one exits, in reverse order.
     '''
 
     def __init__(self):
@@ -119,7 +328,7 @@ class MultiContext(object):
 
     def __exit__(self, *args):
         try:
-            for child in self.children:
+            for child in reversed(self.children):
                 child.__exit__(*args)
         finally:
             del self.children
@@ -140,8 +349,8 @@ def dir_has_contents(directory):
 def select_file(files, key=lambda x: x):
     '''
     Lets the user select a file from a list of filenames. Returns
-    the selected file. If the user stops the selection, exits
-    the program with the info that the user stopped it.
+    the selected file. If the user stops the selection, an
+    :class:`InstallError` is raised.
     '''
 
     for i, filename in enumerate(files):
@@ -150,7 +359,7 @@ def select_file(files, key=lambda x: x):
     while True:
         string = input('> ').strip()
         if not string:
-            exit('user stop')
+            raise InstallError('user stop')
 
         try:
             selection = int(string)
@@ -165,39 +374,283 @@ def select_file(files, key=lambda x: x):
     return files[selection]
 
 
-def detect_packages(directory):
+def detect_packages(directory, include=None, exclude=None):
     '''
-    Finds the paths to the CLTools and Mac OSX SDK packages from
-    a directory, or asks the user if they could not be detected.
-    Exits if the user exits or if he had no choices.
+    Finds the ``*.pkg`` files in *directory* and returns a list of
+    :class:`PackageInfo` objects for the packages that pass the
+    *include* and *exclude* filters (see :func:`filter_packages`).
     '''
 
-    def find_in_files(files, regex):
-        for filename in files:
-            if re.match(regex, os.path.basename(filename), re.I):
-                return filename
-        return None
+    packages = []
+    for filename in sorted(glob.glob(os.path.join(directory, '*.pkg'))):
+        packages.append(read_package_info(filename))
+    return filter_packages(packages, include, exclude)
 
-    # Find all *.pkg files, and from this list, match the
-    # required files using regular expressions.
-    return glob.glob(os.path.join(directory, '*.pkg'))
 
+class PackageInfo(object):
+    '''
+    Describes a package that can be installed with :func:`install_pkg`.
+    The information is read from the XAR table of contents, the
+    ``PackageInfo`` file and the headers of the ``Payload`` without
+    unpacking the package.
+
+    .. attribute:: filename
+
+        The path to the ``*.pkg`` file or directory.
+
+    .. attribute:: member
+
+        If the package is contained in a product archive, this is the
+        name of the package directory in the archive at *filename*.
+
+    .. attribute:: identifier
+
+        The package identifier, eg. ``com.apple.pkg.CLTools_Executables``.
 
-def unpack_pkg(pkg_filename, dest):
+    .. attribute:: num_files
+
+        The number of files in the payload, or None if unknown.
+
+    .. attribute:: payload_size
+
+        The size of the compressed payload in bytes.
+
+    .. attribute:: expanded_size
+
+        The size of the payload contents in bytes. This is derived from
+        the payload headers if possible, otherwise from the
+        ``installKBytes`` in the ``PackageInfo``. None if unknown.
+    '''
+
+    def __init__(self, filename, member=None):
+        super(PackageInfo, self).__init__()
+        self.filename = filename
+        self.member = member
+        self.identifier = None
+        self.num_files = None
+        self.payload_size = 0
+        self.expanded_size = None
+
+    def __repr__(self):
+        return '<PackageInfo {!r}>'.format(self.name)
+
+    @property
+    def name(self):
+        return os.path.basename(self.member or self.filename)
+
+    def matches(self, pattern):
+        '''
+        Returns True if the glob *pattern* matches the package name (with
+        or without the ``.pkg`` suffix) or identifier, ignoring case.
+        '''
+
+        pattern = pattern.lower()
+        names = [self.name, os.path.splitext(self.name)[0], self.identifier or '']
+        return any(fnmatch.fnmatch(x.lower(), pattern) for x in names)
+
+
+def _parse_package_info_xml(info, data):
+    root = ET.fromstring(data)
+    info.identifier = root.get('identifier')
+    payload = root.find('payload')
+    if payload is not None:
+        if payload.get('numberOfFiles'):
+            info.num_files = int(payload.get('numberOfFiles'))
+        if payload.get('installKBytes'):
+            info.expanded_size = int(payload.get('installKBytes')) * 1024
+
+
+def _read_payload_size(info, fp, length):
+    '''
+    Reads the expanded size of a payload from its headers. For pbzx
+    payloads, this is the sum of the chunk sizes, for gzip payloads the
+    size stored in the gzip trailer (which is only exact below 4 GiB).
+    '''
+
+    info.payload_size = length
+    if pbzx.is_pbzx(fp):
+        info.expanded_size = pbzx.expanded_size(fp)
+    elif fp.read(2) == b'\x1f\x8b' and length >= 4:
+        fp.seek(length - 4)
+        isize = struct.unpack('<I', fp.read(4))[0]
+        if info.expanded_size is None or isize > info.expanded_size:
+            info.expanded_size = isize
+
+
+def _read_archived_package(info, archive, prefix):
+    info_entry = archive.entries.get(prefix + 'PackageInfo')
+    if info_entry is not None:
+        _parse_package_info_xml(info, archive.read(info_entry))
+    payload = archive.entries.get(prefix + 'Payload')
+    if payload is not None and payload.offset is not None:
+        with archive.open(payload) as fp:
+            if payload.encoding in (None, 'application/octet-stream'):
+                _read_payload_size(info, fp, payload.length)
+            else:
+                info.payload_size = payload.length
+
+
+def read_package_info(filename, fp=None):
+    '''
+    Reads the :class:`PackageInfo` for a flat ``*.pkg`` file or a package
+    directory that contains a ``Payload`` file. If *fp* is specified, the
+    flat package is read from this file object instead.
+    '''
+
+    info = PackageInfo(filename)
+    if fp is None and os.path.isdir(filename):
+        info_file = os.path.join(filename, 'PackageInfo')
+        if os.path.isfile(info_file):
+            with open(info_file, 'rb') as fp:
+                _parse_package_info_xml(info, fp.read())
+        payload = os.path.join(filename, 'Payload')
+        if os.path.isfile(payload):
+            with open(payload, 'rb') as fp:
+                _read_payload_size(info, fp, os.path.getsize(payload))
+        return info
+
+    with XarArchive(filename if fp is None else fp) as archive:
+        _read_archived_package(info, archive, '')
+    return info
+
+
+def read_product_packages(filename, fp=None):
+    '''
+    Reads the :class:`PackageInfo` of all packages contained in the product
+    archive *filename* (a ``*.pkg`` file that contains other packages)
+    without unpacking it. If *fp* is specified, the archive is read from
+    this file object instead.
+    '''
+
+    packages = []
+    with XarArchive(filename if fp is None else fp) as archive:
+        for name in archive.names():
+            entry = archive.entries[name]
+            if '/' in name or entry.type != 'directory' or not name.endswith('.pkg'):
+                continue
+            info = PackageInfo(filename, member=name)
+            _read_archived_package(info, archive, name + '/')
+            packages.append(info)
+    return packages
+
+
+def filter_packages(packages, include=None, exclude=None):
+    '''
+    Filters a list of :class:`PackageInfo` objects. If *include* is not
+    empty, only packages that match at least one of its glob patterns are
+    kept. Packages that match any of the *exclude* patterns are removed.
+    '''
+
+    result = []
+    for info in packages:
+        if include and not any(info.matches(x) for x in include):
+            continue
+        if exclude and any(info.matches(x) for x in exclude):
+            continue
+        result.append(info)
+    return result
+
+
+def format_size(size):
+    '''
+    Formats a size in bytes for humans.
+    '''
+
+    if size is None:
+        return '?'
+    for unit in ('B', 'KiB', 'MiB', 'GiB'):
+        if size < 1024 or unit == 'GiB':
+            break
+        size /= 1024.0
+    return '{:.1f} {}'.format(size, unit) if unit != 'B' else '{} B'.format(size)
+
+
+def format_report(packages):
+    '''
+    Returns a list of lines that describe the file count and expanded
+    size of the *packages* (a list of :class:`PackageInfo` objects).
+    '''
+
+    lines = []
+    total = 0
+    for info in packages:
+        files = '?' if info.num_files is None else info.num_files
+        lines.append('  {:<48} {:>8} files {:>12}'.format(info.name, files,
+            format_size(info.expanded_size)))
+        total += info.expanded_size or 0
+    lines.append('  {:<48} {:>8}       {:>12}'.format('total', '', format_size(total)))
+    return lines
+
+
+def preflight(packages, dest, scratch=None, reserve=64*1024*1024):
+    '''
+    Checks that there is enough free disk space in *dest* to install the
+    *packages* (a list of :class:`PackageInfo` objects), and in the
+    *scratch* directory to unpack their payloads. Returns the total
+    expanded size.
+
+    :raise RuntimeError: if there is not enough free disk space.
+    '''
+
+    total = 0
+    scratch_total = 0
+    for info in packages:
+        total += info.expanded_size or 0
+        # Packages from a product archive are unpacked all at once,
+        # others one after another.
+        if info.member:
+            scratch_total += info.payload_size
+        else:
+            scratch_total = max(scratch_total, info.payload_size)
+
+    required = {}
+    dest_dev = _find_existing(dest)
+    required[dest_dev] = total + reserve
+    if scratch:
+        scratch_dev = _find_existing(scratch)
+        if os.stat(scratch_dev).st_dev == os.stat(dest_dev).st_dev:
+            required[dest_dev] += scratch_total
+        else:
+            required[scratch_dev] = scratch_total + reserve
+
+    for path, size in required.items():
+        free = shutil.disk_usage(path).free
+        if free < size:
+            raise RuntimeError('not enough free disk space in {!r}: {} required, '
+                '{} available'.format(path, format_size(size), format_size(free)))
+    return total
+
+
+def _find_existing(path):
+    path = os.path.abspath(path)
+    while not os.path.exists(path):
+        path = os.path.dirname(path)
+    return path
+
+
+def unpack_pkg(pkg_filename, dest, members=None, verbose=None):
     '''
     Unpacks the contents of a ``*.pkg`` file to the specified
-    directory *dest*.
+    directory *dest*. If *members* is specified, only the packages
+    with these names are extracted from the archive.
     '''
 
-    system.call('xar', '-C', dest, '-xf', pkg_filename)
+    files = []
+    if members:
+        with XarArchive(pkg_filename) as archive:
+            for member in members:
+                files.append(member)
+                files += archive.names(member + '/')
+    system.call('xar', '-C', dest, '-xf', pkg_filename, *files, verbose=verbose)
 
 
-def install_pkg(pkg_filename, dest):
+def install_pkg(pkg_filename, dest, verbose=None, pbzx_program='pbzx', scratch=None):
     '''
     Installs the contents of a ``*.pkg`` file to the specified folder.
     More specifically, the ``Payload`` file in the package will be
     unzipped into the folder *dest*. A temporary folder needs to be
-    created to unpack the *pkg_filename* first.
+    created to unpack the *pkg_filename* first, its location is chosen
+    by :func:`scratch_dir` with the *scratch* directory.
 
     .. note:: Sometimes, *pkg_filename* is a directory instead. If that
         is the case, the directory will not be copied into a temporary
@@ -209,8 +662,9 @@ def install_pkg(pkg_filename, dest):
 
     with MultiContext() as context:
         if os.path.isfile(pkg_filename):
-            source_dir = context.enter(TempDir())
-            unpack_pkg(pkg_filename, source_dir)
+            parent = scratch_dir(os.path.getsize(pkg_filename), dest, scratch)
+            source_dir = context.enter(TempDir(dir=parent))
+            unpack_pkg(pkg_filename, source_dir, verbose=verbose)
         else:
             source_dir = pkg_filename
 
@@ -226,7 +680,7 @@ def install_pkg(pkg_filename, dest):
 
         commands = []
         if magic == b'pbzx':
-            commands.append(['pbzx', '-n', payload_filename])
+            commands.append([pbzx_program, '-n', payload_filename])
         else:
             commands.append(['cat', payload_filename])
             commands.append(['gunzip', '-dc'])
@@ -234,4 +688,604 @@ def install_pkg(pkg_filename, dest):
 
         # Unpack the contents of the Payload file to the
         # destination directory.
-        system.multicall(*commands, cwd=dest)
+        system.multicall(*commands, cwd=dest, verbose=verbose)
+
+
+def stream_pkg(fp, dest, member=None, journal=None, progress=None):
+    '''
+    Extracts the ``Payload`` of the flat package in the file object *fp*
+    (or of the package *member* of a product archive) to *dest*. The
+    payload is decompressed and unpacked as a stream, nothing is written
+    to a temporary directory.
+
+    If an :class:`InstallJournal` is specified, the progress is recorded
+    in it and extraction continues where the journal says it stopped.
+    *progress* is called with the number of bytes decompressed and the
+    number of files extracted after every file.
+    '''
+
+    name = (member + '/' if member else '') + 'Payload'
+    with XarArchive(fp) as archive:
+        entry = archive.entries.get(name)
+        if entry is None or entry.offset is None:
+            raise RuntimeError("'%s' contains no Payload" % (member or 'package'))
+        if hasattr(fp, 'hint'):
+            fp.hint(archive.heap_offset + entry.offset, entry.length)
+        _extract_payload(payload.open_payload(archive.open(entry)), dest,
+                         journal, progress)
+
+
+def stream_pkg_dir(directory, dest, journal=None, progress=None):
+    '''
+    Like :func:`stream_pkg`, but for a package *directory* that contains
+    a ``Payload`` file instead of a flat package.
+    '''
+
+    with open(os.path.join(directory, 'Payload'), 'rb') as fp:
+        _extract_payload(payload.open_payload(fp), dest, journal, progress)
+
+
+def _extract_payload(stream, dest, journal, progress):
+    if journal is None and progress is None:
+        payload.extract(stream, dest)
+        return
+    offset, links = journal.resume_point() if journal else (0, None)
+    files = [0]
+
+    def checkpoint(offset, entry, filename):
+        if journal:
+            journal.record(offset, entry, filename)
+        if progress:
+            files[0] += 1
+            progress(offset, files[0])
+
+    payload.extract(stream, dest, offset=offset, links=links,
+                    checkpoint=checkpoint)
+
+
+class InstallJournal(object):
+    '''
+    Records the progress of an installation in a file in the destination
+    directory, so that an interrupted installation can be resumed instead
+    of starting over. The journal contains the names of the packages that
+    are completely installed and, for the package that is being installed,
+    the offset of the next entry in its uncompressed payload.
+
+    The journal is replaced atomically, at most every *interval* seconds
+    while a package is extracted and whenever a package is complete.
+    Entries that were extracted after the last write are extracted again
+    when the installation is resumed.
+
+    When the installation is complete, the journal is replaced by the
+    marker file :attr:`marker`, which identifies the installed packages.
+    '''
+
+    filename = '.osxt-install.json'
+    marker = '.osxt-installed.json'
+
+    def __init__(self, dest, source, packages, interval=1.0):
+        super(InstallJournal, self).__init__()
+        self.dest = dest
+        self.path = os.path.join(dest, self.filename)
+        self.marker_path = os.path.join(dest, self.marker)
+        self.source = source
+        self.packages = list(packages)
+        self.interval = interval
+        self.completed = []
+        self.current = None
+        self.links = {}
+        self._written = 0
+
+    def load(self):
+        '''
+        Loads the journal of a previous installation of the same packages
+        from the same source. Returns True if it can be resumed.
+        '''
+
+        try:
+            with open(self.path) as fp:
+                data = json.load(fp)
+        except (IOError, OSError, ValueError):
+            return False
+        if data.get('source') != self.source or data.get('packages') != self.packages:
+            return False
+        self.completed = [x for x in data.get('completed', ()) if x in self.packages]
+        self.current = data.get('current')
+        return True
+
+    def is_complete(self, package):
+        return package in self.completed
+
+    def begin(self, package):
+        '''
+        Starts or continues the installation of *package*.
+        '''
+
+        if not self.current or self.current.get('package') != package:
+            self.current = {'package': package, 'offset': 0, 'links': {}, 'last': None}
+        self.links = {}
+        for ino, path in self.current['links'].items():
+            self.links[int(ino)] = os.path.join(self.dest, path)
+
+    def resume_point(self):
+        '''
+        Returns the offset in the uncompressed payload of the current
+        package where extraction continues, and the hard links extracted
+        before it. The last file recorded in the journal is checked, if
+        it does not have the recorded size (eg. because the system went
+        down before it was written to disk), it is extracted again.
+        '''
+
+        last = self.current['last']
+        if last:
+            filename = os.path.join(self.dest, last['path'])
+            if not os.path.isfile(filename) or os.path.getsize(filename) != last['size']:
+                return last['offset'], self.links
+        return self.current['offset'], self.links
+
+    def record(self, offset, entry, filename):
+        '''
+        Called by :func:`payload.extract` after every entry.
+        '''
+
+        self.current['offset'] = offset
+        if filename and entry.isreg() and entry.size:
+            self.current['last'] = {
+                'path': os.path.relpath(filename, self.dest),
+                'size': entry.size,
+                'offset': entry.offset,
+            }
+        if time.time() - self._written >= self.interval:
+            self.write()
+
+    def complete(self, package):
+        self.completed.append(package)
+        self.current = None
+        self.links = {}
+        self.write()
+
+    def write(self):
+        if self.current is not None:
+            self.current['links'] = dict((str(ino), os.path.relpath(path, self.dest))
+                                         for ino, path in self.links.items())
+        data = {
+            'source': self.source,
+            'packages': self.packages,
+            'completed': self.completed,
+            'current': self.current,
+        }
+        tmp = '{}.tmp-{}'.format(self.path, os.getpid())
+        with open(tmp, 'w') as fp:
+            json.dump(data, fp, indent=2, sort_keys=True)
+        os.rename(tmp, self.path)
+        self._written = time.time()
+
+    def is_installed(self):
+        '''
+        Returns True if the marker file says that the same packages from
+        the same source are completely installed.
+        '''
+
+        try:
+            with open(self.marker_path) as fp:
+                data = json.load(fp)
+        except (IOError, OSError, ValueError):
+            return False
+        return data.get('source') == self.source and data.get('packages') == self.packages
+
+    def mark_installed(self):
+        '''
+        Replaces the journal with the marker file.
+        '''
+
+        data = {'source': self.source, 'packages': self.packages, 'time': time.time()}
+        tmp = '{}.tmp-{}'.format(self.marker_path, os.getpid())
+        with open(tmp, 'w') as fp:
+            json.dump(data, fp, indent=2, sort_keys=True)
+        os.rename(tmp, self.marker_path)
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+class InstallError(Exception):
+    '''
+    Raised by :class:`Installer` if an installation can not be performed.
+    '''
+
+
+class InstallResult(object):
+    '''
+    The result of :meth:`Installer.install`.
+
+    .. attribute:: dest
+
+        The absolute path of the installation directory.
+
+    .. attribute:: packages
+
+        A list of :class:`PackageInfo` objects for the selected packages.
+
+    .. attribute:: expanded_size
+
+        The total expanded size of the selected packages in bytes.
+
+    .. attribute:: installed
+
+        False if this was a dry run, True otherwise.
+
+    .. attribute:: reused
+
+        True if the packages were already installed in the destination,
+        eg. by another process that held the lock for it.
+
+    .. attribute:: toolchain
+
+        The name under which the toolchain was registered, or None.
+
+    .. attribute:: duration
+
+        The time the installation took in seconds.
+    '''
+
+    def __init__(self, dest, packages, expanded_size):
+        super(InstallResult, self).__init__()
+        self.dest = dest
+        self.packages = packages
+        self.expanded_size = expanded_size
+        self.installed = False
+        self.reused = False
+        self.toolchain = None
+        self.duration = None
+
+
+class Installer(object):
+    '''
+    Installs XCode command-line tools from Disk Image Files. The keyword
+    arguments passed to the constructor are the defaults for the options
+    of :meth:`install`. An Installer does not keep any state between
+    calls and it does not change the process environment or working
+    directory, thus one instance can run multiple installations into
+    different directories from multiple threads at the same time.
+
+    Options:
+
+    * *include*, *exclude*: Lists of glob patterns to select packages,
+      see :func:`filter_packages`.
+    * *user*: The name of the user that should own the installed files.
+    * *overwrite*: What to do if the destination is not empty. False
+      raises an :class:`InstallError`, True erases the destination. A
+      callable is called with the destination and must return a bool.
+    * *dry_run*: Only select the packages and run the preflight check.
+    * *name*: Register the toolchain under this name, see the
+      ``registry`` module. Nothing is registered if it is None.
+    * *use*: Make the registered toolchain the active one.
+    * *select*: A callable that selects one of multiple product archives
+      found in a Disk Image File. Without it, an :class:`InstallError` is
+      raised in that case.
+    * *debug_hook*: A callable that is called with the directory of the
+      unpacked packages before they are installed. The packages are then
+      installed with the ``pbzx`` and ``cpio`` programs and the
+      installation can not be resumed. It is not called when installing
+      from a URL.
+    * *scratch*: The directory in which packages are unpacked for the
+      *debug_hook* if they do not fit into ``/dev/shm``, see
+      :func:`scratch_dir`.
+    * *session*: The ``requests.Session`` used when installing from a
+      URL, eg. one that is logged in to the Apple Developer Portal.
+    * *resume*: Continue an interrupted installation into the same
+      destination from its :class:`InstallJournal`, or do nothing if the
+      same packages are already installed there. If False, the
+      destination is treated like any other non-empty directory.
+    * *lock_timeout*: The number of seconds to wait for another process
+      that installs into the same destination. None waits forever.
+    * *events*: An :class:`events.EventBus` on which the stages of the
+      installation and the progress of every package are emitted.
+    * *verbose*: Print the commands that are run and a package report.
+    '''
+
+    defaults = {
+        'include': (),
+        'exclude': (),
+        'user': None,
+        'overwrite': False,
+        'dry_run': False,
+        'name': None,
+        'use': False,
+        'select': None,
+        'debug_hook': None,
+        'scratch': None,
+        'session': None,
+        'resume': True,
+        'lock_timeout': None,
+        'events': None,
+        'verbose': False,
+    }
+
+    def __init__(self, **options):
+        super(Installer, self).__init__()
+        self.options = self._merge(self.defaults, options)
+
+    @staticmethod
+    def _merge(base, options):
+        for key in options:
+            if key not in base:
+                raise TypeError("unexpected keyword argument '%s'" % key)
+        result = dict(base)
+        result.update(options)
+        return result
+
+    def inspect(self, volume, **options):
+        '''
+        Returns the :class:`PackageInfo` objects of the packages selected
+        by the *include* and *exclude* options in the mounted Disk Image
+        File at *volume*, and the path of the product archive that contains
+        them (or None). *volume* can also be a :class:`hfsplus.HfsVolume`,
+        then the paths are relative to the volume.
+        '''
+
+        opts = self._merge(self.options, options)
+        if isinstance(volume, HfsVolume):
+            return self._inspect_volume(volume, opts)
+
+        # Two choices: Either, the CLTools and SDK packages are
+        # contained in a Packages/ subdirectory or in another
+        # Package archive.
+        packages_dir = os.path.join(volume, 'Packages')
+        if os.path.isdir(packages_dir):
+            packages = detect_packages(packages_dir, opts['include'], opts['exclude'])
+            return packages, None
+
+        # So, there must be a *.pkg file in this Disk Image File
+        # which in turn contains the CLTools and SDK packages.
+        pkgs = sorted(glob.glob(os.path.join(volume, '*.pkg')))
+        if not pkgs:
+            raise InstallError('no *.pkg found in Disk Image File')
+        elif len(pkgs) != 1:
+            if not opts['select']:
+                raise InstallError('multiple *.pkg found in Disk Image File')
+            product = opts['select'](pkgs)
+        else:
+            product = pkgs[0]
+        packages = read_product_packages(product)
+        return filter_packages(packages, opts['include'], opts['exclude']), product
+
+    def _inspect_volume(self, volume, opts):
+        if volume.isdir('Packages'):
+            packages = []
+            for name in volume.listdir('Packages'):
+                filename = 'Packages/' + name
+                if name.endswith('.pkg') and not volume.isdir(filename):
+                    packages.append(read_package_info(filename, volume.open(filename)))
+            return filter_packages(packages, opts['include'], opts['exclude']), None
+
+        pkgs = [x for x in volume.listdir() if x.endswith('.pkg')]
+        if not pkgs:
+            raise InstallError('no *.pkg found in Disk Image File')
+        elif len(pkgs) != 1:
+            if not opts['select']:
+                raise InstallError('multiple *.pkg found in Disk Image File')
+            product = opts['select'](pkgs)
+        else:
+            product = pkgs[0]
+        packages = read_product_packages(product, volume.open(product))
+        return filter_packages(packages, opts['include'], opts['exclude']), product
+
+    def install(self, dmg, dest, **options):
+        '''
+        Installs the XCode command-line tools from the Disk Image File
+        *dmg* into the directory *dest*. See the class documentation for
+        the available options.
+
+        If *dmg* is a HTTP(S) URL, the Disk Image File is not downloaded.
+        The packages are read from it with Range requests and their
+        payloads are unpacked while they are being transferred.
+
+        The progress is recorded in an :class:`InstallJournal` in *dest*.
+        If the installation is interrupted, running it again with the
+        same Disk Image File and packages continues where it stopped.
+
+        :raise InstallError: if the installation can not be performed,
+            eg. because reading from the URL fails.
+        :raise system.ExitError: if one of the system commands fails.
+        :return: an :class:`InstallResult`.
+        '''
+
+        try:
+            return self._install(dmg, dest, options)
+        except HttpError as exc:
+            raise InstallError(str(exc))
+
+    def _install(self, dmg, dest, options):
+        opts = self._merge(self.options, options)
+        verbose = opts['verbose']
+        events = opts['events'] or EventBus()
+        dest = os.path.abspath(dest)
+        start = time.time()
+
+        if opts['name']:
+            try:
+                registry.check_name(opts['name'])
+            except ValueError as exc:
+                raise InstallError(str(exc))
+
+        # If the Mac OS SDK should be installed, this should be run
+        # as superuser. Otherwise, some files might not be extracted
+        # properly from the archive.
+        if os.getuid() != 0 and verbose:
+            print('warning: not run as superuser, some files might not get extracted')
+
+        user = opts['user']
+        if user:
+            try:
+                int(system.getoutput('id', '-u', user, verbose=verbose))
+            except (ValueError, system.ExitError):
+                raise InstallError('could not determine uid for user {!r}'.format(user))
+
+        remote = is_url(dmg)
+        debug_hook = opts['debug_hook'] if not remote else None
+        with MultiContext() as context:
+            # Only one process installs into a directory at a time. Others
+            # wait, and have nothing left to do if they install the same
+            # packages. The lock is taken before the Disk Image File is
+            # mounted, so that waiting processes do not keep it mounted.
+            if not opts['dry_run']:
+                def on_wait(holder):
+                    if verbose:
+                        print('Waiting for the installation into', dest, 'by',
+                              describe_holder(holder), '...')
+                lock = FileLock(lock_path('install', dest), opts['lock_timeout'],
+                                'installation into ' + dest, on_wait)
+                try:
+                    context.enter(lock)
+                except LockTimeout as exc:
+                    raise InstallError(str(exc))
+
+            # Mount the Disk Image File (or open the remote one) and search
+            # for the CLTools and Mac OS SDK package files. Every installation
+            # uses its own mount point, so that installations from the same
+            # file do not unmount each other's volume.
+            if remote:
+                volume = context.enter(RemoteImage(dmg, opts['session']))
+            else:
+                if debug_hook:
+                    program = pbzx.find_or_install(verbose=verbose)
+                volume = context.enter(MountFile(dmg, verbose=verbose, private=True))
+            with events.stage(os.path.basename(dmg), 'inspect'):
+                packages, product = self.inspect(volume, **options)
+            if not packages:
+                raise InstallError('no packages selected for installation')
+
+            # Check the expanded sizes from the package headers against
+            # the available disk space before anything is unpacked.
+            if verbose:
+                print('Packages to install:')
+                for line in format_report(packages):
+                    print(line)
+            try:
+                # Payloads are unpacked as a stream, without scratch space,
+                # unless the packages are unpacked for the debug hook.
+                scratch = None
+                if debug_hook:
+                    scratch_size = sum(x.payload_size for x in packages)
+                    scratch = scratch_dir(scratch_size, dest, opts['scratch'])
+                size = preflight(packages, dest, scratch)
+            except RuntimeError as exc:
+                raise InstallError(str(exc))
+
+            result = InstallResult(dest, packages, size)
+            if opts['dry_run']:
+                result.duration = time.time() - start
+                return result
+
+            source = dmg if remote else os.path.abspath(dmg)
+            journal = InstallJournal(dest, source, [x.name for x in packages])
+            if opts['resume'] and journal.is_installed():
+                if verbose:
+                    print('The packages are already installed in', dest)
+                result.reused = True
+                return self._finish(result, dmg, dest, opts, start)
+            if opts['resume'] and os.path.isdir(dest) and journal.load():
+                if verbose:
+                    print('Resuming the installation in', dest, '...')
+            else:
+                self._prepare_dest(dest, opts)
+
+            if not debug_hook:
+                for info in packages:
+                    if journal.is_complete(info.name):
+                        continue
+                    if verbose:
+                        print('Installing', info.name, '...')
+                    journal.begin(info.name)
+
+                    def progress(size, files, info=info):
+                        events.emit(BytesDecompressed(info.name, size, info.expanded_size))
+                        events.emit(FilesExtracted(info.name, files, info.num_files))
+
+                    try:
+                        with events.stage(info.name, 'install'):
+                            if remote:
+                                with volume.open(product or info.filename) as fp:
+                                    stream_pkg(fp, dest, info.member, journal, progress)
+                            elif os.path.isdir(info.filename):
+                                # A package directory in Packages/.
+                                stream_pkg_dir(info.filename, dest, journal, progress)
+                            else:
+                                with open(product or info.filename, 'rb') as fp:
+                                    stream_pkg(fp, dest, info.member, journal, progress)
+                    except (IOError, OSError, payload.PayloadError, XarError) as exc:
+                        raise InstallError("could not install '{}': {}".format(info.name, exc))
+                    journal.complete(info.name)
+                journal.mark_installed()
+                return self._finish(result, dmg, dest, opts, start)
+
+            # We need to unpack the product PKG in order to access the
+            # contained packages, but only the selected ones.
+            tmpdir = os.path.join(volume, 'Packages')
+            if product:
+                tmpdir = context.enter(TempDir(dir=scratch))
+                with events.stage(os.path.basename(product), 'unpack'):
+                    unpack_pkg(product, tmpdir, [x.member for x in packages], verbose=verbose)
+
+            debug_hook(tmpdir)
+
+            for info in packages:
+                if info.member:
+                    filename = os.path.join(tmpdir, info.member)
+                else:
+                    filename = info.filename
+                with events.stage(info.name, 'install'):
+                    install_pkg(filename, dest, verbose=verbose, pbzx_program=program,
+                                scratch=opts['scratch'])
+            journal.mark_installed()
+            return self._finish(result, dmg, dest, opts, start)
+
+    def _finish(self, result, dmg, dest, opts, start):
+        '''
+        Copies the activate script, changes the owner of the installed
+        files and registers the toolchain.
+        '''
+
+        verbose = opts['verbose']
+        user = opts['user']
+
+        # Copy the activate script to the destination directory.
+        activate_script = str(module.directory.joinpath('../templates/activate'))
+        shutil.copy(activate_script, os.path.join(dest, 'activate'))
+
+        # Chown the complete destination directory.
+        if user:
+            system.call('chown', '-R', user, dest, verbose=verbose)
+
+        # Register the toolchain and generate its resolved activate script.
+        if opts['name']:
+            registry.register(opts['name'], dest, dmg)
+            if opts['use']:
+                registry.use(opts['name'])
+            result.toolchain = opts['name']
+
+        result.installed = True
+        result.duration = time.time() - start
+        return result
+
+    def _prepare_dest(self, dest, opts):
+        '''
+        Makes sure the output directory exists, and that it does not
+        already contain any important files.
+        '''
+
+        if not os.path.exists(dest):
+            os.makedirs(dest)
+            return
+        if not os.path.isdir(dest):
+            raise InstallError("'%s' is not a directory" % dest)
+        if not dir_has_contents(dest):
+            return
+
+        overwrite = opts['overwrite']
+        if callable(overwrite):
+            overwrite = overwrite(dest)
+        if not overwrite:
+            raise InstallError("'%s' is not empty" % dest)
+        shutil.rmtree(dest)
+        os.makedirs(dest)
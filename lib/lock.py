@@ -0,0 +1,180 @@
+# Copyright (c) 2017  Niklas Rosenstein
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+import errno
+import fcntl
+import hashlib
+import json
+import os
+import re
+import socket
+import time
+
+import {data_dir} from './paths'
+
+
+class LockTimeout(Exception):
+  """
+  Raised by #FileLock.acquire() if the lock could not be acquired in time.
+  #holder is the information written by the process that holds the lock
+  (a dictionary with `pid`, `host`, `since` and `what`) or #None.
+  """
+
+  def __init__(self, message, holder=None):
+    Exception.__init__(self, message)
+    self.holder = holder
+
+
+def locks_dir():
+  return data_dir('locks')
+
+
+def lock_path(kind, key, directory=None):
+  """
+  Returns the path of the lock file for the artifact #key (eg. the name
+  of a Disk Image File or an installation directory) of the given #kind.
+  """
+
+  slug = re.sub(r'[^A-Za-z0-9_.-]+', '_', os.path.basename(key.rstrip('/')))[:40]
+  digest = hashlib.sha1(key.encode('utf8')).hexdigest()[:12]
+  return os.path.join(directory or locks_dir(), '{}-{}-{}.lock'.format(kind, slug, digest))
+
+
+class FileLock(object):
+  """
+  An exclusive lock between processes, based on `flock()` on the file
+  #path. The lock is released by the kernel when the process that holds
+  it exits, so a crashed process never blocks others. The holder writes
+  its PID, host name and #what into the file, which is reported to
+  processes that wait for the lock.
+
+  #timeout is the number of seconds to wait for the lock (#None waits
+  forever, 0 does not wait). #on_wait is called once with the holder
+  information if the lock is not immediately available.
+
+  The lock file is removed when the lock is released. Lock files left
+  behind by processes that died are reused.
+  """
+
+  poll_interval = 0.2
+
+  def __init__(self, path, timeout=None, what=None, on_wait=None):
+    self.path = path
+    self.timeout = timeout
+    self.what = what
+    self.on_wait = on_wait
+    self._fd = None
+
+  def __enter__(self):
+    self.acquire()
+    return self
+
+  def __exit__(self, *args):
+    self.release()
+
+  @property
+  def locked(self):
+    return self._fd is not None
+
+  def holder(self):
+    """
+    Returns the information written by the current holder of the lock, or
+    #None if it can not be read.
+    """
+
+    try:
+      with open(self.path) as fp:
+        return json.load(fp)
+    except (IOError, OSError, ValueError):
+      return None
+
+  def _try_lock(self):
+    fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+      fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except (IOError, OSError) as exc:
+      os.close(fd)
+      if exc.errno in (errno.EAGAIN, errno.EACCES):
+        return None
+      raise
+    # The previous holder may have removed the file after we opened it,
+    # in that case we hold a lock on a file that nobody else will see.
+    try:
+      same = os.path.samestat(os.fstat(fd), os.stat(self.path))
+    except OSError:
+      same = False
+    if not same:
+      os.close(fd)
+      return None
+    return fd
+
+  def acquire(self):
+    """
+    Acquires the lock. Raises a #LockTimeout if the lock is held by
+    another process for longer than #timeout seconds.
+    """
+
+    if self._fd is not None:
+      raise RuntimeError('lock {!r} is already acquired'.format(self.path))
+    parent = os.path.dirname(self.path)
+    if parent and not os.path.isdir(parent):
+      os.makedirs(parent)
+
+    deadline = None if self.timeout is None else time.time() + self.timeout
+    waiting = False
+    while True:
+      fd = self._try_lock()
+      if fd is not None:
+        break
+      if deadline is not None and time.time() >= deadline:
+        holder = self.holder()
+        raise LockTimeout('timed out waiting for {!r}, locked by {}'.format(
+          self.what or self.path, describe_holder(holder)), holder)
+      if not waiting:
+        waiting = True
+        if self.on_wait:
+          self.on_wait(self.holder())
+      time.sleep(self.poll_interval)
+
+    info = {'pid': os.getpid(), 'host': socket.gethostname(), 'since': time.time(),
+            'what': self.what}
+    os.ftruncate(fd, 0)
+    os.write(fd, json.dumps(info).encode('utf8'))
+    self._fd = fd
+
+  def release(self):
+    if self._fd is None:
+      return
+    try:
+      os.remove(self.path)
+    except OSError:
+      pass
+    os.close(self._fd)
+    self._fd = None
+
+
+def describe_holder(holder):
+  """
+  Returns a short description of the #holder of a lock for messages.
+  """
+
+  if not holder:
+    return 'another process'
+  return 'pid {} on {}'.format(holder.get('pid'), holder.get('host'))
@@ -19,11 +19,15 @@
 # THE SOFTWARE.
 
 import argparse
-import bs4, html5lib
 import os
 import sys
 
 parser = argparse.ArgumentParser()
+parser.add_argument('--events', metavar='FILE', dest='events_file', help='Append progress and stage events to FILE '
+    'as JSON lines. Use - to write them to stdout.')
+parser.add_argument('--metrics', metavar='FILE', dest='metrics_file', help='Export progress, throughput and stage durations '
+    'to FILE in the Prometheus text format (for the node exporter\'s textfile collector).')
+parser.add_argument('--no-progress', action='store_true', help='Do not show progress on the terminal.')
 subparsers = parser.add_subparsers(dest='command')
 
 mkiso_parser = subparsers.add_parser('mkiso', description='''
@@ -32,6 +36,17 @@ mkiso_parser = subparsers.add_parser('mkiso', description='''
 ''')
 mkiso_parser.add_argument('installer', nargs='?')
 mkiso_parser.add_argument('-o', '--output', help='Name of the output ISO file.')
+mkiso_parser.add_argument('--no-verify', action='store_true', help='Do not verify BaseSystem.dmg against BaseSystem.chunklist.')
+mkiso_parser.add_argument('-j', '--jobs', type=int, help='Number of threads for the verification. Defaults to the number of CPUs.')
+
+verify_chunklist_parser = subparsers.add_parser('verify-chunklist', description='''
+  Verify a Disk Image File against the SHA-256 digests in a chunklist, eg.
+  BaseSystem.dmg against BaseSystem.chunklist from a macOS installer. The
+  signature of the chunklist is not checked.
+''')
+verify_chunklist_parser.add_argument('chunklist')
+verify_chunklist_parser.add_argument('dmg')
+verify_chunklist_parser.add_argument('-j', '--jobs', type=int, help='Number of threads. Defaults to the number of CPUs.')
 
 vbx_parser = subparsers.add_parser('vbx', description='''
   Create and/or configure a VirtualBox virtual machine for the installation
@@ -49,7 +64,9 @@ vbx_parser.add_argument('--new', action='store_true', help='Create a new VM. Imp
 vbx_parser.add_argument('--all', action='store_true', help='Perform all configuration steps.')
 vbx_parser.add_argument('--general', action='store_true', help='Perform general configuration steps, such as memory, vram, cpu count, firmware, etc.')
 vbx_parser.add_argument('--storage', action='store_true', help='Set up storage configuration.')
-vbx_parser.add_argument('--image', help='Disk image to attach. Implies --storage.')
+vbx_parser.add_argument('--image', help='Disk image to attach. Implies --storage. Raw and ISO images are converted to a dynamically '
+    'allocated VDI image that is cached and attached as a multi-attach medium, so that multiple VMs can share it.')
+vbx_parser.add_argument('--no-convert', action='store_true', help='Attach the --image as it is, without converting it to VDI.')
 vbx_parser.add_argument('--device', help='Configure a specific host device. If --all is used, the default device is MacBookPro11,3.')
 vbx_parser.add_argument('--list-devices', action='store_true', help='List available host devices for which a --device-serial can be automatically selected.')
 vbx_parser.add_argument('--device-serial', help='Manually specify the device serial number. Must be paired with a --device name.')
@@ -70,21 +87,84 @@ xcode_subparser = xcode_parser.add_subparsers(dest='xcode_command')
 xcode_install_parser = xcode_subparser.add_parser('install', description='''
   Install macOS XCode command-line tools from a Disk Image File (.dmg).
   Must be run as a superuser if you want to install macOS SDK components.
+
+  If a URL or a version from the XCode Version Table or the local catalog is
+  specified, the Disk Image File is not downloaded. Only the parts that are
+  needed for the selected packages are read with HTTP Range requests.
+
+  If an installation is interrupted, running the same command again continues
+  where it stopped instead of erasing the directory. If another osxt process
+  installs into the same directory, this command waits for it and does nothing
+  if the same packages were installed.
 ''')
-xcode_install_parser.add_argument('dmg', help='Path to the Disk Image file. The XCode command-line tools .dmg files can be downloaded from the '
-    'Apple Developer Portal: https://developer.apple.com/downloads/index.action')
+xcode_install_parser.add_argument('dmg', help='Path to the Disk Image file, its URL or a (partial) name from `osxt xcode download --list`. '
+    'The XCode command-line tools .dmg files can be downloaded from the Apple Developer Portal: '
+    'https://developer.apple.com/downloads/index.action')
 xcode_install_parser.add_argument('directory', help='The directory where the XCode command-line tools will be installed to.')
 xcode_install_parser.add_argument('-u', '--user', help='The name of the user that should be granted ownership of the extracted files. This argument '
     'should be specified when running as a superuser.')
 xcode_install_parser.add_argument('--debug-pkg', action='store_true', help='Enter an interactive bash session after the disk image was mounted and the contained '
     '.pkg file was extracted. This option is useful when the installation process fails to inspect the contents of the .pkg file.')
+xcode_install_parser.add_argument('--name', help='The name under which the toolchain is registered for `osxt xcode use`. Defaults to the name of the '
+    'Disk Image file without its suffix.')
+xcode_install_parser.add_argument('--use', action='store_true', help='Make the installed toolchain the active toolchain.')
+xcode_install_parser.add_argument('--include', action='append', default=[], help='Only install packages whose name or identifier matches '
+    'this glob pattern, eg. "*Executables*". Can be specified multiple times.')
+xcode_install_parser.add_argument('--exclude', action='append', default=[], help='Do not install packages whose name or identifier matches '
+    'this glob pattern, eg. "*SDK*". Can be specified multiple times.')
+xcode_install_parser.add_argument('--dry-run', action='store_true', help='Only print the packages that would be installed with their '
+    'expanded sizes and check the available disk space.')
+xcode_install_parser.add_argument('--restart', action='store_true', help='Do not resume an interrupted installation into the '
+    'directory and do not skip an installation that is already complete, start over instead.')
+xcode_install_parser.add_argument('--lock-timeout', type=float, help='The number of seconds to wait for another process that installs '
+    'into the same directory. Waits forever by default.')
+xcode_install_parser.add_argument('--apple-id', help='You\'re Apple ID, for installing from the Apple Developer Portal. Will be prompted if not specified.')
+
+xcode_use_parser = xcode_subparser.add_parser('use', description='''
+  Switch the active toolchain. Every toolchain installed with `osxt xcode
+  install` is registered under a name and gets a pre-resolved activate
+  script. The active toolchain can be activated in a shell by sourcing
+  ~/.osxt/toolchains/current/activate. If no NAME is specified, the
+  registered toolchains are listed.
+''')
+xcode_use_parser.add_argument('name', nargs='?', help='The name of the toolchain to activate.')
+xcode_use_parser.add_argument('--remove', action='store_true', help='Remove the toolchain from the registry instead. The installed '
+    'files are not deleted.')
+
+xcode_pack_parser = xcode_subparser.add_parser('pack', description='''
+  Pack an installed toolchain into an archive for distribution, eg. to CI
+  workers. File contents are compressed in chunks by multiple threads and
+  the archive contains an index, so it can be unpacked in parallel and
+  single files can be extracted without decompressing the whole archive.
+''')
+xcode_pack_parser.add_argument('directory', help='The directory of the installed toolchain.')
+xcode_pack_parser.add_argument('-o', '--output', help='The name of the archive. Defaults to the directory name with the suffix .osxtpack.')
+xcode_pack_parser.add_argument('-j', '--jobs', type=int, help='Number of compression threads. Defaults to the number of CPUs.')
+xcode_pack_parser.add_argument('--compression', choices=('zlib', 'lzma', 'bz2'), default='zlib', help='The compression method. '
+    'Defaults to zlib.')
+
+xcode_unpack_parser = xcode_subparser.add_parser('unpack', description='''
+  Unpack an archive created with `osxt xcode pack`. If MEMBERs are specified,
+  only these files and directories are extracted, eg. usr/bin/clang.
+''')
+xcode_unpack_parser.add_argument('archive')
+xcode_unpack_parser.add_argument('member', nargs='*')
+xcode_unpack_parser.add_argument('-C', '--directory', default='.', help='The directory to unpack to. Defaults to the current directory.')
+xcode_unpack_parser.add_argument('-j', '--jobs', type=int, help='Number of decompression threads. Defaults to the number of CPUs.')
+xcode_unpack_parser.add_argument('-l', '--list', action='store_true', help='List the contents of the archive instead.')
+xcode_unpack_parser.add_argument('--name', help='Register the unpacked toolchain under this name for `osxt xcode use`.')
 
 xcode_getversion_parser = xcode_subparser.add_parser('getversion', description='''
-  Installs to a temporary directory and outputs the clang version, then
-  removes the temporarily installed files again.
+  Outputs the clang version of one or more XCode or Command Line Tools Disk
+  Image Files. Only the clang binary is extracted from the package payloads.
+  Results are cached by the SHA-256 of the Disk Image File.
 ''')
-xcode_getversion_parser.add_argument('dmg')
-xcode_getversion_parser.add_argument('-v', '--verbose')
+xcode_getversion_parser.add_argument('dmg', nargs='+', help='Disk Image Files or directories that contain Disk Image Files.')
+xcode_getversion_parser.add_argument('-j', '--jobs', type=int, help='The number of Disk Image Files to process in parallel. '
+    'Defaults to the number of CPUs.')
+xcode_getversion_parser.add_argument('--no-cache', action='store_true', help='Ignore cached results.')
+xcode_getversion_parser.add_argument('--json', action='store_true', help='Print the results as a JSON object.')
+xcode_getversion_parser.add_argument('-v', '--verbose', action='store_true')
 
 xcode_download_parser = xcode_subparser.add_parser('download', description='''
   Download a file from the Apple Developer Portal. If URL is specified, it must
@@ -93,12 +173,90 @@ xcode_download_parser = xcode_subparser.add_parser('download', description='''
 
   If no URL is specified, an interactive session will allow you to selected
   a version.
+
+  If another osxt process is downloading the same file, this command waits
+  for it and then takes the file from the local cache.
+
+  If a peer is specified and the local cache contains a similar Disk Image
+  file (eg. the previous release), only the parts of the file that differ are
+  downloaded from the peer.
+
+  Peers are only used if the SHA-256 of the file is known. On a machine that
+  did not download the file before, pass --sha256 or record the digests of a
+  trusted machine with `osxt cache list > digests.txt` there and `osxt xcode
+  catalog digests digests.txt` here.
 ''')
 xcode_download_parser.add_argument('url', nargs='?')
-xcode_download_parser.add_argument('-l', '--list', action='store_true', help='List the downloads available from the XCode Version Table in the osxt README. '
+xcode_download_parser.add_argument('-l', '--list', action='store_true', help='List the downloads available from the XCode Version Table in the osxt README '
+    'and the local catalog (see `osxt xcode catalog`). '
     'If the URL argument is specified, only results that contain the URL string will be printed.')
 xcode_download_parser.add_argument('--show-url', action='store_true', help='Print the download URL when using the --list option.')
 xcode_download_parser.add_argument('--apple-id', help='You\'re Apple ID. Will be prompted if not specified.')
+xcode_download_parser.add_argument('--peer', action='append', default=[], help='The URL of an `osxt cache serve` instance to try before '
+    'downloading from Apple. Can be specified multiple times. Peers are only used if the SHA-256 of the file is known, see --sha256.')
+xcode_download_parser.add_argument('--sha256', help='The expected SHA-256 of the Disk Image file. Defaults to the digest recorded in '
+    'the local cache or in the local catalog (see `osxt xcode catalog digests`).')
+xcode_download_parser.add_argument('--no-cache', action='store_true', help='Do not add the downloaded file to the local cache.')
+xcode_download_parser.add_argument('--no-delta', action='store_true', help='Do not reconstruct the file from similar cached Disk Image '
+    'files with the delta index of a peer, download it completely instead.')
+xcode_download_parser.add_argument('--lock-timeout', type=float, help='The number of seconds to wait for another process that downloads '
+    'the same file. Waits forever by default.')
+
+xcode_catalog_parser = xcode_subparser.add_parser('catalog', description='''
+  Manage the local catalog of downloads. The catalog is merged with the XCode
+  Version Table from the osxt README for `osxt xcode download`.
+''')
+xcode_catalog_subparser = xcode_catalog_parser.add_subparsers(dest='catalog_command')
+
+xcode_catalog_refresh_parser = xcode_catalog_subparser.add_parser('refresh', description='''
+  Fetch the list of downloads from the Apple Developer Portal and merge it into
+  the local catalog. The request is conditional on the ETag and Last-Modified
+  date of the previous refresh, so an unchanged list is not transferred again.
+''')
+xcode_catalog_refresh_parser.add_argument('--url', help='Fetch the download list from this URL instead.')
+xcode_catalog_refresh_parser.add_argument('--apple-id', help='You\'re Apple ID. Will be prompted if a login is required.')
+xcode_catalog_refresh_parser.add_argument('--force', action='store_true', help='Fetch the list even if it did not change.')
+
+xcode_catalog_list_parser = xcode_catalog_subparser.add_parser('list', description='''
+  List the downloads in the local catalog.
+''')
+xcode_catalog_list_parser.add_argument('filter', nargs='?', help='Only list downloads that contain this string.')
+xcode_catalog_list_parser.add_argument('--show-url', action='store_true', help='Print the download URLs.')
+
+xcode_catalog_digests_parser = xcode_catalog_subparser.add_parser('digests', description='''
+  Record trusted SHA-256 digests of Disk Image files in the local catalog.
+  `osxt xcode download` verifies files against them and downloads files with
+  a known digest from peers. The files contain lines of a digest and a file
+  name, as printed by `osxt cache list` and `sha256sum`.
+''')
+xcode_catalog_digests_parser.add_argument('files', nargs='+', help='The files to read the digests from. Use - to read from stdin.')
+
+cache_parser = subparsers.add_parser('cache', description='''
+  Manage the local cache of Disk Image files. Files downloaded with `osxt xcode
+  download` are added to the cache automatically and can be shared with other
+  machines in the network using `osxt cache serve`.
+''')
+cache_subparser = cache_parser.add_subparsers(dest='cache_command')
+
+cache_serve_parser = cache_subparser.add_parser('serve', description='''
+  Serve the cached Disk Image files over HTTP. Other machines can use the
+  server with `osxt xcode download --peer http://<host>:<port>`. The delta
+  indexes of the files, with which other machines download only the parts
+  that they do not have yet, are built in the background when the server
+  starts, unless `osxt cache add` already built them.
+''')
+cache_serve_parser.add_argument('--host', default='', help='The address to bind to. Defaults to all interfaces.')
+cache_serve_parser.add_argument('--port', type=int, default=8585, help='The port to bind to. Defaults to 8585.')
+
+cache_add_parser = cache_subparser.add_parser('add', description='''
+  Add Disk Image files to the cache, record their SHA-256 in the cache and
+  the local catalog and build their delta index.
+''')
+cache_add_parser.add_argument('files', nargs='+')
+
+cache_list_parser = cache_subparser.add_parser('list', description='''
+  List the cached Disk Image files.
+''')
 
 
 def mkiso(args):
@@ -120,6 +278,8 @@ def mkiso(args):
 
   installer = args.installer
   output = args.output
+  verify = not args.no_verify
+  jobs = args.jobs
 
   if installer and not os.path.isabs(installer) and not os.path.exists(installer):
     installer = os.path.join('/Applications', installer)
@@ -135,43 +295,75 @@ def mkiso(args):
     base = re.sub('\s+', '-', base)
     output = base + '.iso'
 
+  events = args.events
+  task = os.path.basename(output)
   fn = os.path.join(installer, 'Contents/SharedSupport/InstallESD.dmg')
   args = ['-noverify', '-nobrowse']
   with MountFile(fn, args) as mount:
+    if verify:
+      chunklist_fn = os.path.join(mount, 'BaseSystem.chunklist')
+      dmg_fn = os.path.join(mount, 'BaseSystem.dmg')
+      with events.stage(task, 'verify') as stage:
+        if not verify_chunklist_file(chunklist_fn, dmg_fn, jobs):
+          stage.error = 'verification failed'
+      if stage.error:
+        return 1
     filename = '/tmp/' + os.path.basename(output)
-    # Create a blank ISO image with a single partition map.
-    system.call('hdiutil', 'create', '-o', filename,
-      '-layout', 'SPUD', '-fs', 'HFS+J', '-type', 'SPARSE')
-    # Mount the sparse bundle for package addition.
-    system.call('hdiutil', 'attach', filename + '.sparseimage', '-noverify',
-      '-nobrowse', '-mountpoint', '/Volumes/install_build')
-    # Restore the base system into the ISO image.
-    # Mounts "OS X Base System".
-    system.call('asr', 'restore', '-source', os.path.join(mount, 'BaseSystem.dmg'),
-      '-target', '/Volumes/install_build', '-noprompt', '-noverify', '-erase')
-    # Remove package link and replace with actual files.
-    system.call('rm', '/Volumes/OS X Base System/System/Installation/Packages')
-    system.call('cp', '-rp', os.path.join(mount, 'Packages'),
-      '/Volumes/OS X Base System/System/Installation')
-    # Copy installer dependencies.
-    system.call('cp', '-rp', os.path.join(mount, 'BaseSystem.chunklist'),
-      '/Volumes/OS X Base System/BaseSystem.chunklist')
-    system.call('cp', '-rp', os.path.join(mount, 'BaseSystem.dmg'),
-      '/Volumes/OS X Base System/BaseSystem.dmg')
+    with events.stage(task, 'create'):
+      # Create a blank ISO image with a single partition map.
+      system.call('hdiutil', 'create', '-o', filename,
+        '-layout', 'SPUD', '-fs', 'HFS+J', '-type', 'SPARSE')
+      # Mount the sparse bundle for package addition.
+      system.call('hdiutil', 'attach', filename + '.sparseimage', '-noverify',
+        '-nobrowse', '-mountpoint', '/Volumes/install_build')
+    with events.stage(task, 'restore'):
+      # Restore the base system into the ISO image.
+      # Mounts "OS X Base System".
+      system.call('asr', 'restore', '-source', os.path.join(mount, 'BaseSystem.dmg'),
+        '-target', '/Volumes/install_build', '-noprompt', '-noverify', '-erase')
+    with events.stage(task, 'copy'):
+      # Remove package link and replace with actual files.
+      system.call('rm', '/Volumes/OS X Base System/System/Installation/Packages')
+      system.call('cp', '-rp', os.path.join(mount, 'Packages'),
+        '/Volumes/OS X Base System/System/Installation')
+      # Copy installer dependencies.
+      system.call('cp', '-rp', os.path.join(mount, 'BaseSystem.chunklist'),
+        '/Volumes/OS X Base System/BaseSystem.chunklist')
+      system.call('cp', '-rp', os.path.join(mount, 'BaseSystem.dmg'),
+        '/Volumes/OS X Base System/BaseSystem.dmg')
 
   system.call('hdiutil', 'detach', '/Volumes/OS X Base System')
-  # Optimise Sparseimage size.
-  system.call('hdiutil', 'compact', filename + '.sparseimage', '-batteryallowed')
-  system.call('hdiutil', 'resize', '-size', 'min', filename + '.sparseimage')
-  # Convert the sparseimage to ISO.
-  system.call('hdiutil', 'convert', filename + '.sparseimage',
-    '-format', 'UDTO', '-o', filename)
+  with events.stage(task, 'convert'):
+    # Optimise Sparseimage size.
+    system.call('hdiutil', 'compact', filename + '.sparseimage', '-batteryallowed')
+    system.call('hdiutil', 'resize', '-size', 'min', filename + '.sparseimage')
+    # Convert the sparseimage to ISO.
+    system.call('hdiutil', 'convert', filename + '.sparseimage',
+      '-format', 'UDTO', '-o', filename)
 
   print('Moving {} to {} ...'.format(filename, output))
   os.rename(filename + '.cdr', output)
   os.remove(filename + '.sparseimage')
 
 
+def verify_chunklist_file(chunklist_fn, dmg_fn, jobs=None):
+  import chunklist from './chunklist'
+
+  print('Verifying {} ...'.format(dmg_fn))
+  try:
+    failed = chunklist.verify(chunklist.parse(chunklist_fn), dmg_fn, jobs)
+  except (IOError, OSError, chunklist.ChunklistError) as exc:
+    print('error:', exc)
+    return False
+  for chunk in failed:
+    print('error: chunk {} at offset {} does not match'.format(chunk.index, chunk.offset))
+  return not failed
+
+
+def verify_chunklist(args):
+  return 0 if verify_chunklist_file(args.chunklist, args.dmg, args.jobs) else 1
+
+
 def vbcall(prog, *args, **kwargs):
   import system from './system'
   if os.name == 'nt' and not os.path.isabs(prog):
@@ -183,9 +375,30 @@ def vbmanage(*args, **kwargs):
   return vbcall('VBoxManage', *args, **kwargs)
 
 
-def vbx(args):
-  import system from './system'
+def attach_image(vm, image, convert=True):
+  import vdi from './vdi'
+  import {format_size} from './installer'
 
+  # Raw and ISO images are converted to a cached VDI image first.
+  mtype = []
+  if convert and os.path.splitext(image)[1].lower() not in vdi.NATIVE_FORMATS:
+    def progress(bytes_read, size):
+      print('\rConverting \'{}\' to VDI ... {}%'.format(image, bytes_read * 100 // max(size, 1)), end='')
+    result = vdi.convert_cached(image, progress)
+    if result.cached:
+      print('Using cached VDI image for \'{}\''.format(image))
+    else:
+      print()
+    print('{}: {} of {} blocks allocated ({})'.format(result.filename, result.allocated,
+      result.blocks, format_size(result.allocated * vdi.BLOCK_SIZE)))
+    image = result.filename
+    # Every VM gets its own differencing image on top of the shared one.
+    mtype = ['--mtype', 'multiattach']
+  vbmanage('storageattach', vm, '--storagectl', 'SATA Controller', '--port',
+    '0', '--device', '0', '--type', 'hdd', '--medium', os.path.abspath(image), *mtype)
+
+
+def vbx(args):
   # From http://www.insanelymac.com/forum/topic/309654-run-vanilla-os-x-el-capitan-sierra-yosemite-or-mavericks-in-virtualbox-5010-on-a-windows-host/
   DEVICE_SERIALS = {
     'iMac11,3': 'Mac-F2238BAE',
@@ -246,8 +459,7 @@ def vbx(args):
   if storage or all:
     vbmanage('storagectl', vm, '--name', 'SATA Controller', '--add', 'sata', '--controller', 'IntelAHCI')
     if image:
-      vbmanage('storageattach', vm, '--storagectl', 'SATA Controller', '--port',
-        '0', '--device', '0', '--type', 'hdd', '--medium', os.path.abspath(image))
+      attach_image(vm, image, not args.no_convert)
   elif image:
     print('warning: --image only with --storage')
   if general or all:
@@ -281,154 +493,212 @@ def vbx(args):
 
 
 def xcode(args):
-  global getpass, glob, requests, posixpath, installer, system, pbzx
-  import getpass
-  import glob
-  import requests
-  import posixpath
-  import installer from './installer'
-  import system from './system'
-  import pbzx from './pbzx'
-
   if args.xcode_command == 'install':
     return xcode_install(args)
+  elif args.xcode_command == 'use':
+    return xcode_use(args)
+  elif args.xcode_command == 'pack':
+    return xcode_pack(args)
+  elif args.xcode_command == 'unpack':
+    return xcode_unpack(args)
   elif args.xcode_command == 'getversion':
     return xcode_getversion(args)
   elif args.xcode_command == 'download':
     return xcode_download(args)
+  elif args.xcode_command == 'catalog':
+    return xcode_catalog(args)
   else:
     print('error: unexpected subcommand: {!r}'.format(args.xcode_command))
+    return 1
 
 
 def xcode_install(args):
+  import getpass
+  import posixpath
+  import cache from './cache'
+  import catalog from './catalog'
+  import download from './download'
+  import installer from './installer'
+  import registry from './registry'
+  import system from './system'
+  import {is_url} from './httpio'
+  from urllib.parse import urlparse
+
   dmg = args.dmg
-  dest = args.directory
   user = args.user
-  debug_pkg = args.debug_pkg
-
-  pbzx.find_or_install()
+  session = None
 
-  # If the Mac OS SDK should be installed, this should be run
-  # as superuser. Otherwise, some files might not be extracted
-  # properly from the archive.
-  if os.getuid() != 0 and system.verbose:
-    print('warning: not run as superuser, some files might not get extracted')
+  # Resolve versions from the XCode Version Table and the local catalog.
+  # A cached copy of the Disk Image File is preferred over the URL.
+  if not os.path.exists(dmg) and not is_url(dmg):
+    try:
+      filename, dmg = download.find_version(dmg, catalog.versions())
+    except download.DownloadError as exc:
+      print('error:', exc)
+      for v in exc.candidates[:5]:
+        print('  -', v[0])
+      return 1
+    dmg = cache.lookup(posixpath.basename(dmg)) or dmg
+
+  if is_url(dmg):
+    name = posixpath.basename(urlparse(dmg).path)
+    if urlparse(dmg).netloc.endswith('apple.com'):
+      import requests
+      session = requests.Session()
+      apple_id = args.apple_id or input('Apple ID: ')
+      if not download.apple_id_login(session, apple_id, getpass.getpass('Password: ')):
+        print('error: Apple ID login failed')
+        return 1
+  else:
+    name = os.path.basename(dmg)
+  name = args.name or registry.default_name(os.path.splitext(name)[0])
 
   if not user:
     user = system.getoutput('logname').strip()
 
-  # Determine the user and group ID of the new user.
-  if user:
-    try:
-      uid = int(system.getoutput('id', '-u', user))
-      gid = int(system.getoutput('id', '-g', user))
-    except (ValueError, system.ExitError):
-      exit('could not determine uid/gid for user', user, code=1)
-  else:
-    uid = gid = None
-
-  # Make sure the output directory exists, and that it does
-  # not already contain any important files.
-  if os.path.exists(dest):
-    if not os.path.isdir(dest):
-      exit("'%s' is not a directory" % dest, code=1)
-
-    if installer.dir_has_contents(dest):
-      string = input("'%s' is not empty, it'll be erased. "
-        "Okay with that? [yes/no] " % dest).strip().lower()
-      if not string or string not in ('yes', 'y'):
-        exit('user stop')
-
-      system.call('rm', '-rf', dest)
-      system.call('mkdir', dest)
-  else:
-    system.call('mkdir', '-p', dest)
-
-  # Mount the Disk Image File and search for the CLTools and
-  # Mac OS SDK package files.
-  packages = None
-  with installer.MultiContext() as context:
-    volume = context.enter(installer.MountFile(dmg))
-
-    # Two choices: Either, the CLTools and SDK packages are
-    # contained in a Packages/ subdirectory or in another
-    # Package archive.
-    packages_dir = os.path.join(volume, 'Packages')
-    if os.path.isdir(packages_dir):
-      packages = installer.detect_packages(packages_dir)
-    else:
-      # So, there must be a *.pkg file in this Disk Image File
-      # which in turn contains the CLTools and SDK packages.
-      pkgs = glob.glob(os.path.join(volume, '*.pkg'))
-      if not pkgs:
-        exit('No *.pkg found in Disk Image File', code=1)
-      elif len(pkgs) != 1:
-        print('Not sure which *.pkg to use from Disk Image File.')
-        filename = installer.select_file(pkgs)
-      else:
-        filename = pkgs[0]
+  def confirm(dest):
+    string = input("'%s' is not empty, it'll be erased. "
+      "Okay with that? [yes/no] " % dest).strip().lower()
+    return string in ('yes', 'y')
 
-      # We need to unpack the PKG in order to acces its
-      # contained packages (the CLTools and SDK packages).
-      tmpdir = context.enter(installer.TempDir())
-      installer.unpack_pkg(filename, tmpdir)
-      packages = installer.detect_packages(tmpdir)
+  def select(pkgs):
+    print('Not sure which *.pkg to use from Disk Image File.')
+    return installer.select_file(pkgs)
 
-    if debug_pkg:
-      olddir = os.getcwd()
-      os.chdir(tmpdir)
-      try:
-        system.call('bash')
-      except system.ExitError as exc:
-        print('aborted after --debug-pkg')
-        return exc.code
-      finally:
-        os.chdir(olddir)
-
-    for pkg in packages:
-      installer.install_pkg(pkg, dest)
-
-  # Copy the activate script to the destination directory.
-  activate_script = str(module.directory.joinpath('../templates/activate'))
+  def debug_hook(directory):
+    system.call('bash', cwd=directory)
+
+  inst = installer.Installer(verbose=True, events=args.events)
   try:
-    system.call('cp', activate_script, os.path.join(dest, 'activate'))
+    result = inst.install(dmg, args.directory, user=user, name=name, use=args.use,
+      include=args.include, exclude=args.exclude, dry_run=args.dry_run,
+      overwrite=confirm, select=select, debug_hook=debug_hook if args.debug_pkg else None,
+      session=session, resume=not args.restart, lock_timeout=args.lock_timeout)
+  except installer.InstallError as exc:
+    print('error:', exc)
+    return 1
   except system.ExitError as exc:
-    print("failed to copy activate script.")
+    if args.debug_pkg and exc.args[0] == 'bash':
+      print('aborted after --debug-pkg')
+    else:
+      print('error:', exc)
+    return exc.code
+
+  if result.toolchain:
+    print("registered toolchain '{}'".format(result.toolchain))
+  return 0
 
-  # Chown the complete destination directory.
-  if user:
-    system.call('chown', '-R', user, dest)
 
+def xcode_use(args):
+  import registry from './registry'
+
+  if not args.name:
+    current = registry.current()
+    for name in registry.names():
+      print('*' if name == current else ' ', name, registry.get(name)['directory'])
+    return 0
+
+  try:
+    if args.remove:
+      registry.unregister(args.name)
+    else:
+      registry.use(args.name)
+  except ValueError as exc:
+    print('error:', exc)
+    return 1
+  except KeyError:
+    print('error: no such toolchain: {!r}'.format(args.name))
+    return 1
   return 0
 
 
-def xcode_getversion(args):
-  dmg = args.dmg
-  system.verbose = args.verbose
-  with installer.TempDir() as dir:
-    ret = install([dmg, dir], '--extract', '/usr/bin/clang', standalone_mode=False)
-    if ret != 0:
-      # TODO: Currently extracts all files, but we only need the clang binary.
-      print('error: extraction failed', file=sys.stderr)
+def xcode_pack(args):
+  import pack from './pack'
+
+  output = args.output or os.path.basename(os.path.abspath(args.directory)) + '.osxtpack'
+  if not os.path.isdir(args.directory):
+    print('error: not a directory: {!r}'.format(args.directory))
+    return 1
+  count = pack.pack(args.directory, output, args.jobs, args.compression)
+  print('packed {} entries into {}'.format(count, output))
+  return 0
+
+
+def xcode_unpack(args):
+  import pack from './pack'
+  import registry from './registry'
+
+  try:
+    archive = pack.PackArchive(args.archive)
+    entries = archive.select(args.member)
+  except pack.PackError as exc:
+    print('error:', exc)
+    return 1
+  except KeyError as exc:
+    print('error: not in archive: {}'.format(exc))
+    return 1
+
+  if args.list:
+    for entry in entries:
+      if entry['type'] == 'dir':
+        print(entry['path'] + '/')
+      elif entry['type'] in ('symlink', 'hardlink'):
+        print(entry['path'], '->', entry['target'])
+      else:
+        print(entry['path'])
+    return 0
+
+  if args.name:
+    try:
+      registry.check_name(args.name)
+    except ValueError as exc:
+      print('error:', exc)
       return 1
-    clang_bin = os.path.join(dir, 'usr/bin/clang')
-    if not os.path.isfile(clang_bin):
-      clang_bin = os.path.join(dir, 'Library/Developer/CommandLineTools/usr/bin/clang')
-    system.call(clang_bin, '--version')
+  archive.extract(args.directory, args.member, args.jobs)
+  if args.name:
+    registry.register(args.name, args.directory)
+    print("registered toolchain '{}'".format(args.name))
+  return 0
+
+
+def xcode_getversion(args):
+  import json
+  import versions from './versions'
+
+  dmgs = versions.find_dmgs(args.dmg)
+  if not dmgs:
+    print('error: no Disk Image Files found')
+    return 1
+
+  def report(dmg, version, error):
+    if args.json:
+      return
+    print('==>', dmg)
+    print(version if version else 'error: {}'.format(error))
+
+  results = versions.get_versions(dmgs, jobs=args.jobs, use_cache=not args.no_cache,
+    verbose=args.verbose, callback=report)
+  if args.json:
+    print(json.dumps(results, indent=2, sort_keys=True))
+  return 0 if all(results.values()) else 1
 
 
 def xcode_download(args):
-  import {apple_id_login, parse_xcode_version_table} from './download'
+  import getpass
+  import posixpath
+  import cache from './cache'
+  import catalog from './catalog'
+  import download from './download'
+  import {describe_holder} from './lock'
   from prompt_toolkit import prompt
   from prompt_toolkit.contrib.completers import WordCompleter
 
   url = args.url
   list = args.list
-  apple_id = args.apple_id
   show_url = args.show_url
 
   if list:
-    versions = parse_xcode_version_table()
+    versions = catalog.versions()
     for version in versions:
       if url and url not in version[0]:
         continue
@@ -436,74 +706,171 @@ def xcode_download(args):
         print(version[0], '{' + version[1] + '}')
       else:
         print(version[0])
-    return
+    return 0
 
   if not url or not url.startswith('http'):
-    versions = parse_xcode_version_table()
+    versions = catalog.versions()
     if url:
-      results = []
-      for v in versions:
-        if url in v[0]:
-          results.append(v)
-      if len(results) == 0:
-        print('error: no versions matching "{}"'.format(url))
-        sys.exit(1)
-      elif len(results) > 1:
-        print('error: multiple versions matching "{}"'.format(url))
-        for v in results[:5]:
+      try:
+        filename, url = download.find_version(url, versions)
+      except download.DownloadError as exc:
+        print('error:', exc)
+        for v in exc.candidates[:5]:
             print('  -', v[0])
-        if len(results) > 5:
+        if len(exc.candidates) > 5:
             print('  - ...')
-        sys.exit(1)
-      filename, url = results[0]
+        return 1
     else:
       choices = [x[0] for x in versions]
       choice = prompt('Disk Image: ', completer=WordCompleter(choices, sentence=True))
       if choice not in choices:
-        print('error: invalid selection "{}"'.format(url))
-        sys.exit(1)
+        print('error: invalid selection "{}"'.format(choice))
+        return 1
       filename, url = versions[choices.index(choice)]
   else:
     filename = posixpath.basename(url)
 
-  session = requests.Session()
-  apple_id = apple_id or input('Apple ID: ')
-  password = getpass.getpass('Password: ')
+  def credentials():
+    apple_id = args.apple_id or input('Apple ID: ')
+    return apple_id, getpass.getpass('Password: ')
 
-  if not apple_id_login(session, apple_id, password):
-    print('Login failed.')
-    sys.exit(1)
+  def on_wait(holder):
+    print('Waiting for the download by {} ...'.format(describe_holder(holder)))
 
-  response = session.get(url, stream=True)
-  response.raise_for_status()
-  if 'Content-Length' in response.headers:
-    size = int(response.headers['Content-Length'])
+  if args.peer and not (args.sha256 or cache.known_hash(url) or catalog.known_hash(url)):
+    print('warning: SHA-256 of \'{}\' unknown, not using peers (see `osxt xcode catalog '
+      'digests`)'.format(filename))
+  try:
+    result = download.download(url, filename, credentials=credentials, peers=args.peer,
+      sha256=args.sha256, use_cache=not args.no_cache, lock_timeout=args.lock_timeout,
+      on_wait=on_wait, use_delta=not args.no_delta, events=args.events)
+  except download.DownloadError as exc:
+    print('error:', exc)
+    return 1
+  if result.source == 'cache':
+    print('Using cached \'{}\''.format(result.filename))
+  elif result.source == 'delta':
+    print('Reconstructed \'{}\' from {}, reused {:.1f} MiB and downloaded {:.1f} MiB'.format(
+      result.filename, result.url, result.delta.reused / 1024.0**2,
+      result.delta.fetched / 1024.0**2))
   else:
-    size = None
-  bytes_read = 0
+    print('Downloaded \'{}\' from {}'.format(result.filename, result.url))
+  return 0
+
+
+def xcode_catalog(args):
+  import getpass
+  import time
+  import catalog from './catalog'
 
-  if response.headers['Content-Type'] == 'text/html':
-    soup = bs4.BeautifulSoup(response.content, 'html5lib')
-    print(soup.find(id='content'))
+  if args.catalog_command == 'refresh':
+    def credentials():
+      apple_id = args.apple_id or input('Apple ID: ')
+      return apple_id, getpass.getpass('Password: ')
+    try:
+      result = catalog.refresh(url=args.url, credentials=credentials, force=args.force)
+    except catalog.CatalogError as exc:
+      print('error:', exc)
+      return 1
+    if not result.modified:
+      print('Catalog is up to date.')
+      return 0
+    for prefix, names in (('+', result.added), ('*', result.updated), ('-', result.removed)):
+      for name in names:
+        print(prefix, name)
+    print('{} added, {} updated, {} removed.'.format(
+      len(result.added), len(result.updated), len(result.removed)))
+  elif args.catalog_command == 'digests':
+    digests = {}
+    try:
+      for filename in args.files:
+        if filename == '-':
+          digests.update(catalog.parse_digests(sys.stdin.read()))
+        else:
+          with open(filename) as fp:
+            digests.update(catalog.parse_digests(fp.read()))
+    except (IOError, OSError, catalog.CatalogError) as exc:
+      print('error: {}: {}'.format(filename, exc))
+      return 1
+    changed = catalog.record_digests(digests)
+    for name in changed:
+      print(digests[name], name)
+    print('{} digests recorded, {} changed.'.format(len(digests), len(changed)))
+  elif args.catalog_command == 'list':
+    data = catalog.load()
+    entries = data.get('entries', {})
+    for name in sorted(entries):
+      if args.filter and args.filter not in name:
+        continue
+      if args.show_url:
+        print(name, '{' + entries[name]['url'] + '}')
+      else:
+        print(name)
+    if not entries:
+      print('Catalog is empty, use `osxt xcode catalog refresh`.')
+    elif data.get('updated'):
+      print('(last refreshed {})'.format(time.strftime('%Y-%m-%d %H:%M',
+        time.localtime(data['updated']))))
+  else:
+    print('error: unexpected subcommand: {!r}'.format(args.catalog_command))
     return 1
+  return 0
 
-  # TODO: Nicer progress bar.
-  def update():
-    print('\rDownloading \'{}\' ... ({}/{})'.format(filename, bytes_read, size), end='')
-    if size:
-      p = float(bytes_read) / size * 100
-      print(' {}%'.format(p), end='')
-  update()
-  with open(filename, 'wb') as fp:
-    for data in response.iter_content(4098):
-      bytes_read += len(data)
-      fp.write(data)
-      update()
-  print()
+
+def cache(args):
+  import cache from './cache'
+  import catalog from './catalog'
+
+  if args.cache_command == 'serve':
+    server = cache.CacheServer(args.host, args.port)
+    print('serving {} on port {} ...'.format(server.directory, server.server_port))
+    try:
+      server.serve_forever()
+    except KeyboardInterrupt:
+      pass
+    finally:
+      server.server_close()
+  elif args.cache_command == 'add':
+    import delta from './delta'
+    for filename in args.files:
+      filename = cache.add(filename)
+      name = os.path.basename(filename)
+      catalog.record_digests({name: cache.known_hash(name)})
+      delta.load_index(filename)
+      print(filename)
+  elif args.cache_command == 'list':
+    hashes = cache.load_hashes()
+    for name in sorted(hashes):
+      if os.path.isfile(os.path.join(cache.cache_dir(), name)):
+        print(hashes[name], name)
+  else:
+    print('error: unexpected subcommand: {!r}'.format(args.cache_command))
+    return 1
+  return 0
+
+
+def event_bus(args):
+  import events from './events'
+
+  bus = events.EventBus()
+  if not args.no_progress and args.events_file != '-' and sys.stdout.isatty():
+    bus.subscribe(events.TtyRenderer(sys.stdout))
+  if args.events_file == '-':
+    bus.subscribe(events.JsonLinesSink(sys.stdout))
+  elif args.events_file:
+    bus.subscribe(events.JsonLinesSink(open(args.events_file, 'a'), close_fp=True))
+  if args.metrics_file:
+    bus.subscribe(events.PrometheusTextfile(args.metrics_file))
+  return bus
 
 
 def main(argv=None):
   args = parser.parse_args(argv)
+  with event_bus(args) as args.events:
+    return dispatch(args)
+
+
+def dispatch(args):
   if args.command == 'mkiso':
     return mkiso(args)
   elif args.command == 'vbx':
@@ -512,6 +879,10 @@ def main(argv=None):
     return vbmanage(*args.argv)
   elif args.command == 'xcode':
     return xcode(args)
+  elif args.command == 'cache':
+    return cache(args)
+  elif args.command == 'verify-chunklist':
+    return verify_chunklist(args)
   else:
     parser.print_usage()
     return 0
@@ -0,0 +1,268 @@
+# Copyright (c) 2017  Niklas Rosenstein
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+import bz2
+import collections
+import json
+import lzma
+import os
+import stat
+import struct
+import zlib
+
+from concurrent.futures import ThreadPoolExecutor
+
+MAGIC = b'OSXTPAK1'
+TRAILER = struct.Struct('<QQ8s')
+TRAILER_MAGIC = b'OSXTIDX1'
+
+#: Compressors by name. All of them release the GIL while compressing.
+CODECS = {
+  'zlib': (lambda data: zlib.compress(data, 6), zlib.decompress),
+  'lzma': (lzma.compress, lzma.decompress),
+  'bz2': (bz2.compress, bz2.decompress),
+}
+
+
+class PackError(Exception):
+  pass
+
+
+def _check_path(path):
+  parts = path.split('/')
+  if not path or path.startswith('/') or '..' in parts:
+    raise PackError('unsafe path in archive: {!r}'.format(path))
+  return path
+
+
+def _walk(directory):
+  """
+  Yields the paths of all entries in #directory relative to it, parents
+  before their children.
+  """
+
+  for root, dirs, files in os.walk(directory):
+    dirs.sort()
+    rel = os.path.relpath(root, directory)
+    rel = '' if rel == '.' else rel.replace(os.sep, '/') + '/'
+    for name in dirs:
+      yield rel + name
+    for name in sorted(files):
+      yield rel + name
+
+
+def pack(directory, output, jobs=None, compression='zlib', chunk_size=4*1024*1024):
+  """
+  Packs the contents of #directory into the archive #output. File contents
+  are split into chunks of #chunk_size bytes that are compressed in
+  parallel by #jobs threads. The index at the end of the archive records
+  the location of every chunk, so files can be extracted independently.
+  Returns the number of entries in the archive.
+  """
+
+  if compression not in CODECS:
+    raise ValueError('unknown compression: {!r}'.format(compression))
+  compress = CODECS[compression][0]
+  jobs = jobs or os.cpu_count() or 1
+
+  entries = []
+  inodes = {}
+  pending = collections.deque()
+
+  with open(output, 'wb') as out, ThreadPoolExecutor(jobs) as executor:
+    out.write(MAGIC)
+
+    def flush(limit):
+      while len(pending) > limit:
+        entry, usize, future = pending.popleft()
+        data = future.result()
+        entry['chunks'].append([out.tell(), len(data), usize])
+        out.write(data)
+
+    for path in _walk(directory):
+      filename = os.path.join(directory, path)
+      st = os.lstat(filename)
+      entry = {'path': path, 'mode': stat.S_IMODE(st.st_mode), 'mtime': st.st_mtime}
+      entries.append(entry)
+      if stat.S_ISDIR(st.st_mode):
+        entry['type'] = 'dir'
+      elif stat.S_ISLNK(st.st_mode):
+        entry['type'] = 'symlink'
+        entry['target'] = os.readlink(filename)
+      elif stat.S_ISREG(st.st_mode):
+        key = (st.st_dev, st.st_ino)
+        if st.st_nlink > 1 and key in inodes:
+          entry['type'] = 'hardlink'
+          entry['target'] = inodes[key]
+          continue
+        inodes[key] = path
+        entry['type'] = 'file'
+        entry['size'] = st.st_size
+        entry['chunks'] = []
+        with open(filename, 'rb') as fp:
+          for data in iter(lambda: fp.read(chunk_size), b''):
+            pending.append((entry, len(data), executor.submit(compress, data)))
+            flush(jobs * 2)
+      else:
+        entries.pop()
+    flush(0)
+
+    index = {
+      'version': 1,
+      'compression': compression,
+      'chunk_size': chunk_size,
+      'entries': entries,
+    }
+    index_data = zlib.compress(json.dumps(index).encode('utf8'), 9)
+    index_offset = out.tell()
+    out.write(index_data)
+    out.write(TRAILER.pack(index_offset, len(index_data), TRAILER_MAGIC))
+
+  return len(entries)
+
+
+class PackArchive(object):
+  """
+  Reads an archive that was created with #pack().
+  """
+
+  def __init__(self, filename):
+    self.filename = filename
+    with open(filename, 'rb') as fp:
+      if fp.read(len(MAGIC)) != MAGIC:
+        raise PackError('{!r}: not an osxt pack archive'.format(filename))
+      fp.seek(-TRAILER.size, os.SEEK_END)
+      offset, length, magic = TRAILER.unpack(fp.read(TRAILER.size))
+      if magic != TRAILER_MAGIC:
+        raise PackError('{!r}: missing index, archive truncated?'.format(filename))
+      fp.seek(offset)
+      index = json.loads(zlib.decompress(fp.read(length)).decode('utf8'))
+    if index.get('version') != 1:
+      raise PackError('{!r}: unsupported version {!r}'.format(filename, index.get('version')))
+    self.compression = index['compression']
+    self.decompress = CODECS[self.compression][1]
+    self.entries = collections.OrderedDict()
+    for entry in index['entries']:
+      self.entries[_check_path(entry['path'])] = entry
+
+  def select(self, members=None):
+    """
+    Returns the entries for the specified #members and their contents if
+    they are directories, or all entries if #members is empty. Raises a
+    #KeyError for members that are not in the archive.
+    """
+
+    if not members:
+      return list(self.entries.values())
+    members = [x.strip('/') for x in members]
+    for member in members:
+      if member not in self.entries:
+        raise KeyError(member)
+    prefixes = tuple(x + '/' for x in members)
+    return [e for p, e in self.entries.items() if p in members or p.startswith(prefixes)]
+
+  def read(self, entry, fp=None):
+    """
+    Reads the contents of the file #entry (a path or an entry from
+    #entries). If #fp is specified, the data is written to it and #None is
+    returned.
+    """
+
+    if not isinstance(entry, dict):
+      entry = self.entries[entry]
+    if entry['type'] != 'file':
+      raise PackError('{!r} is not a file'.format(entry['path']))
+    result = [] if fp is None else None
+    with open(self.filename, 'rb') as src:
+      for offset, csize, usize in entry['chunks']:
+        src.seek(offset)
+        data = self.decompress(src.read(csize))
+        if len(data) != usize:
+          raise PackError('{!r}: corrupt chunk at offset {}'.format(entry['path'], offset))
+        if fp is None:
+          result.append(data)
+        else:
+          fp.write(data)
+    return None if fp is not None else b''.join(result)
+
+  def extract(self, dest, members=None, jobs=None):
+    """
+    Extracts the #members (all entries by default) to the directory #dest.
+    Files are decompressed and written in parallel by #jobs threads. Returns
+    the list of extracted entries.
+    """
+
+    entries = self.select(members)
+    jobs = jobs or os.cpu_count() or 1
+
+    def target(entry):
+      return os.path.join(dest, *entry['path'].split('/'))
+
+    def makedirs(path):
+      if not os.path.isdir(path):
+        os.makedirs(path)
+
+    def extract_file(entry):
+      filename = target(entry)
+      if os.path.lexists(filename):
+        os.remove(filename)
+      with open(filename, 'wb') as fp:
+        self.read(entry, fp)
+      os.chmod(filename, entry['mode'])
+      os.utime(filename, (entry['mtime'], entry['mtime']))
+
+    # Directories first so that the files can be written in any order.
+    makedirs(dest)
+    for entry in entries:
+      if entry['type'] == 'dir':
+        makedirs(target(entry))
+      else:
+        makedirs(os.path.dirname(target(entry)))
+
+    with ThreadPoolExecutor(jobs) as executor:
+      files = [e for e in entries if e['type'] == 'file']
+      for _ in executor.map(extract_file, files):
+        pass
+
+    for entry in entries:
+      filename = target(entry)
+      if entry['type'] == 'symlink':
+        if os.path.lexists(filename):
+          os.remove(filename)
+        os.symlink(entry['target'], filename)
+      elif entry['type'] == 'hardlink':
+        source = os.path.join(dest, *_check_path(entry['target']).split('/'))
+        if os.path.lexists(filename):
+          os.remove(filename)
+        if os.path.exists(source):
+          os.link(source, filename)
+        else:
+          # The link target was not selected, extract its contents instead.
+          with open(filename, 'wb') as fp:
+            self.read(entry['target'], fp)
+          os.chmod(filename, entry['mode'])
+
+    # Restore directory permissions and times last, children first.
+    for entry in reversed(entries):
+      if entry['type'] == 'dir':
+        os.chmod(target(entry), entry['mode'])
+        os.utime(target(entry), (entry['mtime'], entry['mtime']))
+
+    return entries
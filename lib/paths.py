@@ -0,0 +1,43 @@
+# Copyright (c) 2017  Niklas Rosenstein
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+import os
+
+
+def data_dir(*parts, **kwargs):
+  """
+  Returns the path to the osxt data directory, joined with #parts. The
+  directory defaults to `~/.osxt` and can be changed with the `OSXT_HOME`
+  environment variable. The directory is created unless #create is #False.
+  """
+
+  create = kwargs.pop('create', True)
+  for key in kwargs:
+    raise TypeError("unexpected keyword argument '%s'" % key)
+
+  root = os.environ.get('OSXT_HOME') or os.path.expanduser('~/.osxt')
+  path = os.path.join(root, *parts)
+  if create and not os.path.isdir(path):
+    try:
+      os.makedirs(path)
+    except OSError:
+      if not os.path.isdir(path):
+        raise
+  return path
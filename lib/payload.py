@@ -0,0 +1,440 @@
+# Copyright (c) 2017  Niklas Rosenstein
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+import lzma
+import os
+import stat
+import struct
+import zlib
+
+import pbzx from './pbzx'
+import {XarError} from './xar'
+
+XZ_MAGIC = b'\xfd7zXZ\x00'
+
+
+class PayloadError(Exception):
+  pass
+
+
+class _DecodingReader(object):
+  """
+  Base class for file-like objects that decode a stream in blocks. The
+  buffer is consumed by advancing an index, so that many small reads (as
+  done for cpio headers) do not copy large decoded blocks.
+  """
+
+  def __init__(self, fp):
+    self.fp = fp
+    self.buffer = b''
+    self.index = 0
+    self.pos = 0
+
+  def _fill(self):
+    """
+    Returns the next block of decoded data, or an empty string at the end
+    of the stream.
+    """
+
+    raise NotImplementedError
+
+  def read(self, size=-1):
+    while size < 0 or len(self.buffer) - self.index < size:
+      data = self._fill()
+      if not data:
+        break
+      self.buffer = self.buffer[self.index:] + data
+      self.index = 0
+    if size < 0:
+      size = len(self.buffer) - self.index
+    data = self.buffer[self.index:self.index + size]
+    self.index += len(data)
+    self.pos += len(data)
+    return data
+
+  def tell(self):
+    return self.pos
+
+  def skip_to(self, offset):
+    """
+    Advances to #offset in the decoded stream, discarding the data before
+    it.
+    """
+
+    while self.pos < offset:
+      if not self.read(min(offset - self.pos, 1024 * 1024)):
+        raise PayloadError('offset {} is beyond the end of the stream'.format(offset))
+
+
+class PbzxReader(_DecodingReader):
+  """
+  A file-like object that decompresses a pbzx stream from #fp on the fly.
+  Every chunk of a pbzx stream is an independent XZ stream (or stored
+  uncompressed), so decompression happens one chunk at a time.
+  """
+
+  def __init__(self, fp):
+    _DecodingReader.__init__(self, fp)
+    if fp.read(4) != pbzx.MAGIC:
+      raise PayloadError('not a pbzx stream')
+    self.flags = struct.unpack('>Q', fp.read(8))[0]
+
+  def _fill(self):
+    header = self._next_header()
+    if header is None:
+      return b''
+    return self._read_chunk(header[1])
+
+  def _next_header(self):
+    if not self.flags & (1 << 24):
+      return None
+    header = self.fp.read(pbzx.CHUNK_HEADER.size)
+    if len(header) < pbzx.CHUNK_HEADER.size:
+      self.flags = 0
+      return None
+    # The flags of a chunk header are the uncompressed size of the chunk,
+    # the 16 MiB flag is not set for the last chunk.
+    self.flags, length = pbzx.CHUNK_HEADER.unpack(header)
+    return self.flags, length
+
+  def _read_chunk(self, length):
+    data = self.fp.read(length)
+    if len(data) != length:
+      raise PayloadError('truncated pbzx chunk')
+    if data.startswith(XZ_MAGIC):
+      data = lzma.decompress(data, format=lzma.FORMAT_XZ)
+    return data
+
+  def skip_to(self, offset):
+    """
+    Like #_DecodingReader.skip_to(), but chunks that end before #offset
+    are not decompressed. Their data is skipped with `seek()` if #fp
+    supports it.
+    """
+
+    available = len(self.buffer) - self.index
+    if self.pos + available >= offset:
+      return _DecodingReader.skip_to(self, offset)
+    self.pos += available
+    self.buffer, self.index = b'', 0
+    while self.pos < offset:
+      header = self._next_header()
+      if header is None:
+        raise PayloadError('offset {} is beyond the end of the stream'.format(offset))
+      size, length = header
+      if self.pos + size > offset:
+        self.buffer = self._read_chunk(length)
+        self.index = offset - self.pos
+        self.pos = offset
+        break
+      _skip(self.fp, length)
+      self.pos += size
+
+
+def _skip(fp, length):
+  try:
+    fp.seek(length, os.SEEK_CUR)
+    return
+  except (AttributeError, IOError, OSError, XarError):
+    # Not seekable, eg. an encoded member of a XAR archive.
+    pass
+  while length > 0:
+    data = fp.read(min(length, 1024 * 1024))
+    if not data:
+      raise PayloadError('unexpected end of stream')
+    length -= len(data)
+
+
+class GzipReader(_DecodingReader):
+  """
+  A file-like object that decompresses a gzip stream from #fp on the fly.
+  """
+
+  chunk_size = 1024 * 1024
+
+  def __init__(self, fp):
+    _DecodingReader.__init__(self, fp)
+    self.decoder = zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+  def _fill(self):
+    while self.decoder is not None:
+      data = self.fp.read(self.chunk_size)
+      if not data:
+        data, self.decoder = self.decoder.flush(), None
+        return data
+      data = self.decoder.decompress(data)
+      if data:
+        return data
+    return b''
+
+
+def open_payload(fp):
+  """
+  Returns a file-like object that reads the uncompressed cpio archive from
+  the `Payload` file object #fp, which may be pbzx or gzip compressed.
+  """
+
+  magic = fp.read(4)
+  if magic == pbzx.MAGIC:
+    fp.seek(fp.tell() - 4)
+    return PbzxReader(fp)
+  elif magic[:2] == b'\x1f\x8b':
+    fp.seek(fp.tell() - 4)
+    return GzipReader(fp)
+  raise PayloadError('unknown payload compression (magic {!r})'.format(magic))
+
+
+class CpioEntry(object):
+  """
+  A header in a cpio archive. #path is normalized so that it never starts
+  with `./`. #offset is the position of the header in the stream.
+  """
+
+  def __init__(self, path, mode, uid, gid, nlink, mtime, size, ino, offset):
+    self.path = path
+    self.mode = mode
+    self.uid = uid
+    self.gid = gid
+    self.nlink = nlink
+    self.mtime = mtime
+    self.size = size
+    self.ino = ino
+    self.offset = offset
+
+  def __repr__(self):
+    return '<CpioEntry {!r} mode={:o} size={}>'.format(self.path, self.mode, self.size)
+
+  def isdir(self):
+    return stat.S_ISDIR(self.mode)
+
+  def isreg(self):
+    return stat.S_ISREG(self.mode)
+
+  def islnk(self):
+    return stat.S_ISLNK(self.mode)
+
+
+def _read_exact(stream, size):
+  data = stream.read(size)
+  if len(data) != size:
+    raise PayloadError('unexpected end of cpio archive')
+  return data
+
+
+def _normpath(name):
+  while name.startswith('./'):
+    name = name[2:]
+  return name.strip('/') or '.'
+
+
+class CpioReader(object):
+  """
+  Reads the entries of a cpio archive in the odc (`070707`) or newc
+  (`070701`, `070702`) format from #stream, which only needs a `read()`
+  method. Iterating yields #CpioEntry objects; the data of the current
+  entry can be read with #read_data() or #copy_data() before advancing,
+  otherwise it is skipped.
+  """
+
+  def __init__(self, stream, offset=0):
+    self.stream = stream
+    self.offset = offset
+    self.remaining = 0
+    self.padding = 0
+
+  def __iter__(self):
+    return self
+
+  def __next__(self):
+    self.skip_data()
+    entry = self._read_header()
+    if entry is None:
+      raise StopIteration
+    return entry
+
+  next = __next__
+
+  def _read_header(self):
+    start = self.offset
+    magic = _read_exact(self.stream, 6)
+    if magic == b'070707':
+      header = _read_exact(self.stream, 70)
+      fields = [header[i:i + 6] for i in range(0, 42, 6)] + [header[42:53], header[53:59], header[59:70]]
+      dev, ino, mode, uid, gid, nlink, rdev, mtime, namesize, filesize = [int(x, 8) for x in fields]
+      name = _read_exact(self.stream, namesize)
+      self.offset += 76 + namesize
+      align = 1
+    elif magic in (b'070701', b'070702'):
+      header = _read_exact(self.stream, 104)
+      fields = [int(header[i:i + 8], 16) for i in range(0, 104, 8)]
+      ino, mode, uid, gid, nlink, mtime, filesize = fields[:7]
+      namesize = fields[11]
+      name = _read_exact(self.stream, namesize)
+      self.offset += 110 + namesize
+      pad = (4 - self.offset % 4) % 4
+      _read_exact(self.stream, pad)
+      self.offset += pad
+      align = 4
+    else:
+      raise PayloadError('bad cpio magic {!r} at offset {}'.format(magic, start))
+
+    name = name.rstrip(b'\0').decode('utf8', 'surrogateescape')
+    self.remaining = filesize
+    self.padding = (align - (self.offset + filesize) % align) % align
+    if name == 'TRAILER!!!':
+      self.skip_data()
+      return None
+    return CpioEntry(_normpath(name), mode, uid, gid, nlink, mtime, filesize, ino, start)
+
+  def read_data(self, size=-1):
+    """
+    Reads up to #size bytes of the current entry's data.
+    """
+
+    if size < 0 or size > self.remaining:
+      size = self.remaining
+    data = _read_exact(self.stream, size) if size else b''
+    self.remaining -= len(data)
+    self.offset += len(data)
+    if not self.remaining and self.padding:
+      _read_exact(self.stream, self.padding)
+      self.offset += self.padding
+      self.padding = 0
+    return data
+
+  def copy_data(self, fp, chunk_size=1024*1024):
+    """
+    Writes the remaining data of the current entry to the file object #fp.
+    """
+
+    while self.remaining:
+      fp.write(self.read_data(chunk_size))
+    if self.padding:
+      self.read_data(0)
+
+  def skip_data(self):
+    self.copy_data(_NullFile())
+
+
+class _NullFile(object):
+
+  def write(self, data):
+    pass
+
+
+def extract_entry(reader, entry, dest, links=None):
+  """
+  Extracts the current #entry of the #CpioReader to the directory #dest.
+  #links maps inode numbers to the paths of already extracted files, so
+  hard links that have no data can be recreated. Returns the path of the
+  extracted file.
+  """
+
+  if entry.path == '.':
+    return dest
+  filename = os.path.join(dest, *entry.path.split('/'))
+  if '..' in entry.path.split('/'):
+    raise PayloadError('unsafe path in payload: {!r}'.format(entry.path))
+  parent = os.path.dirname(filename)
+  if not os.path.isdir(parent):
+    os.makedirs(parent)
+
+  if entry.isdir():
+    if not os.path.isdir(filename):
+      os.makedirs(filename)
+    # Keep the directory writable for the entries that follow it.
+    os.chmod(filename, stat.S_IMODE(entry.mode) | stat.S_IWUSR | stat.S_IXUSR)
+    return filename
+
+  if os.path.lexists(filename) and not os.path.isdir(filename):
+    os.remove(filename)
+
+  if entry.islnk():
+    os.symlink(reader.read_data().decode('utf8', 'surrogateescape'), filename)
+    return filename
+  if not entry.isreg():
+    # Device files, fifos etc. are never part of a toolchain payload.
+    reader.skip_data()
+    return None
+
+  if links is not None and entry.nlink > 1 and entry.size == 0 and entry.ino in links:
+    os.link(links[entry.ino], filename)
+    return filename
+
+  with open(filename, 'wb') as fp:
+    reader.copy_data(fp)
+  os.chmod(filename, stat.S_IMODE(entry.mode))
+  os.utime(filename, (entry.mtime, entry.mtime))
+  if os.getuid() == 0:
+    os.lchown(filename, entry.uid, entry.gid)
+  if links is not None and entry.nlink > 1:
+    links[entry.ino] = filename
+  return filename
+
+
+def extract(stream, dest, members=None, follow_symlinks=True, offset=0, links=None,
+    checkpoint=None, first=False):
+  """
+  Extracts the cpio archive from #stream into #dest. If #members is a
+  collection of paths, only these files are extracted and the function
+  returns as soon as all of them have been found, without reading the
+  rest of the stream. With #first, it returns as soon as one of them has
+  been found instead, eg. if #members are alternative locations of the
+  same file. With #follow_symlinks, the targets of selected symlinks are
+  selected as well. Returns the paths of the members that were extracted.
+
+  An interrupted extraction is resumed by passing the #offset of the
+  header of the next entry in the uncompressed stream and the #links
+  (inode numbers mapped to paths) of the entries extracted before it.
+  #checkpoint is called with the offset of the next header, the
+  #CpioEntry and the path of the extracted file after every entry.
+  """
+
+  wanted = None if members is None else set(_normpath(x) for x in members)
+  found = []
+  links = {} if links is None else links
+  if offset:
+    if hasattr(stream, 'skip_to'):
+      stream.skip_to(offset)
+    else:
+      _skip(stream, offset)
+  reader = CpioReader(stream, offset)
+  for entry in reader:
+    if wanted is not None and entry.path not in wanted:
+      continue
+    if wanted is not None and entry.islnk() and follow_symlinks:
+      filename = extract_entry(reader, entry, dest, links)
+      target = os.readlink(filename)
+      if not target.startswith('/'):
+        target = os.path.join(os.path.dirname(entry.path), target)
+      wanted.discard(entry.path)
+      wanted.add(_normpath(os.path.normpath(target)))
+      found.append(entry.path)
+      continue
+    filename = extract_entry(reader, entry, dest, links)
+    found.append(entry.path)
+    if checkpoint:
+      reader.skip_data()
+      checkpoint(reader.offset, entry, filename)
+    if wanted is not None:
+      wanted.discard(entry.path)
+      if first or not wanted:
+        break
+  return found
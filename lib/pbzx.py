@@ -22,23 +22,92 @@ from __future__ import print_function
 import os
 import requests
 import six
+import struct
+import threading
 import zipfile
 import system from './system'
 
+MAGIC = b'pbzx'
+CHUNK_HEADER = struct.Struct('>QQ')
+
 url = 'https://github.com/NiklasRosenstein/pbzx/releases/download/v1.0.2/pbzx-1.0.2.zip'
 
-def find_or_install():
-  download_dir = str(module.directory.joinpath('_download'))
-  os.environ['PATH'] = download_dir + os.pathsep + os.environ['PATH']
+_lock = threading.Lock()
+_program = None
+
+
+def find_or_install(verbose=None):
+  """
+  Returns the path to the `pbzx` program. If it is not on the `PATH`, it
+  is downloaded once to the `_download` directory of this package. Safe
+  to call from multiple threads.
+  """
+
+  global _program
+  with _lock:
+    if _program:
+      return _program
+
+    download_dir = str(module.directory.joinpath('_download'))
+    for program in ('pbzx', os.path.join(download_dir, 'pbzx')):
+      try:
+        system.getoutput(program, '-v', verbose=verbose)
+      except (OSError, system.ExitError):
+        continue
+      _program = program
+      return program
+
+    print('pbzx not available, downloading from', url, '...')
+    fp = six.BytesIO(requests.get(url).content)
+    archive = zipfile.ZipFile(fp)
+    archive.extract('pbzx', download_dir)
+    program = os.path.join(download_dir, 'pbzx')
+    system.call('chmod', '+x', program, verbose=verbose)
+    system.getoutput(program, '-v', verbose=verbose)
+    _program = program
+    return program
+
+
+def is_pbzx(fp):
+  """
+  Returns #True if the file object #fp starts with the pbzx magic. The
+  file position is restored afterwards.
+  """
+
+  pos = fp.tell()
   try:
-    version = system.getoutput('pbzx', '-v')
-    return
-  except (OSError, system.ExitError) as exc:
-    pass
-
-  print('pbzx not available, downloading from', url, '...')
-  fp = six.BytesIO(requests.get(url).content)
-  archive = zipfile.ZipFile(fp)
-  archive.extract('pbzx', download_dir)
-  system.call('chmod', '+x', os.path.join(download_dir, 'pbzx'))
-  system.getoutput('pbzx', '-v')
+    return fp.read(4) == MAGIC
+  finally:
+    fp.seek(pos)
+
+
+def iter_chunk_headers(fp):
+  """
+  Iterates over the chunk headers of the pbzx stream #fp without reading
+  the chunk data. Yields tuples of the offset of the chunk data in the
+  stream, the uncompressed size and the compressed size of the chunk.
+  """
+
+  start = fp.tell()
+  if fp.read(4) != MAGIC:
+    raise ValueError('not a pbzx stream')
+  flags = struct.unpack('>Q', fp.read(8))[0]
+  offset = 12
+  while flags & (1 << 24):
+    header = fp.read(CHUNK_HEADER.size)
+    if len(header) < CHUNK_HEADER.size:
+      break
+    flags, length = CHUNK_HEADER.unpack(header)
+    offset += CHUNK_HEADER.size
+    yield offset, flags, length
+    offset += length
+    fp.seek(start + offset)
+
+
+def expanded_size(fp):
+  """
+  Returns the total uncompressed size of the pbzx stream #fp, computed
+  from the chunk headers only.
+  """
+
+  return sum(size for _, size, _ in iter_chunk_headers(fp))
@@ -0,0 +1,267 @@
+# Copyright (c) 2017  Niklas Rosenstein
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+import glob
+import json
+import os
+import pipes
+import re
+import shutil
+import tempfile
+import time
+
+import {is_url} from './httpio'
+import {FileLock, lock_path} from './lock'
+import {data_dir} from './paths'
+
+ACTIVATE_TEMPLATE = '''\
+# Activate Mac OS X Command Line Tools in the current shell.
+# Generated by osxt for toolchain {name}, do not edit.
+
+_OLD_PATH=${{PATH}}
+_OLD_LD_LIBRARY_PATH=${{LD_LIBRARY_PATH}}
+_OLD_C_INCLUDE_PATH=${{C_INCLUDE_PATH}}
+_OLD_CPLUS_INCLUDE_PATH=${{CPLUS_INCLUDE_PATH}}
+_OLD_OBJC_INCLUDE_PATH=${{OBJC_INCLUDE_PATH}}
+_OLD_OBJCPLUS_INCLUDE_PATH=${{OBJCPLUS_INCLUDE_PATH}}
+
+function deactivate-xcode() {{
+    export PATH=${{_OLD_PATH}}
+    export LD_LIBRARY_PATH=${{_OLD_LD_LIBRARY_PATH}}
+    export C_INCLUDE_PATH=${{_OLD_C_INCLUDE_PATH}}
+    export CPLUS_INCLUDE_PATH=${{_OLD_CPLUS_INCLUDE_PATH}}
+    export OBJC_INCLUDE_PATH=${{_OLD_OBJC_INCLUDE_PATH}}
+    export OBJCPLUS_INCLUDE_PATH=${{_OLD_OBJCPLUS_INCLUDE_PATH}}
+    unset -f deactivate-xcode
+    unset CLTOOLS_BIN
+    unset CLTOOLS_NAME
+}}
+
+export CLTOOLS_NAME={quoted_name}
+export CLTOOLS_BIN={bin}
+export PATH="$CLTOOLS_BIN:$PATH"
+export LD_LIBRARY_PATH={lib}:"$LD_LIBRARY_PATH"
+export C_INCLUDE_PATH={c_include}:"$C_INCLUDE_PATH"
+export CPLUS_INCLUDE_PATH={cplus_include}:"$CPLUS_INCLUDE_PATH"
+export OBJC_INCLUDE_PATH={objc_include}:"$OBJC_INCLUDE_PATH"
+export OBJCPLUS_INCLUDE_PATH={objcplus_include}:"$OBJCPLUS_INCLUDE_PATH"
+'''
+
+
+def toolchains_dir():
+  """
+  Returns the directory of the toolchain registry. Every toolchain gets a
+  sub-directory that contains a `toolchain.json` and an `activate` script
+  in which all paths have already been resolved at install time. The
+  `current` symlink points to the active toolchain, thus build wrappers
+  only need to `source $OSXT_HOME/toolchains/current/activate`.
+  """
+
+  return data_dir('toolchains')
+
+
+def check_name(name):
+  """
+  Raises a #ValueError if #name can not be used as a toolchain name.
+  """
+
+  if not name or name == 'current' or not re.match(r'^[\w\.\-\+]+$', name):
+    raise ValueError('invalid toolchain name: {!r}'.format(name))
+
+
+def default_name(text):
+  """
+  Derives a valid toolchain name from #text (eg. the base name of a Disk
+  Image File) by replacing unsupported characters with dashes. Returns
+  #None if no valid name remains.
+  """
+
+  name = re.sub(r'[^\w\.\-\+]+', '-', text).strip('-')
+  return None if not name or name == 'current' else name
+
+
+def resolve_environment(directory):
+  """
+  Resolves the paths that are set by `templates/activate` for the XCode
+  command-line tools installed in #directory. Returns a dictionary that
+  maps environment variable names to lists of paths.
+  """
+
+  directory = os.path.abspath(directory)
+  usr = os.path.join(directory, 'usr')
+  usr_tools = os.path.join(directory, 'Library/Developer/CommandLineTools/usr')
+  if not os.path.exists(os.path.join(usr_tools, 'bin', 'clang')):
+    usr_tools = usr
+
+  include_base = [os.path.join(usr_tools, 'include'), os.path.join(usr, 'include')]
+  cplus = sorted(glob.glob(os.path.join(usr, 'include', 'c++', '*')))
+  return {
+    'CLTOOLS_BIN': [os.path.join(usr_tools, 'bin')],
+    'LD_LIBRARY_PATH': [os.path.join(usr_tools, 'lib'), os.path.join(usr, 'lib')],
+    'C_INCLUDE_PATH': include_base,
+    'CPLUS_INCLUDE_PATH': include_base + cplus,
+    'OBJC_INCLUDE_PATH': include_base,
+    'OBJCPLUS_INCLUDE_PATH': include_base + [os.path.join(usr, 'include', 'objc')],
+  }
+
+
+def render_activate(name, directory):
+  """
+  Renders the activate script for the toolchain #name that is installed
+  in #directory.
+  """
+
+  def quote(key):
+    paths = []
+    for path in env[key]:
+      if path not in paths:
+        paths.append(path)
+    return pipes.quote(os.pathsep.join(paths))
+
+  env = resolve_environment(directory)
+  return ACTIVATE_TEMPLATE.format(
+    name=name,
+    quoted_name=pipes.quote(name),
+    bin=quote('CLTOOLS_BIN'),
+    lib=quote('LD_LIBRARY_PATH'),
+    c_include=quote('C_INCLUDE_PATH'),
+    cplus_include=quote('CPLUS_INCLUDE_PATH'),
+    objc_include=quote('OBJC_INCLUDE_PATH'),
+    objcplus_include=quote('OBJCPLUS_INCLUDE_PATH'))
+
+
+def _lock():
+  # Serializes changes to the registry between threads and processes.
+  return FileLock(lock_path('registry', toolchains_dir()), what='registry update')
+
+
+def _write_atomic(filename, data):
+  fd, tmp = tempfile.mkstemp(prefix='.' + os.path.basename(filename) + '.tmp-',
+    dir=os.path.dirname(filename))
+  try:
+    with os.fdopen(fd, 'w') as fp:
+      fp.write(data)
+    os.chmod(tmp, 0o644)
+    os.rename(tmp, filename)
+  except BaseException:
+    os.remove(tmp)
+    raise
+
+
+def register(name, directory, dmg=None):
+  """
+  Registers the toolchain installed in #directory under the specified
+  #name and generates its activate script. An existing registration
+  with the same name is replaced. Returns the toolchain info.
+  """
+
+  check_name(name)
+  path = os.path.join(toolchains_dir(), name)
+  info = {
+    'name': name,
+    'directory': os.path.abspath(directory),
+    'dmg': (dmg if is_url(dmg) else os.path.abspath(dmg)) if dmg else None,
+    'registered': time.strftime('%Y-%m-%dT%H:%M:%S'),
+  }
+  with _lock():
+    if not os.path.isdir(path):
+      os.makedirs(path)
+    _write_atomic(os.path.join(path, 'activate'), render_activate(name, directory))
+    _write_atomic(os.path.join(path, 'toolchain.json'), json.dumps(info, indent=2))
+  return info
+
+
+def unregister(name):
+  """
+  Removes the toolchain #name from the registry. The installed files are
+  not touched. If the toolchain is currently active, the `current` link
+  is removed as well.
+  """
+
+  check_name(name)
+  path = os.path.join(toolchains_dir(), name)
+  with _lock():
+    if not os.path.isdir(path):
+      raise KeyError(name)
+    if current() == name:
+      os.remove(os.path.join(toolchains_dir(), 'current'))
+    for filename in os.listdir(path):
+      os.remove(os.path.join(path, filename))
+    os.rmdir(path)
+
+
+def get(name):
+  """
+  Returns the toolchain info for #name. Raises a #KeyError if no such
+  toolchain is registered.
+  """
+
+  check_name(name)
+  filename = os.path.join(toolchains_dir(), name, 'toolchain.json')
+  try:
+    with open(filename) as fp:
+      return json.load(fp)
+  except (IOError, OSError):
+    raise KeyError(name)
+
+
+def names():
+  """
+  Returns a sorted list of the names of all registered toolchains.
+  """
+
+  root = toolchains_dir()
+  result = []
+  for name in os.listdir(root):
+    if name != 'current' and os.path.isfile(os.path.join(root, name, 'toolchain.json')):
+      result.append(name)
+  return sorted(result)
+
+
+def current():
+  """
+  Returns the name of the active toolchain or #None.
+  """
+
+  try:
+    return os.readlink(os.path.join(toolchains_dir(), 'current'))
+  except OSError:
+    return None
+
+
+def use(name):
+  """
+  Makes #name the active toolchain. The `current` symlink is replaced
+  atomically, so shells that source `current/activate` concurrently
+  will always see either the old or the new toolchain.
+  """
+
+  root = toolchains_dir()
+  with _lock():
+    get(name)
+    # The link is created in a private directory, so that concurrent
+    # callers never share a temporary name.
+    tmpdir = tempfile.mkdtemp(prefix='.current.tmp-', dir=root)
+    try:
+      tmp = os.path.join(tmpdir, 'current')
+      os.symlink(name, tmp)
+      os.rename(tmp, os.path.join(root, 'current'))
+    finally:
+      shutil.rmtree(tmpdir)
@@ -24,7 +24,8 @@ import six
 import subprocess
 import sys
 
-#: True if verbose output is desired.
+#: True if verbose output is desired. This is only the default for
+#: functions that accept a ``verbose`` keyword argument.
 verbose = True
 
 
@@ -48,24 +49,51 @@ def format(*args):
     return ' '.join(pipes.quote(x) for x in args)
 
 
-def call(*args):
-    if verbose:
+def _pop_options(kwargs, *names):
+    result = [kwargs.pop(name, None) for name in names]
+    for key in kwargs:
+        raise TypeError("unexpected keyword argument '%s'" % key)
+    return result
+
+
+def call(*args, **kwargs):
+    '''
+    Runs the command *args* and waits for it to finish.
+
+    :param verbose: Print the command and let it write to the standard
+        output. Defaults to the module-level :data:`verbose`.
+    :param cwd: The working directory for the command.
+    :raise ExitError: if the command exits with a non-zero code.
+    '''
+
+    verbose_, cwd = _pop_options(kwargs, 'verbose', 'cwd')
+    if verbose_ is None:
+        verbose_ = verbose
+    if verbose_:
         print('$', format(*args))
-        stdout = stderr = 1
+        stdout = stderr = None
     else:
-        stdout = subprocess.PIPE
-        stderr = subprocess.STDOUT
-    process = subprocess.Popen(args, shell=False)
+        stdout = stderr = subprocess.DEVNULL
+    process = subprocess.Popen(args, shell=False, stdout=stdout,
+        stderr=stderr, cwd=cwd)
     process.wait()
     if process.returncode != 0:
         raise ExitError(args, process.returncode)
 
 
-def getoutput(*args):
-    if verbose:
+def getoutput(*args, **kwargs):
+    '''
+    Runs the command *args* and returns its combined standard and error
+    output. Accepts the same keyword arguments as :func:`call`.
+    '''
+
+    verbose_, cwd = _pop_options(kwargs, 'verbose', 'cwd')
+    if verbose_ is None:
+        verbose_ = verbose
+    if verbose_:
         print('$', format(*args))
     process = subprocess.Popen(args, shell=False, stdout=subprocess.PIPE,
-        stderr=subprocess.STDOUT)
+        stderr=subprocess.STDOUT, cwd=cwd)
     stdout = process.communicate()[0]
     if process.returncode != 0:
         raise ExitError(args, process.returncode)
@@ -85,13 +113,18 @@ def multicall(*commands, **kwargs):
         output).
     :param cwd: The current working directory for all commands.
         Defaults to None (the current working directory is used).
+    :param verbose: Print the commands and show their output. Defaults
+        to the module-level :data:`verbose`.
     '''
 
     # Read additional options for the call.
+    verbose_ = kwargs.pop('verbose', None)
+    if verbose_ is None:
+        verbose_ = verbose
     data = {
-        'stdin': kwargs.pop('stdin', None if verbose else subprocess.DEVNULL),
-        'stdout': kwargs.pop('stdout', None if verbose else subprocess.DEVNULL),
-        'stderr': kwargs.pop('stderr', None if verbose else subprocess.DEVNULL),
+        'stdin': kwargs.pop('stdin', None if verbose_ else subprocess.DEVNULL),
+        'stdout': kwargs.pop('stdout', None if verbose_ else subprocess.DEVNULL),
+        'stderr': kwargs.pop('stderr', None if verbose_ else subprocess.DEVNULL),
         'cwd': kwargs.pop('cwd', None),
     }
 
@@ -108,7 +141,7 @@ def multicall(*commands, **kwargs):
                 % type(command).__name__)
 
     # Print an approximate shell representation of the call.
-    if verbose:
+    if verbose_:
         if data['cwd']:
             print('$ cd', os.path.abspath(data['cwd']))
         print('$', ' | '.join(format(*c) for c in commands))
@@ -0,0 +1,315 @@
+# Copyright (c) 2017  Niklas Rosenstein
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+import bisect
+import bz2
+import collections
+import lzma
+import os
+import plistlib
+import struct
+import threading
+import zlib
+
+from concurrent.futures import ThreadPoolExecutor
+
+SECTOR_SIZE = 512
+
+#: The `koly` trailer in the last 512 bytes of a UDIF Disk Image File.
+KOLY = struct.Struct('>4sIIIQQQQQII16sII128sQQ120sII128sIQIII')
+#: The header of a `blkx` block table (`mish`).
+MISH = struct.Struct('>4sIQQQII24sII128sI')
+MISH_CHUNK = struct.Struct('>IIQQQQ')
+
+CHUNK_ZERO = 0x00000000
+CHUNK_RAW = 0x00000001
+CHUNK_IGNORE = 0x00000002
+CHUNK_ADC = 0x80000004
+CHUNK_ZLIB = 0x80000005
+CHUNK_BZIP2 = 0x80000006
+CHUNK_LZFSE = 0x80000007
+CHUNK_LZMA = 0x80000008
+CHUNK_COMMENT = 0x7ffffffe
+CHUNK_END = 0xffffffff
+
+DECOMPRESSORS = {
+  CHUNK_ZLIB: zlib.decompress,
+  CHUNK_BZIP2: bz2.decompress,
+  CHUNK_LZMA: lzma.decompress,
+}
+
+
+class UdifError(Exception):
+  pass
+
+
+class BlockChunk(object):
+  """
+  A run of sectors in a partition. #offset and #size are the location of
+  the uncompressed data in the partition, #data_offset and #data_length
+  the location of the (compressed) data in the Disk Image File.
+  """
+
+  def __init__(self, type, offset, size, data_offset, data_length):
+    self.type = type
+    self.offset = offset
+    self.size = size
+    self.data_offset = data_offset
+    self.data_length = data_length
+
+  def __repr__(self):
+    return '<BlockChunk type=0x{:08x} offset={} size={}>'.format(self.type, self.offset, self.size)
+
+
+class Partition(object):
+
+  def __init__(self, name, size, chunks):
+    self.name = name
+    self.size = size
+    self.chunks = chunks
+
+  def __repr__(self):
+    return '<Partition {!r} size={}>'.format(self.name, self.size)
+
+
+def _parse_blkx(name, data, data_fork_offset):
+  if len(data) < MISH.size:
+    raise UdifError('{!r}: truncated block table'.format(name))
+  fields = MISH.unpack_from(data)
+  if fields[0] != b'mish':
+    raise UdifError('{!r}: bad block table magic {!r}'.format(name, fields[0]))
+  sector_count, data_offset, num_chunks = fields[3], fields[4], fields[11]
+  chunks = []
+  for index in range(num_chunks):
+    type, _, sector, count, offset, length = MISH_CHUNK.unpack_from(data, MISH.size + index * MISH_CHUNK.size)
+    if type in (CHUNK_COMMENT, CHUNK_END) or count == 0:
+      continue
+    chunks.append(BlockChunk(type, sector * SECTOR_SIZE, count * SECTOR_SIZE,
+      data_fork_offset + data_offset + offset, length))
+  return Partition(name, sector_count * SECTOR_SIZE, chunks)
+
+
+class UdifImage(object):
+  """
+  Reads the partition map of a UDIF Disk Image File (`*.dmg`) from the
+  `koly` trailer and the `blkx` tables in its XML property list. #fp is a
+  seekable binary file object, if it has a `read_at()` method (like
+  #httpio.HttpFile) that is used instead, so it can be read from multiple
+  threads.
+  """
+
+  def __init__(self, fp):
+    self.fp = fp
+    self._lock = threading.Lock()
+    fp.seek(0, os.SEEK_END)
+    self.size = fp.tell()
+    if self.size < KOLY.size:
+      raise UdifError('not a UDIF Disk Image File (file too short)')
+    koly = KOLY.unpack(self.read_at(self.size - KOLY.size, KOLY.size))
+    if koly[0] != b'koly':
+      raise UdifError('not a UDIF Disk Image File (missing koly trailer)')
+    data_fork_offset, xml_offset, xml_length = koly[5], koly[15], koly[16]
+    if not xml_length:
+      raise UdifError('Disk Image File has no XML property list')
+    plist = plistlib.loads(self.read_at(xml_offset, xml_length))
+    self.partitions = []
+    for entry in plist.get('resource-fork', {}).get('blkx', []):
+      name = entry.get('Name') or entry.get('CFName') or ''
+      self.partitions.append(_parse_blkx(name, entry['Data'], data_fork_offset))
+
+  def read_at(self, offset, size):
+    if hasattr(self.fp, 'read_at'):
+      return self.fp.read_at(offset, size)
+    with self._lock:
+      self.fp.seek(offset)
+      return self.fp.read(size)
+
+  def find_partition(self, *names):
+    """
+    Returns the first #Partition whose name contains one of #names (eg.
+    `Apple_HFS`), or the largest partition if #names is empty.
+    """
+
+    if not names:
+      return max(self.partitions, key=lambda p: p.size)
+    for partition in self.partitions:
+      if any(name in partition.name for name in names):
+        return partition
+    raise UdifError('no partition matching {!r}'.format(names))
+
+  def open(self, partition, jobs=4, cache_size=64*1024*1024):
+    return PartitionReader(self, partition, jobs, cache_size)
+
+
+class PartitionReader(object):
+  """
+  A seekable file-like object for the uncompressed data of a #Partition.
+  Only the chunks that are actually read are fetched and decompressed.
+  #prefetch() loads the chunks for a list of byte ranges in parallel, which
+  hides the latency of a remote Disk Image File. Decompressed chunks are
+  kept in a cache of at most #cache_size bytes.
+  """
+
+  #: Adjacent compressed chunks are fetched in one request up to this size.
+  max_request_size = 4 * 1024 * 1024
+
+  def __init__(self, image, partition, jobs=4, cache_size=64*1024*1024):
+    self.image = image
+    self.partition = partition
+    self.chunks = sorted(partition.chunks, key=lambda c: c.offset)
+    self.starts = [c.offset for c in self.chunks]
+    self.size = partition.size
+    self.jobs = jobs
+    self.cache_size = cache_size
+    self.pos = 0
+    self._cache = collections.OrderedDict()
+    self._cache_bytes = 0
+    self._lock = threading.Lock()
+
+  def _find_chunks(self, offset, size):
+    """
+    Returns the indices of the chunks that overlap the range.
+    """
+
+    index = max(0, bisect.bisect_right(self.starts, offset) - 1)
+    end = offset + size
+    result = []
+    while index < len(self.chunks) and self.chunks[index].offset < end:
+      chunk = self.chunks[index]
+      if chunk.offset + chunk.size > offset:
+        result.append(index)
+      index += 1
+    return result
+
+  def _decode(self, chunk, data):
+    if chunk.type in (CHUNK_ZERO, CHUNK_IGNORE):
+      return bytes(chunk.size)
+    if chunk.type == CHUNK_RAW:
+      result = data
+    elif chunk.type in DECOMPRESSORS:
+      result = DECOMPRESSORS[chunk.type](data)
+    else:
+      raise UdifError('unsupported chunk type 0x{:08x} (ADC and LZFSE are not '
+        'supported)'.format(chunk.type))
+    if len(result) < chunk.size:
+      result += bytes(chunk.size - len(result))
+    return result[:chunk.size]
+
+  def _store(self, index, data):
+    with self._lock:
+      if index in self._cache:
+        return
+      self._cache[index] = data
+      self._cache_bytes += len(data)
+      while self._cache_bytes > self.cache_size and len(self._cache) > 1:
+        _, old = self._cache.popitem(last=False)
+        self._cache_bytes -= len(old)
+
+  def _get(self, index):
+    with self._lock:
+      data = self._cache.get(index)
+      if data is not None:
+        self._cache.move_to_end(index)
+        return data
+    chunk = self.chunks[index]
+    data = b''
+    if chunk.type not in (CHUNK_ZERO, CHUNK_IGNORE):
+      data = self.image.read_at(chunk.data_offset, chunk.data_length)
+    data = self._decode(chunk, data)
+    self._store(index, data)
+    return data
+
+  def _fetch_batch(self, indices):
+    chunks = [self.chunks[i] for i in indices]
+    start = chunks[0].data_offset
+    data = self.image.read_at(start, chunks[-1].data_offset + chunks[-1].data_length - start)
+    for index, chunk in zip(indices, chunks):
+      offset = chunk.data_offset - start
+      self._store(index, self._decode(chunk, data[offset:offset + chunk.data_length]))
+
+  def prefetch(self, ranges):
+    """
+    Fetches and decompresses the chunks that back the `(offset, size)`
+    #ranges of the partition with #jobs parallel requests. Chunks that are
+    adjacent in the Disk Image File are fetched together.
+    """
+
+    with self._lock:
+      indices = []
+      for offset, size in ranges:
+        for index in self._find_chunks(offset, size):
+          if index not in self._cache and (not indices or indices[-1] != index):
+            indices.append(index)
+    indices.sort()
+
+    batches = []
+    for index in indices:
+      chunk = self.chunks[index]
+      if chunk.type in (CHUNK_ZERO, CHUNK_IGNORE):
+        continue
+      if batches:
+        last = self.chunks[batches[-1][-1]]
+        first = self.chunks[batches[-1][0]]
+        end = chunk.data_offset + chunk.data_length
+        if last.data_offset + last.data_length == chunk.data_offset and \
+            end - first.data_offset <= self.max_request_size:
+          batches[-1].append(index)
+          continue
+      batches.append([index])
+
+    if len(batches) == 1:
+      self._fetch_batch(batches[0])
+    elif batches:
+      with ThreadPoolExecutor(self.jobs) as executor:
+        for _ in executor.map(self._fetch_batch, batches):
+          pass
+
+  def read_at(self, offset, size):
+    size = max(0, min(size, self.size - offset))
+    result = []
+    for index in self._find_chunks(offset, size):
+      chunk = self.chunks[index]
+      data = self._get(index)
+      start = max(offset, chunk.offset) - chunk.offset
+      end = min(offset + size, chunk.offset + chunk.size) - chunk.offset
+      result.append(data[start:end])
+    data = b''.join(result)
+    if len(data) < size:
+      # The chunks of a partition are expected to cover it without gaps.
+      raise UdifError('partition {!r} has no data at offset {}'.format(self.partition.name, offset))
+    return data
+
+  def read(self, size=-1):
+    if size < 0:
+      size = self.size - self.pos
+    data = self.read_at(self.pos, size)
+    self.pos += len(data)
+    return data
+
+  def seek(self, offset, whence=0):
+    if whence == os.SEEK_CUR:
+      offset += self.pos
+    elif whence == os.SEEK_END:
+      offset += self.size
+    self.pos = max(0, offset)
+    return self.pos
+
+  def tell(self):
+    return self.pos
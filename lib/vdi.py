@@ -0,0 +1,194 @@
+# Copyright (c) 2017  Niklas Rosenstein
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+import array
+import hashlib
+import json
+import os
+import struct
+import sys
+import tempfile
+import uuid
+
+import {FileLock, lock_path} from './lock'
+import {data_dir} from './paths'
+
+PRE_HEADER = struct.Struct('<64sII')
+PRE_HEADER_TEXT = b'<<< Oracle VM VirtualBox Disk Image >>>\n'
+SIGNATURE = 0xBEDA107F
+VERSION = 0x00010001
+
+#: The version 1.1 header that follows the pre-header.
+HEADER = struct.Struct('<III256sII4IIQIIII16s16s16s16s4I')
+HEADER_OFFSET = PRE_HEADER.size
+TYPE_DYNAMIC = 1
+SECTOR_SIZE = 512
+BLOCK_SIZE = 1024 * 1024
+BLOCK_FREE = 0xffffffff
+
+#: Images with these suffixes are attached to VirtualBox as they are.
+NATIVE_FORMATS = ('.vdi', '.vmdk', '.vhd', '.vhdx', '.hdd')
+
+
+class ConvertResult(object):
+  """
+  The result of #convert() and #convert_cached(). #blocks is the number of
+  blocks of the virtual disk, #allocated the number of blocks that were
+  written (the others are all-zero and not stored).
+  """
+
+  def __init__(self, filename, sha256, size, blocks, allocated, cached=False):
+    self.filename = filename
+    self.sha256 = sha256
+    self.size = size
+    self.blocks = blocks
+    self.allocated = allocated
+    self.cached = cached
+
+
+def _pack_header(size, blocks, allocated, offset_blocks, offset_data, comment=b''):
+  return HEADER.pack(
+    HEADER.size, TYPE_DYNAMIC, 0, comment,
+    offset_blocks, offset_data,
+    0, 0, 0, SECTOR_SIZE,  # legacy geometry, VirtualBox computes it
+    0, size, BLOCK_SIZE, 0, blocks, allocated,
+    uuid.uuid4().bytes_le, uuid.uuid4().bytes_le, bytes(16), bytes(16),
+    0, 0, 0, SECTOR_SIZE)
+
+
+def convert(source, dest, progress=None):
+  """
+  Converts the raw disk image (or ISO image) #source into a dynamically
+  allocated VDI image #dest in a single streaming pass. Blocks that
+  contain only zeros are not written to the image. #progress is called
+  with the number of bytes read and the size of #source. Returns a
+  #ConvertResult that includes the SHA-256 of #source.
+  """
+
+  size = os.path.getsize(source)
+  disk_size = (size + SECTOR_SIZE - 1) // SECTOR_SIZE * SECTOR_SIZE
+  blocks = (disk_size + BLOCK_SIZE - 1) // BLOCK_SIZE
+  block_map = array.array('I', [BLOCK_FREE]) * blocks
+  offset_blocks = 2 * SECTOR_SIZE
+  offset_data = offset_blocks + blocks * 4
+  offset_data = (offset_data + BLOCK_SIZE - 1) // BLOCK_SIZE * BLOCK_SIZE
+  zero_block = bytes(BLOCK_SIZE)
+  hasher = hashlib.sha256()
+  allocated = 0
+
+  with open(source, 'rb') as src, open(dest, 'wb') as fp:
+    fp.truncate(offset_data)
+    fp.seek(offset_data)
+    for index in range(blocks):
+      data = src.read(BLOCK_SIZE)
+      hasher.update(data)
+      if data != zero_block[:len(data)]:
+        if len(data) < BLOCK_SIZE:
+          data += zero_block[len(data):]
+        fp.write(data)
+        block_map[index] = allocated
+        allocated += 1
+      if progress:
+        progress(min(size, (index + 1) * BLOCK_SIZE), size)
+
+    fp.seek(0)
+    fp.write(PRE_HEADER.pack(PRE_HEADER_TEXT, SIGNATURE, VERSION))
+    fp.write(_pack_header(disk_size, blocks, allocated, offset_blocks, offset_data))
+    fp.seek(offset_blocks)
+    if sys.byteorder != 'little':
+      block_map.byteswap()
+    fp.write(block_map.tobytes())
+
+  return ConvertResult(dest, hasher.hexdigest(), disk_size, blocks, allocated)
+
+
+def cache_dir():
+  return data_dir('vdi')
+
+
+def _load_index(directory):
+  try:
+    with open(os.path.join(directory, 'index.json')) as fp:
+      return json.load(fp)
+  except (IOError, OSError, ValueError):
+    return {}
+
+
+def _index_lock(directory):
+  # Serializes read-modify-write cycles of the index file between threads
+  # and processes.
+  return FileLock(lock_path('vdi', os.path.abspath(directory)), what='VDI cache update')
+
+
+def _save_index(directory, index):
+  fd, tmp = tempfile.mkstemp(prefix='.index.json.tmp-', dir=directory)
+  try:
+    with os.fdopen(fd, 'w') as fp:
+      json.dump(index, fp, indent=2, sort_keys=True)
+    os.chmod(tmp, 0o644)
+    os.rename(tmp, os.path.join(directory, 'index.json'))
+  except BaseException:
+    os.remove(tmp)
+    raise
+
+
+def convert_cached(source, progress=None, directory=None):
+  """
+  Like #convert(), but the VDI image is stored in the cache directory
+  under the SHA-256 of #source and reused for sources with the same
+  content. The digest of #source is remembered by its path, size and
+  modification time, so an unchanged source is not read again.
+  """
+
+  directory = directory or cache_dir()
+  key = os.path.abspath(source)
+  st = os.stat(source)
+  with _index_lock(directory):
+    memo = _load_index(directory).get(key)
+  if memo and memo['size'] == st.st_size and memo['mtime'] == st.st_mtime:
+    filename = os.path.join(directory, memo['sha256'] + '.vdi')
+    if os.path.isfile(filename):
+      return ConvertResult(filename, memo['sha256'], memo['disk_size'], memo['blocks'],
+        memo['allocated'], cached=True)
+
+  fd, tmp = tempfile.mkstemp(prefix='.convert-', suffix='.vdi', dir=directory)
+  os.close(fd)
+  os.chmod(tmp, 0o644)
+  try:
+    result = convert(source, tmp, progress)
+    filename = os.path.join(directory, result.sha256 + '.vdi')
+    if os.path.isfile(filename):
+      # Same content under another path, keep the image that may already
+      # be registered with VirtualBox.
+      os.remove(tmp)
+      result.cached = True
+    else:
+      os.rename(tmp, filename)
+    result.filename = filename
+  finally:
+    if os.path.exists(tmp):
+      os.remove(tmp)
+
+  with _index_lock(directory):
+    index = _load_index(directory)
+    index[key] = {'size': st.st_size, 'mtime': st.st_mtime, 'sha256': result.sha256,
+      'disk_size': result.size, 'blocks': result.blocks, 'allocated': result.allocated}
+    _save_index(directory, index)
+  return result
@@ -0,0 +1,239 @@
+# Copyright (c) 2017  Niklas Rosenstein
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+import contextlib
+import glob
+import multiprocessing
+import os
+import sqlite3
+import time
+
+import cache from './cache'
+import installer from './installer'
+import payload from './payload'
+import system from './system'
+import {data_dir} from './paths'
+import {XarArchive} from './xar'
+
+#: Paths of the clang binary in the payloads of the different CLTools versions.
+CLANG_PATHS = ('usr/bin/clang', 'Library/Developer/CommandLineTools/usr/bin/clang')
+
+
+@contextlib.contextmanager
+def open_package_payload(info):
+  """
+  A context manager that opens the `Payload` of the package described by
+  the #installer.PackageInfo #info and yields a decompressing file-like
+  object for the cpio archive. The payload is read directly from the XAR
+  archive, nothing is unpacked.
+  """
+
+  if os.path.isdir(info.filename):
+    with open(os.path.join(info.filename, 'Payload'), 'rb') as fp:
+      yield payload.open_payload(fp)
+  else:
+    with XarArchive(info.filename) as archive:
+      name = (info.member + '/' if info.member else '') + 'Payload'
+      yield payload.open_payload(archive.open(name))
+
+
+def _package_order(info):
+  # The clang binary lives in the Executables package, look there first.
+  return (0 if info.matches('*Executables*') else 1, info.name)
+
+
+def extract_clang(dmg, dest, verbose=False):
+  """
+  Extracts only the clang binary from the Disk Image File #dmg to #dest.
+  The payloads are decompressed as a stream and reading stops as soon as
+  the binary has been extracted. Returns the path to the binary or #None.
+  """
+
+  with installer.MultiContext() as context:
+    volume = context.enter(installer.MountFile(dmg, verbose=verbose, private=True))
+    packages, _ = installer.Installer(select=lambda pkgs: pkgs[0]).inspect(volume)
+    for info in sorted(packages, key=_package_order):
+      with open_package_payload(info) as stream:
+        found = payload.extract(stream, dest, CLANG_PATHS, first=True)
+      for path in CLANG_PATHS:
+        filename = os.path.join(dest, *path.split('/'))
+        if path in found and os.path.isfile(filename):
+          return filename
+  return None
+
+
+def clang_version(dmg, verbose=False):
+  """
+  Returns the output of `clang --version` for the clang binary from the
+  Disk Image File #dmg. Raises a #RuntimeError if there is no clang.
+  """
+
+  with installer.TempDir() as tmpdir:
+    clang_bin = extract_clang(dmg, tmpdir, verbose)
+    if not clang_bin:
+      raise RuntimeError('no clang binary found in {!r}'.format(dmg))
+    return system.getoutput(clang_bin, '--version', verbose=verbose).strip()
+
+
+class VersionCache(object):
+  """
+  A small SQLite database that maps the SHA-256 of a Disk Image File to
+  the output of `clang --version`. Digests are memoized by path, size and
+  modification time, so unchanged files are not hashed again.
+  """
+
+  def __init__(self, filename=None):
+    self.filename = filename or os.path.join(data_dir(), 'versions.db')
+    self.db = sqlite3.connect(self.filename, timeout=30)
+    with self.db:
+      self.db.execute('CREATE TABLE IF NOT EXISTS digests (path TEXT PRIMARY KEY, '
+        'size INTEGER, mtime REAL, sha256 TEXT)')
+      self.db.execute('CREATE TABLE IF NOT EXISTS versions (sha256 TEXT PRIMARY KEY, '
+        'name TEXT, version TEXT, created REAL)')
+
+  def close(self):
+    self.db.close()
+
+  def cached_digest(self, filename):
+    """
+    Returns the memoized SHA-256 of #filename or #None.
+    """
+
+    st = os.stat(filename)
+    row = self.db.execute('SELECT sha256 FROM digests WHERE path = ? AND size = ? '
+      'AND mtime = ?', (os.path.abspath(filename), st.st_size, st.st_mtime)).fetchone()
+    return row[0] if row else None
+
+  def set_digest(self, filename, digest):
+    st = os.stat(filename)
+    with self.db:
+      self.db.execute('INSERT OR REPLACE INTO digests VALUES (?, ?, ?, ?)',
+        (os.path.abspath(filename), st.st_size, st.st_mtime, digest))
+
+  def digest(self, filename):
+    """
+    Returns the SHA-256 of #filename, computing and memoizing it if needed.
+    """
+
+    digest = self.cached_digest(filename)
+    if not digest:
+      digest = cache.sha256_file(filename)
+      self.set_digest(filename, digest)
+    return digest
+
+  def get(self, digest):
+    row = self.db.execute('SELECT version FROM versions WHERE sha256 = ?', (digest,)).fetchone()
+    return row[0] if row else None
+
+  def set(self, digest, name, version):
+    with self.db:
+      self.db.execute('INSERT OR REPLACE INTO versions VALUES (?, ?, ?, ?)',
+        (digest, os.path.basename(name), version, time.time()))
+
+
+def find_dmgs(paths):
+  """
+  Expands the directories in #paths to the `*.dmg` files they contain.
+  """
+
+  result = []
+  for path in paths:
+    if os.path.isdir(path):
+      result += sorted(glob.glob(os.path.join(path, '*.dmg')))
+    else:
+      result.append(path)
+  return result
+
+
+def _worker(tasks, results, verbose):
+  while True:
+    task = tasks.get()
+    if task is None:
+      break
+    dmg, digest = task
+    try:
+      if not digest:
+        digest = cache.sha256_file(dmg)
+      results.put((dmg, digest, clang_version(dmg, verbose), None))
+    except Exception as exc:
+      results.put((dmg, digest, None, str(exc)))
+
+
+def get_versions(dmgs, jobs=None, use_cache=True, verbose=False, callback=None):
+  """
+  Determines the clang version of every Disk Image File in #dmgs. Files
+  that are not in the #VersionCache are processed by #jobs worker
+  processes. #callback is called with the file name, version and error
+  message (one of which is #None) for every file as soon as its result is
+  available. Returns a dictionary that maps file names to versions (or
+  #None for failed files).
+  """
+
+  db = VersionCache()
+  results = {}
+
+  def report(dmg, version, error):
+    results[dmg] = version
+    if callback:
+      callback(dmg, version, error)
+
+  try:
+    pending = []
+    for dmg in dmgs:
+      try:
+        digest = db.cached_digest(dmg)
+      except OSError as exc:
+        # Eg. a misspelled file name, report it like any other failure.
+        report(dmg, None, exc.strerror or str(exc))
+        continue
+      version = db.get(digest) if (digest and use_cache) else None
+      if version:
+        report(dmg, version, None)
+      else:
+        pending.append((dmg, digest))
+    if not pending:
+      return results
+
+    # Worker processes are forked so that they inherit the loaded modules,
+    # only file names and results pass through the queues.
+    context = multiprocessing.get_context('fork')
+    tasks = context.Queue()
+    queue = context.Queue()
+    jobs = max(1, min(jobs or os.cpu_count() or 1, len(pending)))
+    workers = [context.Process(target=_worker, args=(tasks, queue, verbose)) for _ in range(jobs)]
+    for task in pending:
+      tasks.put(task)
+    for worker in workers:
+      tasks.put(None)
+      worker.start()
+
+    for _ in range(len(pending)):
+      dmg, digest, version, error = queue.get()
+      if digest:
+        db.set_digest(dmg, digest)
+      if version:
+        db.set(digest, dmg, version)
+      report(dmg, version, error)
+    for worker in workers:
+      worker.join()
+  finally:
+    db.close()
+
+  return results
@@ -0,0 +1,218 @@
+# Copyright (c) 2017  Niklas Rosenstein
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+import bz2
+import six
+import struct
+import threading
+import xml.etree.ElementTree as ET
+import zlib
+
+MAGIC = b'xar!'
+HEADER = struct.Struct('>4sHHQQI')
+
+
+class XarError(Exception):
+  pass
+
+
+class XarEntry(object):
+  """
+  Represents a file or directory in the table of contents of a XAR
+  archive. #offset is relative to the start of the archive's heap.
+  """
+
+  def __init__(self, path, type, offset=None, length=0, size=0, encoding=None):
+    self.path = path
+    self.type = type
+    self.offset = offset
+    self.length = length
+    self.size = size
+    self.encoding = encoding
+
+  def __repr__(self):
+    return '<XarEntry {!r} type={!r} size={}>'.format(self.path, self.type, self.size)
+
+
+class XarArchive(object):
+  """
+  Reads the table of contents of a XAR archive (eg. a flat `*.pkg` file) and
+  gives access to the contained files without extracting the archive. #fp
+  can be a filename or a seekable binary file object. Reads from the same
+  archive are serialized, so it can be shared between threads.
+  """
+
+  def __init__(self, fp):
+    if isinstance(fp, six.string_types):
+      fp = open(fp, 'rb')
+      self._owns_fp = True
+    else:
+      self._owns_fp = False
+    self.fp = fp
+    self.lock = threading.Lock()
+
+    fp.seek(0)
+    data = fp.read(HEADER.size)
+    if len(data) < HEADER.size:
+      raise XarError('not a XAR archive (file too short)')
+    magic, header_size, version, toc_clen, toc_ulen, cksum = HEADER.unpack(data)
+    if magic != MAGIC:
+      raise XarError('not a XAR archive (bad magic {!r})'.format(magic))
+
+    fp.seek(header_size)
+    toc = zlib.decompress(fp.read(toc_clen))
+    self.heap_offset = header_size + toc_clen
+    self.toc = ET.fromstring(toc)
+    self.entries = {}
+    for node in self.toc.findall('toc/file'):
+      self._parse_entry(node, '')
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *args):
+    self.close()
+
+  def close(self):
+    if self._owns_fp:
+      self.fp.close()
+
+  def _parse_entry(self, node, prefix):
+    path = prefix + node.findtext('name', '')
+    entry = XarEntry(path, node.findtext('type', 'file'))
+    data = node.find('data')
+    if data is not None:
+      entry.offset = int(data.findtext('offset', '0'))
+      entry.length = int(data.findtext('length', '0'))
+      entry.size = int(data.findtext('size', '0'))
+      encoding = data.find('encoding')
+      if encoding is not None:
+        entry.encoding = encoding.get('style')
+    self.entries[path] = entry
+    for child in node.findall('file'):
+      self._parse_entry(child, path + '/')
+
+  def names(self, prefix=''):
+    """
+    Returns the sorted paths of all entries that start with #prefix.
+    """
+
+    return sorted(x for x in self.entries if x.startswith(prefix))
+
+  def read_raw(self, entry, offset=0, size=None):
+    """
+    Reads the (still encoded) data of #entry, starting at #offset.
+    """
+
+    if isinstance(entry, six.string_types):
+      entry = self.entries[entry]
+    if size is None:
+      size = entry.length - offset
+    size = max(0, min(size, entry.length - offset))
+    with self.lock:
+      self.fp.seek(self.heap_offset + entry.offset + offset)
+      return self.fp.read(size)
+
+  def read(self, entry):
+    """
+    Reads and decodes the complete data of #entry.
+    """
+
+    return self.open(entry).read()
+
+  def open(self, entry):
+    """
+    Returns a file-like object that reads the decoded data of #entry.
+    """
+
+    if isinstance(entry, six.string_types):
+      entry = self.entries[entry]
+    if entry.offset is None:
+      raise XarError('{!r} has no data'.format(entry.path))
+    return XarStream(self, entry)
+
+
+class XarStream(object):
+  """
+  A read-only file-like object for the decoded data of a #XarEntry. Only
+  forward reads are supported for compressed entries.
+  """
+
+  chunk_size = 1024 * 1024
+
+  def __init__(self, archive, entry):
+    self.archive = archive
+    self.entry = entry
+    self.raw_pos = 0
+    self.pos = 0
+    self.buffer = b''
+    if entry.encoding in (None, 'application/octet-stream'):
+      self.decoder = None
+    elif entry.encoding == 'application/x-gzip':
+      self.decoder = zlib.decompressobj()
+    elif entry.encoding == 'application/x-bzip2':
+      self.decoder = bz2.BZ2Decompressor()
+    else:
+      raise XarError('unsupported encoding {!r}'.format(entry.encoding))
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *args):
+    pass
+
+  def close(self):
+    pass
+
+  def tell(self):
+    return self.pos
+
+  def seek(self, offset, whence=0):
+    if self.decoder is not None:
+      raise XarError('can not seek in encoded entry {!r}'.format(self.entry.path))
+    if whence == 1:
+      offset += self.pos
+    elif whence == 2:
+      offset += self.entry.length
+    self.pos = self.raw_pos = max(0, offset)
+    return self.pos
+
+  def read(self, size=-1):
+    if self.decoder is None:
+      data = self.archive.read_raw(self.entry, self.raw_pos, None if size < 0 else size)
+      self.raw_pos += len(data)
+      self.pos += len(data)
+      return data
+
+    while size < 0 or len(self.buffer) < size:
+      if self.raw_pos >= self.entry.length:
+        break
+      data = self.archive.read_raw(self.entry, self.raw_pos, self.chunk_size)
+      if not data:
+        break
+      self.raw_pos += len(data)
+      self.buffer += self.decoder.decompress(data)
+
+    if size < 0:
+      data, self.buffer = self.buffer, b''
+    else:
+      data, self.buffer = self.buffer[:size], self.buffer[size:]
+    self.pos += len(data)
+    return data
@@ -0,0 +1,89 @@
+# Copyright (c) 2017  Niklas Rosenstein
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+import contextlib
+import gzip
+import os
+import shutil
+import stat
+import tempfile
+import unittest
+
+import installer from '../lib/installer'
+
+
+def make_cpio(entries):
+  """
+  Returns an odc cpio archive with the `(path, mode, data)` #entries.
+  """
+
+  result = []
+  for ino, (path, mode, data) in enumerate(list(entries) + [('TRAILER!!!', 0, b'')]):
+    name = path.encode('utf8') + b'\0'
+    fields = (0, ino, mode, 0, 0, 1, 0)
+    result.append(b'070707' + b''.join(b'%06o' % x for x in fields) + b'%011o' % 0 +
+      b'%06o' % len(name) + b'%011o' % len(data) + name + data)
+  return b''.join(result)
+
+
+class PackageDirectoryTest(unittest.TestCase):
+  """
+  Installs from a volume with a `Packages/` directory that contains package
+  directories instead of flat packages.
+  """
+
+  def setUp(self):
+    self.root = tempfile.mkdtemp()
+    self.volume = os.path.join(self.root, 'volume')
+    self.package = os.path.join(self.volume, 'Packages', 'CLTools_Executables.pkg')
+    self.dest = os.path.join(self.root, 'dest')
+    os.makedirs(self.package)
+    with open(os.path.join(self.package, 'PackageInfo'), 'wb') as fp:
+      fp.write(b'<pkg-info identifier="com.apple.pkg.CLTools_Executables">'
+        b'<payload numberOfFiles="3" installKBytes="1"/></pkg-info>')
+    self.mount_file = installer.MountFile
+    installer.MountFile = lambda *args, **kwargs: contextlib.nullcontext(self.volume)
+
+  def tearDown(self):
+    installer.MountFile = self.mount_file
+    shutil.rmtree(self.root)
+
+  def write_payload(self, data):
+    with open(os.path.join(self.package, 'Payload'), 'wb') as fp:
+      fp.write(data)
+
+  def test_package_directory_is_installed(self):
+    self.write_payload(gzip.compress(make_cpio([('.', stat.S_IFDIR | 0o755, b''),
+      ('./usr', stat.S_IFDIR | 0o755, b''),
+      ('./usr/bin', stat.S_IFDIR | 0o755, b''),
+      ('./usr/bin/clang', stat.S_IFREG | 0o755, b'clang')])))
+    result = installer.Installer().install('clt.dmg', self.dest)
+    self.assertTrue(result.installed)
+    self.assertEqual([x.name for x in result.packages], ['CLTools_Executables.pkg'])
+    with open(os.path.join(self.dest, 'usr', 'bin', 'clang'), 'rb') as fp:
+      self.assertEqual(fp.read(), b'clang')
+
+  def test_unreadable_payload_raises_install_error(self):
+    self.write_payload(b'not a payload')
+    with self.assertRaises(installer.InstallError):
+      installer.Installer().install('clt.dmg', self.dest)
+
+
+if require.main == module:
+  unittest.main()
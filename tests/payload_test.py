@@ -0,0 +1,89 @@
+# Copyright (c) 2017  Niklas Rosenstein
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+import io
+import os
+import shutil
+import stat
+import tempfile
+import unittest
+
+import payload from '../lib/payload'
+import {CLANG_PATHS} from '../lib/versions'
+
+
+def make_cpio(entries):
+  """
+  Returns an odc cpio archive with the `(path, mode, data)` #entries.
+  """
+
+  result = []
+  for ino, (path, mode, data) in enumerate(list(entries) + [('TRAILER!!!', 0, b'')]):
+    name = path.encode('utf8') + b'\0'
+    fields = (0, ino, mode, 0, 0, 1, 0)
+    result.append(b'070707' + b''.join(b'%06o' % x for x in fields) + b'%011o' % 0 +
+      b'%06o' % len(name) + b'%011o' % len(data) + name + data)
+  return b''.join(result)
+
+
+class CountingStream(object):
+
+  def __init__(self, data):
+    self.fp = io.BytesIO(data)
+    self.bytes_read = 0
+
+  def read(self, size=-1):
+    data = self.fp.read(size)
+    self.bytes_read += len(data)
+    return data
+
+
+class ExtractFirstTest(unittest.TestCase):
+
+  def setUp(self):
+    self.dest = tempfile.mkdtemp()
+
+  def tearDown(self):
+    shutil.rmtree(self.dest)
+
+  def test_trailing_member_is_not_read(self):
+    entries = [('.', stat.S_IFDIR | 0o755, b''),
+      ('./usr/bin/clang', stat.S_IFREG | 0o755, b'clang')]
+    data = make_cpio(entries + [('./usr/share/big', stat.S_IFREG | 0o644, bytes(4 * 1024 * 1024))])
+    stream = CountingStream(data)
+    found = payload.extract(stream, self.dest, CLANG_PATHS, first=True)
+    self.assertEqual(found, ['usr/bin/clang'])
+    # Nothing after the data of the first match is read, not even the
+    # header of the next entry.
+    self.assertEqual(stream.bytes_read, len(make_cpio(entries)) - len(make_cpio([])))
+    with open(os.path.join(self.dest, 'usr', 'bin', 'clang'), 'rb') as fp:
+      self.assertEqual(fp.read(), b'clang')
+
+  def test_symlink_target_is_extracted(self):
+    data = make_cpio([('./usr/bin/clang', stat.S_IFLNK | 0o755, b'clang-4.0'),
+      ('./usr/bin/clang-4.0', stat.S_IFREG | 0o755, b'clang'),
+      ('./usr/share/big', stat.S_IFREG | 0o644, bytes(4 * 1024 * 1024))])
+    stream = CountingStream(data)
+    found = payload.extract(stream, self.dest, CLANG_PATHS, first=True)
+    self.assertEqual(found, ['usr/bin/clang', 'usr/bin/clang-4.0'])
+    self.assertLess(stream.bytes_read, 1024)
+
+
+if require.main == module:
+  unittest.main()